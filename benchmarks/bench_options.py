@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of block-option parsing and merging in pweave.
+
+Compares get_options() and CodeProcessor.merge_options() with the
+implementations pweave used before option strings were parsed with a compiled
+grammar and memoized (reproduced below as legacy_get_options() and
+legacy_merge_options()).  The workload mimics a generated document: a few
+hundred distinct block headers, each repeated many times.
+
+Run from the repository's top directory:
+
+    python benchmarks/bench_options.py
+
+"""
+import os
+import re
+import imp
+import time
+import random
+
+pweave_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'pweave.py')
+pweave = imp.load_source('pweave', pweave_path)
+
+
+def legacy_get_options(optionstring):
+    "get_options() before it used a compiled grammar and memoization."
+    block_options = {"p": "default"}
+    
+    if len(optionstring) > 0:
+        if optionstring.startswith('#'):
+            block_options['__pweave_do_not_process'] = True
+            return block_options
+            
+        m = re.match('^([^,"=]*),([^=].*)$', optionstring)
+        if m is None:
+            m = re.match('(^[^,"=]*)()$', optionstring)
+        
+        if m is not None:
+            key="__pweave_block_name"
+            val=m.group(1).strip(" \t").strip('"')
+            block_options[key] = val
+            optionstring = m.groups()[-1]
+    
+    while len(optionstring) > 0:
+        m = re.match('([^=,]*)=\s*("[^"]*"|[^,"]*),?(.*)', optionstring)
+        if m is not None:
+            key=m.group(1).strip(" \t").strip('"')
+            val=m.group(2).strip(" \t").strip('"')
+            block_options[key] = val
+            optionstring = m.groups()[-1]
+        else:
+            break
+    
+    return block_options
+
+def legacy_merge_options(codeprocessor, codeblock_options):
+    "CodeProcessor.merge_options() before the defaults were precomputed."
+    opts = {}
+    opts.update(codeprocessor.default_block_options())
+    opts.update(codeblock_options)
+    return opts
+
+def make_headers(n_distinct, n_total, seed=0):
+    "Return *n_total* option strings drawn from *n_distinct* different ones."
+    rnd = random.Random(seed)
+    distinct = []
+    for i in range(n_distinct):
+        distinct.append('chunk%d, echo=False, fig=%s, width="%d cm", '
+                        'caption="Figure %d, generated", results=verbatim'
+                        % (i, rnd.choice(['True', 'False']), i % 20, i))
+    return [rnd.choice(distinct) for i in range(n_total)]
+
+def best_time(function, repeat=3):
+    "Return the best wall time of *repeat* calls of function()."
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+def check_equivalence(headers):
+    for h in set(headers):
+        assert pweave.get_options(h) == legacy_get_options(h), h
+
+if __name__ == "__main__":
+    pweave.settings = pweave.defaultdict(lambda: None)
+    processor = pweave.DefaultProcessor({})
+    
+    print '%8s  %8s  %-16s  %12s  %12s' % ('distinct', 'total', 'operation',
+                                           'legacy [s]', 'current [s]')
+    for n_distinct, n_total in [(300, 10000), (300, 100000), (100000, 100000)]:
+        headers = make_headers(n_distinct, n_total)
+        check_equivalence(headers)
+        
+        def legacy_parse():
+            for h in headers:
+                legacy_get_options(h)
+        def current_parse():
+            # start from an empty memo, as a new pweave process would
+            pweave.parsed_options.clear()
+            for h in headers:
+                pweave.get_options(h)
+        print '%8d  %8d  %-16s  %12.4f  %12.4f' % (n_distinct, n_total,
+                'get_options', best_time(legacy_parse),
+                best_time(current_parse))
+        
+        parsed = [pweave.get_options(h) for h in headers]
+        def legacy_merge():
+            for o in parsed:
+                legacy_merge_options(processor, o)
+        def current_merge():
+            for o in parsed:
+                processor.merge_options(o)
+        print '%8d  %8d  %-16s  %12.4f  %12.4f' % (n_distinct, n_total,
+                'merge_options', best_time(legacy_merge),
+                best_time(current_merge))
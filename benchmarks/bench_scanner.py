@@ -0,0 +1,84 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of the code-block scanner used by pweave's preprocess().
+
+Compares iter_chunks() with the line-by-line scanning loop that preprocess()
+used before it (reproduced below as legacy_scan()), on generated documents
+with many small code-blocks and with a few huge code-blocks.  Times are given
+in seconds; a scanner which scales linearly takes ~10 times longer for each
+10 times larger document.
+
+Run from the repository's top directory:
+
+    python benchmarks/bench_scanner.py
+
+"""
+import os
+import re
+import sys
+import imp
+import time
+
+import generators
+
+pweave_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'pweave.py')
+pweave = imp.load_source('pweave', pweave_path)
+
+
+def legacy_scan(lines):
+    "The scanning loop of preprocess() before iter_chunks() existed."
+    chunks = []
+    state = 'text'
+    block = ''
+    for line in lines:
+        code = re.search('^<<(.*)>>=.*$', line.strip())
+        if code is not None:
+            state = 'code'
+            optionstring = code.group(1)
+            line = ''
+        if line.startswith('@'):
+            chunks.append((optionstring, block))
+            block = ''
+            state = 'text'
+            line = ''
+        if state == 'code':
+            block = block + line
+        if state == 'text':
+            chunks.append(line)
+    return chunks
+
+def new_scan(lines):
+    return list(pweave.iter_chunks(lines))
+
+def many_chunks_document(n_chunks):
+    "Return the lines of a document with *n_chunks* small code-blocks."
+    return generators.tiny_chunks_document(n_chunks).splitlines(True)
+
+def huge_chunks_document(n_lines):
+    "Return the lines of a document with two blocks of *n_lines* lines."
+    return generators.huge_chunks_document(n_lines).splitlines(True)
+
+def best_time(function, arg, repeat=3):
+    "Return the best wall time of *repeat* calls of function(arg)."
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(arg)
+        times.append(time.time() - start)
+    return min(times)
+
+def run(label, generator, sizes):
+    print label
+    print '  %10s  %12s  %12s' % ('size', 'legacy [s]', 'scanner [s]')
+    for size in sizes:
+        lines = generator(size)
+        print '  %10d  %12.4f  %12.4f' % (size, best_time(legacy_scan, lines),
+                                          best_time(new_scan, lines))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    run('many small chunks (size = number of chunks)',
+        many_chunks_document, [1000, 10000, 40000])
+    run('few huge chunks (size = lines per chunk)',
+        huge_chunks_document, [10000, 100000, 200000])
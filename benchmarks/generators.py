@@ -0,0 +1,112 @@
+"""
+Generators of synthetic pweave source documents, for benchmarking.
+
+Each function returns the text of a complete (LaTeX) pweave source file whose
+size is controlled by its arguments.  Together they exercise the scanner, the
+option parser, code execution and each processor in pweave_plugins/.
+
+"""
+
+def tiny_chunks_document(n_chunks):
+    "Return a document with *n_chunks* small code-blocks between text."
+    parts = []
+    for i in range(n_chunks):
+        parts.append('Some text describing chunk %d.\n\n' % i)
+        parts.append('<<chunk%d, echo=False>>=\n' % i)
+        parts.append('x%d = %d\nprint x%d\n' % (i, i, i))
+        parts.append('@\n')
+    return ''.join(parts)
+
+def huge_chunks_document(n_lines, n_chunks=2):
+    "Return a document with *n_chunks* code-blocks of *n_lines* lines each."
+    parts = []
+    for i in range(n_chunks):
+        parts.append('Text before chunk %d.\n' % i)
+        parts.append('<<>>=\n')
+        parts.append('data = []\n')
+        parts.extend(['data.append((%d, %d.5))\n' % (j, j)
+                      for j in range(n_lines)])
+        parts.append('print len(data)\n')
+        parts.append('@\n')
+    return ''.join(parts)
+
+def figure_document(n_figures, processor='default'):
+    """Return a document with *n_figures* matplotlib figures.
+
+    *processor* is 'default' or 'legacydefault' (both using the 'fig'
+    option), or 'mplfig' (the MatplotlibFigureProcessor).
+
+    """
+    if processor == 'mplfig':
+        header = '<<p=mplfig, caption="Figure %d">>=\n'
+    else:
+        header = '<<p=' + processor + ', fig=True, echo=False>>=\n'
+
+    parts = ['<<>>=\nimport numpy\nimport matplotlib.pyplot as plt\n@\n']
+    for i in range(n_figures):
+        parts.append('Figure %d follows.\n' % i)
+        if '%d' in header:
+            parts.append(header % i)
+        else:
+            parts.append(header)
+        parts.append('x = numpy.linspace(0, 10, 500)\n')
+        parts.append('plt.plot(x, numpy.sin(x * %d))\n' % (i + 1))
+        parts.append('plt.hist(numpy.random.RandomState(%d).randn(2000), '
+                     '40)\n' % i)
+        parts.append('@\n')
+    return ''.join(parts)
+
+def table_document(n_tables, n_rows=20, n_columns=5):
+    "Return a document with *n_tables* tables of the TableProcessor."
+    parts = []
+    for i in range(n_tables):
+        parts.append('Table %d follows.\n' % i)
+        parts.append('<<p=table, caption="Table %d", column_labels=labels, '
+                     'row_labels=names>>=\n' % i)
+        parts.append('labels = ["c%%d" %% j for j in range(%d)]\n' % n_columns)
+        parts.append('names = ["r%%d" %% j for j in range(%d)]\n' % n_rows)
+        parts.append('tablerows = [[i * j + %d for j in range(%d)] '
+                     'for i in range(%d)]\n' % (i, n_columns, n_rows))
+        parts.append('@\n')
+    return ''.join(parts)
+
+def autowrap_document(n_chunks, n_fragments=20, n_lines=20):
+    "Return a document with *n_chunks* blocks of the AutoWrapProcessor."
+    fragments = ['word%d' % j for j in range(n_fragments)]
+    half = n_fragments // 2
+    header = '<<p=autowrap, textbf_wrapped="%s", emph_wrapped="%s">>=\n' % (
+                '#'.join(fragments[:half]), '#'.join(fragments[half:]))
+    line = ' '.join(fragments + ['!!word0', 'plain text']) + '\n'
+    parts = []
+    for i in range(n_chunks):
+        parts.append('Paragraph %d.\n' % i)
+        parts.append(header)
+        parts.append(line * n_lines)
+        parts.append('@\n')
+    return ''.join(parts)
+
+def helloworld_document(n_chunks):
+    "Return a document with *n_chunks* blocks of the HelloWorldProcessor."
+    parts = []
+    for i in range(n_chunks):
+        parts.append('Text %d.\n' % i)
+        parts.append('<<p=helloworld, hello_text="Hello %d">>=\n' % i)
+        parts.append('ignored\n')
+        parts.append('@\n')
+    return ''.join(parts)
+
+def namespace_document(n_namespaces, chunks_per_namespace):
+    """Return a document with interleaved chains of code-blocks in
+    *n_namespaces* namespaces, each block using its predecessor's state."""
+    parts = []
+    for i in range(chunks_per_namespace):
+        for n in range(n_namespaces):
+            parts.append('Step %d in namespace %d.\n' % (i, n))
+            parts.append('<<namespace=ns%d, echo=False>>=\n' % n)
+            if i == 0:
+                parts.append('state = [%d]\n' % n)
+            else:
+                parts.append('state.append(sum(state[-3:]) %% 1000 + %d)\n' % i)
+            parts.append('print len(state), state[-1]\n')
+            parts.append('@\n')
+    return ''.join(parts)
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+"""
+Benchmark suite for the pweave pipeline.
+
+Runs pweave on synthetic documents (see generators.py) covering the scanner,
+the option parser, code execution, namespaces and each processor in
+pweave_plugins/, and times a few core functions in isolation.  Every
+benchmark is run in a separate process, whose best wall time, CPU time and
+peak resident set size are recorded.  The results are written to a JSON
+file, so that the results of different commits can be compared:
+
+    python benchmarks/run_benchmarks.py -o before.json
+    (change pweave)
+    python benchmarks/run_benchmarks.py -o after.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+
+Benchmarks may be selected by name (see --list).  Everything runs offline;
+the documents are generated in a temporary directory.
+
+"""
+import os
+import sys
+import imp
+import time
+import json
+import shutil
+import tempfile
+import traceback
+import subprocess
+import cPickle as pickle
+from optparse import OptionParser
+from collections import defaultdict
+
+import generators
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repository_dir = os.path.dirname(benchmark_dir)
+pweave_path = os.path.join(repository_dir, 'pweave.py')
+plugin_dir = os.path.join(repository_dir, 'pweave_plugins')
+
+# name -> (document generator, arguments, arguments with --quick); each
+# document is woven by a pweave process, without the code-block cache (see
+# weave_options()).
+documents = [
+    ('startup', generators.tiny_chunks_document, (0,), (0,)),
+    ('tiny_chunks', generators.tiny_chunks_document, (2000,), (200,)),
+    ('huge_chunks', generators.huge_chunks_document, (20000,), (2000,)),
+    ('figures_default', generators.figure_document, (20,), (3,)),
+    ('figures_legacydefault', generators.figure_document,
+        (20, 'legacydefault'), (3, 'legacydefault')),
+    ('figures_mplfig', generators.figure_document, (20, 'mplfig'),
+        (3, 'mplfig')),
+    ('tables', generators.table_document, (200,), (20,)),
+    ('autowrap', generators.autowrap_document, (200,), (20,)),
+    ('helloworld', generators.helloworld_document, (2000,), (200,)),
+    ('namespaces', generators.namespace_document, (50, 20), (10, 5)),
+]
+
+class Unsupported(Exception):
+    "Raised by benchmarks of functions which the checked-out pweave lacks."
+
+def load_pweave(*names):
+    """Import pweave.py as a module (its plugins cannot be used this way).
+    
+    Raises Unsupported unless the module defines all of *names*.
+    
+    """
+    pweave = imp.load_source('pweave', pweave_path)
+    pweave.settings = defaultdict(lambda: None)
+    missing = [name for name in names if not hasattr(pweave, name)]
+    if missing:
+        raise Unsupported(', '.join(missing))
+    return pweave
+
+def scanner_benchmark(quick):
+    "Time iter_chunks() on documents with many tiny and a few huge blocks."
+    pweave = load_pweave('iter_chunks')
+    scale = 10 if quick else 1
+    lines = (generators.tiny_chunks_document(20000 // scale) +
+             generators.huge_chunks_document(200000 // scale)).splitlines(True)
+    start = time.time()
+    for chunk in pweave.iter_chunks(lines):
+        pass
+    return time.time() - start
+
+def options_benchmark(quick):
+    "Time get_options() on a few hundred distinct, often repeated headers."
+    pweave = load_pweave('get_options')
+    headers = ['block%d, echo=False, fig=True, width="%d cm", caption="A, '
+               'b"' % (i, i % 20) for i in range(300)]
+    repeat = 30 if quick else 300
+    start = time.time()
+    for i in range(repeat):
+        for header in headers:
+            pweave.get_options(header)
+    return time.time() - start
+
+def exec_code_benchmark(quick):
+    "Time DefaultProcessor.exec_code() on many small code-blocks."
+    pweave = load_pweave('DefaultProcessor')
+    processor = pweave.DefaultProcessor({})
+    blocks = ['x%d = %d * 2\nprint x%d\n' % (i, i, i) for i in range(500)]
+    repeat = 2 if quick else 20
+    start = time.time()
+    for i in range(repeat):
+        for block in blocks:
+            processor.exec_code(block)
+    return time.time() - start
+
+# name -> function(quick) returning the time spent in the measured code;
+# each function is called in a forked process.  Benchmarks raising
+# Unsupported are skipped.
+functions = [
+    ('scanner', scanner_benchmark),
+    ('get_options', options_benchmark),
+    ('exec_code', exec_code_benchmark),
+]
+
+def run_forked(function, *args):
+    """Call function(*args) in a forked process.
+
+    Returns the function's (picklable) result, or None if it raised
+    Unsupported, and the resource usage of the process.
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                try:
+                    result = function(*args)
+                except Unsupported:
+                    result = None
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+                os.write(write_fd, data)
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    pid, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError('benchmark %s failed' % function.__name__)
+    return pickle.loads(data), rusage
+
+# options which keep runs of pweave independent of each other, if the
+# checked-out pweave supports them (see weave_options()); commits which
+# have these options used the chunk cache or a running server by default
+isolating_options = ['--no-cache', '--no-server']
+
+def weave_options():
+    """Return the isolating_options which pweave.py accepts.
+    
+    Older commits of pweave reject these options, since they have neither a
+    cache nor a server; results of different commits stay comparable.
+    
+    """
+    process = subprocess.Popen([sys.executable, pweave_path, '--help'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    help_text = process.communicate()[0]
+    return [option for option in isolating_options if option in help_text]
+
+def weave(directory, filename, options):
+    """Weave *filename* in *directory* with a separate pweave process,
+    passing it the command line *options*."""
+    # start from an empty output directory
+    for name in os.listdir(directory):
+        if name != filename:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    log = tempfile.TemporaryFile()
+    start = time.time()
+    process = subprocess.Popen([sys.executable, pweave_path] + options +
+                               ['-p', plugin_dir, filename],
+                               cwd=directory, stdout=log,
+                               stderr=subprocess.STDOUT)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        log.seek(0)
+        raise RuntimeError('pweave failed on %s:\n%s' % (filename, log.read()))
+    return elapsed, rusage
+
+def max_rss_bytes(rusage):
+    "Return the peak resident set size from *rusage* in bytes."
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+def summarize(times, rusages, size=None):
+    "Return the result dictionary of one benchmark."
+    return {
+            'wall': min(times),
+            'walls': times,
+            'cpu': min([r.ru_utime + r.ru_stime for r in rusages]),
+            'max_rss': max([max_rss_bytes(r) for r in rusages]),
+            'size': size,
+           }
+
+def run_benchmarks(names, repeat, quick):
+    "Run the benchmarks *names*, returning a dict of their results."
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='pweave-bench-')
+    options = weave_options()
+    try:
+        for name, generator, args, quick_args in documents:
+            if name not in names:
+                continue
+            text = generator(*(quick_args if quick else args))
+            directory = os.path.join(workdir, name)
+            os.mkdir(directory)
+            filename = name + '.tex_pweave'
+            open(os.path.join(directory, filename), 'w').write(text)
+
+            times, rusages = [], []
+            for i in range(repeat):
+                elapsed, rusage = weave(directory, filename, options)
+                times.append(elapsed)
+                rusages.append(rusage)
+            results[name] = summarize(times, rusages, len(text))
+            report(name, results[name])
+    finally:
+        shutil.rmtree(workdir)
+
+    for name, function in functions:
+        if name not in names:
+            continue
+        times, rusages = [], []
+        for i in range(repeat):
+            elapsed, rusage = run_forked(function, quick)
+            if elapsed is None:
+                break
+            times.append(elapsed)
+            rusages.append(rusage)
+        if not times:
+            print '%-24s (not supported by this commit)' % name
+            continue
+        results[name] = summarize(times, rusages)
+        report(name, results[name])
+
+    return results
+
+def report(name, result):
+    "Print the result of one benchmark."
+    print '%-24s %10.3f %10.3f %10.1f' % (name, result['wall'], result['cpu'],
+                                         result['max_rss'] / 1048576.0)
+    sys.stdout.flush()
+
+def git_commit():
+    "Return the abbreviated hash of the checked-out commit, or None."
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=repository_dir, stdout=subprocess.PIPE,
+                                   stderr=open(os.devnull, 'w'))
+        commit = process.communicate()[0].strip()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return commit
+
+def compare(old_filename, new_filename):
+    "Print the wall time ratios of the benchmarks in two result files."
+    old = json.load(open(old_filename))
+    new = json.load(open(new_filename))
+    print '%-24s %10s %10s %8s' % ('', old['commit'] or old_filename,
+                                   new['commit'] or new_filename, 'ratio')
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            print '%-24s (only in one file)' % name
+            continue
+        old_wall = old['results'][name]['wall']
+        new_wall = new['results'][name]['wall']
+        print '%-24s %10.3f %10.3f %8.2f' % (name, old_wall, new_wall,
+                                             new_wall / max(old_wall, 1e-9))
+    if old['quick'] != new['quick']:
+        print 'WARNING: only one of the files was produced with --quick'
+
+if __name__ == "__main__":
+    all_names = [d[0] for d in documents] + [f[0] for f in functions]
+
+    parser = OptionParser(usage="%prog [options] [benchmark ...]\n"
+                                "       %prog --compare OLD.json NEW.json")
+    parser.add_option("-o", "--output", dest="output", default=None,
+          help="JSON file for the results. Default is "
+               "'benchmarks/results-<commit>.json'.")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+          help="Number of runs of each benchmark; the best time is used. "
+               "Default is 3.")
+    parser.add_option("-q", "--quick", action="store_true", dest="quick",
+          default=False,
+          help="Use documents about ten times smaller than the default.")
+    parser.add_option("-l", "--list", action="store_true", dest="list",
+          default=False, help="List the benchmarks and exit.")
+    parser.add_option("-c", "--compare", action="store_true", dest="compare",
+          default=False,
+          help="Compare the results in two JSON files instead of running "
+               "benchmarks.")
+    options, args = parser.parse_args()
+
+    if options.list:
+        print '\n'.join(all_names)
+        sys.exit()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        compare(args[0], args[1])
+        sys.exit()
+
+    unknown = [name for name in args if name not in all_names]
+    if unknown:
+        parser.error("unknown benchmarks: " + ', '.join(unknown))
+    names = args or all_names
+
+    commit = git_commit()
+    output = options.output
+    if output is None:
+        output = os.path.join(benchmark_dir,
+                              'results-%s.json' % (commit or 'unknown'))
+
+    print '%-24s %10s %10s %10s' % ('Benchmark', 'Wall [s]', 'CPU [s]',
+                                    'RSS [MB]')
+    results = run_benchmarks(names, max(1, options.repeat), options.quick)
+
+    data = {
+            'commit': commit,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'quick': options.quick,
+            'repeat': options.repeat,
+            'results': results,
+           }
+    f = open(output, 'w')
+    json.dump(data, f, indent=1, sort_keys=True)
+    f.close()
+    print 'Results written to', output
@@ -24,17 +24,852 @@ import StringIO
 import re
 from optparse import OptionParser
 import os
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from collections import defaultdict
+import glob
+import time
+import copy
+import traceback
+import hashlib
+import ast
+import imp
+import marshal
+import multiprocessing
+import threading
+import tempfile
+import filecmp
+import socket
+import signal
+import ctypes
+import ctypes.util
+import resource
+import json
+import cPickle as pickle
+from collections import defaultdict, OrderedDict
+from string import Template
+
+# Parts of pweave are kept in the modules pweave_*.py next to this script.
+# They import this script as the module 'pweave' (also when it is run as
+# __main__), and use its globals when they are called.
+sys.modules['pweave'] = sys.modules[__name__]
+pweave_dir = os.path.dirname(os.path.realpath(__file__))
+if pweave_dir not in sys.path:
+    sys.path.insert(0, pweave_dir)
+
+# the names of these modules (see pweave_source_paths)
+pweave_modules = ['pweave_figures', 'pweave_cache', 'pweave_executors',
+                  'pweave_watch', 'pweave_server']
+
+from pweave_figures import figure_digest, write_figure, render_figure, \
+                           FigureRenderer, figure_renderer
+from pweave_cache import CacheIndex, NameCollector, analyze_code, \
+                         resolve_names, CachedBlock, ChunkCache, make_cache
+from pweave_executors import partition_blocks, process_blocks, \
+                             cache_statistics, process_partition, \
+                             ProcessExecutor, ThreadExecutor, SocketExecutor, \
+                             executors, concurrency_limits, run_in_threads, \
+                             process_partition_request, preprocess_parallel
+from pweave_watch import FileWatcher, watch
+from pweave_server import default_server_socket, server_status_marker, \
+                          code_signature, connect_to_server, run_via_server, \
+                          handle_request, serve
+
+class MatplotlibImportHook(object):
+    """Import hook selecting matplotlib's Agg backend when it is imported.
+    
+    pweave only imports matplotlib once it is needed (see get_pyplot()), but
+    code-blocks may import it (e.g. via pylab) before; as a sys.meta_path
+    entry, this makes sure that the Agg backend is selected first anyway.
+    
+    """
+    def find_module(self, fullname, path=None):
+        if fullname == 'matplotlib':
+            return self
+        return None
+    
+    def load_module(self, fullname):
+        sys.meta_path.remove(self)
+        matplotlib = __import__('matplotlib')
+        matplotlib.use('Agg')
+        return matplotlib
+
+if 'matplotlib' in sys.modules:
+    sys.modules['matplotlib'].use('Agg')
+else:
+    sys.meta_path.insert(0, MatplotlibImportHook())
+
+def get_pyplot():
+    """Return matplotlib.pyplot, importing it if necessary.
+    
+    Importing matplotlib takes much of pweave's startup time, so it is only
+    imported when a figure is processed.
+    
+    """
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+def close_figures():
+    "Close all pyplot figures, if pyplot has been imported."
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+def have_open_figures():
+    "Return whether pyplot has been imported and has open figures."
+    return 'matplotlib.pyplot' in sys.modules and \
+           bool(sys.modules['matplotlib.pyplot'].get_fignums())
 
 # global (and local) dictionary holding (multiple) namespaces for exec()'ed code
 exec_namespaces = {} 
 exec_namespaces["default"] = {} 
 
+class ThreadLocalList(threading.local):
+    "A list-like object whose contents are separate for each thread."
+    def __init__(self):
+        self.items = []
+    
+    def append(self, item):
+        self.items.append(item)
+    
+    def __delitem__(self, index):
+        del self.items[index]
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+
+# absolute paths of the files (e.g. figures) written via
+# CodeProcessor.save_figure() by the current thread since this list was
+# last cleared.
+generated_files = ThreadLocalList()
+
+# absolute paths of the input files declared by the 'inputs' option of the
+# code-blocks processed since this set was last cleared.
+declared_inputs = set()
+
+def file_signature(path):
+    "Return the (size, mtime) of the file *path*, or None if it is missing."
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+def block_inputs(blockoptions):
+    """Return the absolute paths of the files named by a block's 'inputs'.
+    
+    The option's value is a comma-separated list of file names, relative to
+    the current directory (like the paths used by the block's code).
+    
+    """
+    names = blockoptions.get('inputs', '').split(',')
+    return [os.path.abspath(name.strip()) for name in names if name.strip()]
+
+class Profiler(object):
+    """Records the time and memory used by each code-block.
+    
+    process_block() calls start_block() and end_block() around each block;
+    the parts of a block's processing (e.g. 'exec' for executing its code,
+    'savefig' for saving figures) add their time with add().  Times of other
+    parts of a run (e.g. 'assembly' for writing the output files) are added
+    with add() outside of blocks.  If the tracemalloc module is available,
+    the largest memory allocations of each block are recorded as well.
+    
+    Blocks may be recorded by several threads at once (see ThreadExecutor);
+    each thread has its own current block.
+    
+    """
+    def __init__(self):
+        # the records of the finished blocks, in processing order
+        self.blocks = []
+        # component name -> seconds, over the whole run
+        self.totals = defaultdict(float)
+        # the current block's record and start values, for each thread
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tracemalloc = None
+        try:
+            import tracemalloc
+            tracemalloc.start()
+            self.tracemalloc = tracemalloc
+        except (ImportError, AttributeError):
+            pass
+    
+    def start_block(self, label, lines, processor_name):
+        "Start recording a block, identified by *label* and *lines*."
+        self.local.current = {
+                        'label': label,
+                        'first_line': lines[0] if lines else None,
+                        'last_line': lines[1] if lines else None,
+                        'processor': processor_name,
+                        'exec': 0.0,
+                        'savefig': 0.0,
+                        'cached': False,
+                       }
+        if self.tracemalloc is not None:
+            self.local.snapshot = self.tracemalloc.take_snapshot()
+        self.local.start_rss = peak_rss()
+        self.local.start_cpu = sum(os.times()[:2])
+        self.local.start_wall = time.time()
+    
+    def end_block(self, cached=False):
+        "Finish recording the current block."
+        record = self.local.current
+        record['wall'] = time.time() - self.local.start_wall
+        record['cpu'] = sum(os.times()[:2]) - self.local.start_cpu
+        record['peak_rss_delta'] = peak_rss() - self.local.start_rss
+        record['cached'] = cached
+        if self.tracemalloc is not None:
+            differences = self.tracemalloc.take_snapshot().compare_to(
+                                            self.local.snapshot, 'lineno')
+            record['top_allocations'] = [str(d) for d in differences[:3]]
+        self.lock.acquire()
+        try:
+            self.totals['blocks'] += record['wall']
+            self.blocks.append(record)
+        finally:
+            self.lock.release()
+        self.local.current = None
+    
+    def add(self, component, seconds):
+        "Add *seconds* spent in *component*, to the current block if any."
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            current[component] = current.get(component, 0) + seconds
+        self.lock.acquire()
+        try:
+            self.totals[component] += seconds
+        finally:
+            self.lock.release()
+    
+    def report(self, total_time):
+        "Return the text table of the blocks, the most expensive first."
+        lines = ['%10s %10s %10s %10s %10s  %-6s %s' % ('Wall [s]', 'CPU [s]',
+                    'Exec [s]', 'Fig. [s]', 'RSS+ [MB]', 'Cached', 'Block')]
+        for record in sorted(self.blocks, key=lambda r: -r['wall']):
+            lines.append('%10.3f %10.3f %10.3f %10.3f %10.1f  %-6s %s' % (
+                    record['wall'], record['cpu'], record['exec'],
+                    record['savefig'], record['peak_rss_delta'] / 1048576.0,
+                    'yes' if record['cached'] else 'no', record['label']))
+        lines.append('')
+        lines.append('Total:                %10.3f s' % total_time)
+        lines.append('Code-blocks:          %10.3f s' % self.totals['blocks'])
+        lines.append('  saving figures:     %10.3f s' % self.totals['savefig'])
+        lines.append('Waiting for figures:  %10.3f s' %
+                     self.totals['figure_wait'])
+        lines.append('Writing output:       %10.3f s' %
+                     self.totals['assembly'])
+        return '\n'.join(lines)
+    
+    def write_json(self, filename, sourcefile, total_time):
+        "Write the records and totals to *filename* as JSON."
+        data = {
+                'sourcefile': sourcefile,
+                'time': time.time(),
+                'total_wall': total_time,
+                'totals': dict(self.totals),
+                'tracemalloc': self.tracemalloc is not None,
+                'blocks': self.blocks,
+               }
+        f = open(filename, 'w')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+
+def peak_rss():
+    "Return the peak resident set size of this process, in bytes."
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    # kilobytes on Linux
+    return maxrss * 1024
+
+# the Profiler of the current run (see --profile), or None
+profiler = None
+
+class CompiledCodeCache(object):
+    """Cache of the compiled code objects of executed code.
+    
+    Each source string is compiled only once: as an expression if it is one
+    (so that its value can be printed), and otherwise as statements.  Code
+    objects are kept in memory keyed by the SHA-1 hash of their source, and
+    those used since the last load() can be saved to a file with marshal.
+    Since marshal's format depends on the python version, files should only
+    be loaded by the python version which saved them (see file_suffix).
+    
+    """
+    file_suffix = '.code-' + imp.get_magic().encode('hex')
+    
+    def __init__(self):
+        self.code = {} # source hash -> ('eval' or 'exec', code object)
+        self.used = set() # source hashes used since load()
+    
+    def compile(self, source):
+        "Return the ('eval' or 'exec', code object) tuple for *source*."
+        key = hashlib.sha1(source).hexdigest()
+        try:
+            entry = self.code[key]
+        except KeyError:
+            try:
+                # like eval(), ignore leading spaces and tabs of expressions
+                entry = ('eval', compile(source.lstrip(' \t'), '<string>',
+                                         'eval'))
+            except SyntaxError:
+                entry = ('exec', compile(source, '<string>', 'exec'))
+            self.code[key] = entry
+        
+        self.used.add(key)
+        return entry
+    
+    def export_used(self):
+        "Return the used code objects, marshalled to a string."
+        return marshal.dumps(dict((k, self.code[k]) for k in self.used))
+    
+    def import_marshalled(self, data):
+        "Add the code objects from a string returned by export_used()."
+        code = marshal.loads(data)
+        self.code.update(code)
+        self.used.update(code)
+    
+    def load(self, filename):
+        "Add the code objects saved in *filename*, if it can be read."
+        try:
+            self.code.update(marshal.load(open(filename, 'rb')))
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        self.used = set()
+    
+    def save(self, filename):
+        "Save the code objects used since the last load() to *filename*."
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmp_filename, 'wb')
+        f.write(self.export_used())
+        f.close()
+        os.rename(tmp_filename, filename)
+
+compiled_code = CompiledCodeCache()
+
+class CapturingStream(object):
+    """A file-like object standing in for sys.stdout or sys.stderr while
+    output is captured (see OutputCapture).
+    
+    Output written by a thread goes to the buffer of that thread's innermost
+    OutputCapture.  Output of other threads (e.g. threads started by the
+    captured code) goes to the buffer of the most recently entered capture,
+    or to the stream which was replaced if there is none.
+    
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        # the buffers of all threads, in the order of their captures
+        self.active = []
+    
+    def buffers(self):
+        "Return the stack of capturing buffers of the current thread."
+        try:
+            return self.local.buffers
+        except AttributeError:
+            self.local.buffers = []
+            return self.local.buffers
+    
+    def target(self):
+        buffers = self.buffers() or self.active
+        return buffers[-1] if buffers else self.stream
+    
+    def write(self, data):
+        self.target().write(data)
+    
+    def writelines(self, lines):
+        self.target().writelines(lines)
+    
+    def flush(self):
+        self.target().flush()
+    
+    def __getattr__(self, name):
+        # e.g. encoding, softspace, fileno() and isatty()
+        return getattr(self.target(), name)
+    
+    def __setattr__(self, name, value):
+        if name in ('stream', 'local', 'active'):
+            object.__setattr__(self, name, value)
+        else:
+            # e.g. softspace, which the print statement sets
+            setattr(self.target(), name, value)
+
+class OutputCapture(object):
+    """Context manager capturing the output printed in its 'with' block.
+    
+    Captures may be nested and used by several threads at once: output goes
+    to the innermost capture of the thread printing it, and leaving a capture
+    restores whatever was captured (or printed) before.  The output is kept
+    even if the block raises an exception, and is available from getvalue().
+    
+    If *stderr* is true, output to sys.stderr is captured as well (into the
+    same buffer).  If *fd* is true, the output written to the file
+    descriptors of stdout (and stderr) is captured too, e.g. by C extensions
+    or subprocesses; this output is appended after the rest of the output.
+    File descriptors are shared by all threads, so captures with *fd* are
+    serialized, and also capture the native output of other threads.
+    
+    """
+    # the number of captures using sys.stdout and sys.stderr
+    users = {'stdout': 0, 'stderr': 0}
+    lock = threading.RLock()
+    fd_lock = threading.RLock()
+    
+    def __init__(self, stderr=False, fd=False):
+        self.stream_names = ['stdout', 'stderr'] if stderr else ['stdout']
+        self.fd = fd
+        self.buffer = StringIO.StringIO()
+        self.fd_file = None
+        self.saved_fds = []
+    
+    def __enter__(self):
+        if self.fd:
+            self.fd_lock.acquire()
+            self.redirect_fds()
+        self.lock.acquire()
+        try:
+            for name in self.stream_names:
+                stream = getattr(sys, name)
+                if not isinstance(stream, CapturingStream):
+                    stream = CapturingStream(stream)
+                    setattr(sys, name, stream)
+                self.users[name] += 1
+                stream.buffers().append(self.buffer)
+                stream.active.append(self.buffer)
+        finally:
+            self.lock.release()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.lock.acquire()
+        try:
+            for name in self.stream_names:
+                stream = getattr(sys, name)
+                if isinstance(stream, CapturingStream):
+                    buffers = stream.buffers()
+                    if self.buffer in buffers:
+                        buffers.remove(self.buffer)
+                    if self.buffer in stream.active:
+                        stream.active.remove(self.buffer)
+                self.users[name] -= 1
+                if self.users[name] == 0 and isinstance(stream,
+                                                        CapturingStream):
+                    # restore the stream which was replaced
+                    setattr(sys, name, stream.stream)
+        finally:
+            self.lock.release()
+        if self.fd:
+            try:
+                self.restore_fds()
+            finally:
+                self.fd_lock.release()
+        # don't suppress exceptions
+        return False
+    
+    @classmethod
+    def release(cls):
+        """Stop all captures, restoring sys.stdout and sys.stderr.
+        
+        This is for a forked child process, in which the threads which
+        started the captures do not exist.
+        
+        """
+        for name in cls.users:
+            stream = getattr(sys, name)
+            if isinstance(stream, CapturingStream):
+                setattr(sys, name, stream.stream)
+            cls.users[name] = 0
+    
+    def redirect_fds(self):
+        "Redirect the file descriptors of the streams to a temporary file."
+        flush_native_streams()
+        self.fd_file = tempfile.TemporaryFile()
+        for name in self.stream_names:
+            fd = getattr(sys, '__%s__' % name).fileno()
+            self.saved_fds.append((fd, os.dup(fd)))
+            os.dup2(self.fd_file.fileno(), fd)
+    
+    def restore_fds(self):
+        "Undo redirect_fds(), adding the output written to the buffer."
+        flush_native_streams()
+        for fd, saved_fd in reversed(self.saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        del self.saved_fds[:]
+        self.fd_file.seek(0)
+        self.buffer.write(self.fd_file.read())
+        self.fd_file.close()
+        self.fd_file = None
+    
+    def getvalue(self):
+        "Return the output captured so far."
+        return self.buffer.getvalue()
+
+def flush_native_streams():
+    "Flush the Python and C standard output streams."
+    for stream in (sys.__stdout__, sys.__stderr__):
+        try:
+            stream.flush()
+        except (AttributeError, IOError, ValueError):
+            pass
+    try:
+        ctypes.CDLL(None).fflush(None)
+    except (OSError, AttributeError):
+        pass
+
+# the values of --capture, and the OutputCapture arguments for them
+capture_modes = {
+    'stdout': {},
+    'stderr': {'stderr': True},
+    'fd': {'stderr': True, 'fd': True},
+}
+
+def execute_code(code_as_string, namespace, capture='stdout'):
+    """Execute *code_as_string* in the dictionary *namespace*.
+    
+    The value of an expression is printed.  Returns the output printed by the
+    code, captured as given by *capture* (see capture_modes).  If the code
+    raises an exception, its output is printed before the exception is
+    re-raised.
+    
+    """
+    output = OutputCapture(**capture_modes[capture or 'stdout'])
+    try:
+        with output:
+            mode, code = compiled_code.compile(code_as_string)
+            if mode == 'eval':
+                print(eval(code, namespace))
+            else:
+                exec(code, namespace)
+    except:
+        exc_info = sys.exc_info()
+        sys.stdout.write(output.getvalue())
+        raise exc_info[0], exc_info[1], exc_info[2]
+    
+    return output.getvalue()
+
+class ChunkKilled(Exception):
+    """Raised when a code-block's execution had to be stopped.
+    
+    This happens when the block exceeds its time or memory limit (see
+    ExecutionEngine), or when its namespace has been lost that way.
+    
+    """
+
+class RemoteExecutionError(Exception):
+    "Raised for an exception of code executed in an ExecutionEngine worker."
+
+def address_space_size():
+    "Return the size of this process's virtual address space in bytes."
+    try:
+        pages = int(open('/proc/self/statm').read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize()
+
+def namespace_worker(connection):
+    """Serve the requests of an ExecutionEngine received on *connection*.
+    
+    This runs in a forked worker process, holding the namespace of the
+    code executed by it, until the connection is closed.
+    
+    """
+    namespace = {}
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, IOError):
+            break
+        
+        command = request[0]
+        try:
+            if command == 'exec':
+                code_as_string, memlimit, capture = request[1:]
+                if memlimit:
+                    limits = resource.getrlimit(resource.RLIMIT_AS)
+                    limit = address_space_size() + int(memlimit * 1048576)
+                    if limits[1] != resource.RLIM_INFINITY:
+                        limit = min(limit, limits[1])
+                    resource.setrlimit(resource.RLIMIT_AS, (limit, limits[1]))
+                try:
+                    result = execute_code(code_as_string, namespace, capture)
+                finally:
+                    if memlimit:
+                        resource.setrlimit(resource.RLIMIT_AS, limits)
+            elif command == 'get':
+                result = (request[1] in namespace,
+                          namespace.get(request[1]))
+            elif command == 'set':
+                namespace[request[1]] = request[2]
+                result = None
+            elif command == 'contains':
+                result = request[1] in namespace
+            elif command == 'savefig':
+                filename, savefig_kwargs, previous = request[1:]
+                result = write_figure(get_pyplot().gcf(), filename,
+                                      savefig_kwargs, previous)
+            elif command == 'clf':
+                get_pyplot().clf()
+                result = None
+            connection.send(('ok', result))
+        except MemoryError:
+            connection.send(('memory', None))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+
+class RemoteNamespace(object):
+    """A namespace which lives in a worker process of an ExecutionEngine.
+    
+    Supports the dictionary operations which processors use on their
+    execution_namespace (item access, 'in', get() and clear()), and
+    executing code and saving or clearing the current figure in the worker.
+    
+    """
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+    
+    def execute(self, code_as_string, timeout=None, memlimit=None,
+                capture='stdout'):
+        "Execute code in the namespace, returning its output."
+        return self.engine.call(self.name, ('exec', code_as_string, memlimit,
+                                            capture), timeout, memlimit)
+    
+    def save_figure(self, filename, savefig_kwargs, previous=None):
+        "Save the worker's current figure, like write_figure()."
+        return self.engine.call(self.name,
+                                ('savefig', filename, savefig_kwargs,
+                                 previous))
+    
+    def clear_figure(self):
+        "Clear the worker's current figure."
+        self.engine.call(self.name, ('clf',))
+    
+    def __getitem__(self, key):
+        found, value = self.engine.call(self.name, ('get', key))
+        if not found:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self.engine.call(self.name, ('set', key, value))
+    
+    def __contains__(self, key):
+        return self.engine.call(self.name, ('contains', key))
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def clear(self):
+        "Empty the namespace, by stopping its worker process."
+        self.engine.stop(self.name)
+
+class ExecutionEngine(object):
+    """Executes code-blocks in worker processes, one for each namespace.
+    
+    A worker is forked when its namespace is first used, and keeps the
+    namespace (and the matplotlib state of its code) until the end of the
+    run.  Requests may have a *timeout* (in seconds): a worker which does not
+    answer in time is killed.  Code may have a *memlimit* (in megabytes): the
+    worker's address space may then only grow by that much while the code
+    runs, beyond which allocations fail.  Either way, ChunkKilled is raised;
+    after a worker has been killed (or has died), its namespace is lost, and
+    ChunkKilled is raised for all further requests to it.
+    
+    """
+    def __init__(self):
+        # namespace name -> (pid, connection) of its worker
+        self.workers = {}
+        # namespace name -> message, for namespaces which have been lost
+        self.lost = {}
+        # number of ChunkKilled exceptions raised so far
+        self.kills = 0
+        # the process owning the workers
+        self.pid = os.getpid()
+    
+    def check_process(self):
+        """Forget the workers of the parent process, if this process was
+        forked (e.g. as a --jobs worker) after they were started."""
+        if os.getpid() != self.pid:
+            for pid, connection in self.workers.values():
+                connection.close()
+            self.workers.clear()
+            self.lost.clear()
+            self.pid = os.getpid()
+    
+    def start_worker(self, name):
+        "Fork the worker process for the namespace *name*."
+        parent_connection, child_connection = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                parent_connection.close()
+                for other_pid, other_connection in self.workers.values():
+                    other_connection.close()
+                # the output of other threads' captures is theirs
+                OutputCapture.release()
+                try:
+                    # on Linux, die with the pweave process (PR_SET_PDEATHSIG)
+                    ctypes.CDLL(ctypes.util.find_library('c')).prctl(
+                                                        1, signal.SIGKILL)
+                except (OSError, AttributeError, TypeError):
+                    pass
+                namespace_worker(child_connection)
+            finally:
+                os._exit(0)
+        child_connection.close()
+        self.workers[name] = (pid, parent_connection)
+    
+    def kill(self, name, message):
+        "Kill the worker of namespace *name*, and raise ChunkKilled."
+        pid, connection = self.workers.pop(name)
+        connection.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            # already dead
+            pass
+        os.waitpid(pid, 0)
+        self.lost[name] = message
+        self.kills += 1
+        raise ChunkKilled(message)
+    
+    def call(self, name, request, timeout=None, memlimit=None):
+        "Send *request* to the worker of namespace *name*; return the result."
+        self.check_process()
+        if name in self.lost:
+            self.kills += 1
+            raise ChunkKilled("not executed, since namespace '%s' was lost "
+                              "(%s)" % (name, self.lost[name]))
+        if name not in self.workers:
+            self.start_worker(name)
+        pid, connection = self.workers[name]
+        
+        connection.send(request)
+        if timeout and not connection.poll(timeout):
+            self.kill(name, "exceeded the time limit of %g s" % timeout)
+        try:
+            status, result = connection.recv()
+        except (EOFError, IOError):
+            self.kill(name, "the worker process of namespace '%s' died" % name)
+        
+        if status == 'memory':
+            self.kills += 1
+            raise ChunkKilled("exceeded the memory limit of %g MB" %
+                              (memlimit or 0))
+        if status == 'error':
+            raise RemoteExecutionError(result)
+        return result
+    
+    def stop(self, name):
+        "Stop the worker of namespace *name* (if any), forgetting it."
+        self.check_process()
+        self.lost.pop(name, None)
+        if name in self.workers:
+            pid, connection = self.workers.pop(name)
+            # the worker exits when its connection is closed
+            connection.close()
+            os.waitpid(pid, 0)
+    
+    def shutdown(self):
+        "Stop all workers."
+        for name in self.workers.keys():
+            self.stop(name)
+        self.lost.clear()
+
+def execution_limits(codeblock_options):
+    """Return the (timeout, memlimit) of a block, from its options or the
+    settings; each is None if there is no limit."""
+    limits = []
+    for name in ['timeout', 'memlimit']:
+        value = codeblock_options.get(name, settings[name])
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = 0
+        limits.append(value if value > 0 else None)
+    return tuple(limits)
+
+# executes code-blocks in worker processes if isolation is enabled (see
+# --isolate), or None
+execution_engine = None
+
+class CompiledTemplate(object):
+    """A string.Template, compiled into a %-format string.
+    
+    render() substitutes a mapping with a single string formatting
+    operation, instead of scanning the template with a regular expression
+    each time (as Template.substitute() does); the result is the same.
+    
+    """
+    def __init__(self, template_str):
+        self.template_str = template_str
+        self.format = Template.pattern.sub(self.convert,
+                                           template_str.replace('%', '%%'))
+    
+    def convert(self, match):
+        "Return the %-format equivalent of a matched placeholder."
+        if match.group('escaped') is not None:
+            return '$'
+        name = match.group('named') or match.group('braced')
+        if name is None:
+            raise ValueError('Invalid placeholder in template: %r' %
+                             match.group())
+        return '%(' + name + ')s'
+    
+    def render(self, mapping):
+        "Return the template with its placeholders replaced from *mapping*."
+        return self.format % mapping
+
+# template string -> CompiledTemplate
+compiled_templates = {}
+
+def compile_template(template_str):
+    "Return the (cached) CompiledTemplate of *template_str*."
+    if template_str not in compiled_templates:
+        compiled_templates[template_str] = CompiledTemplate(template_str)
+    return compiled_templates[template_str]
+
+def compile_templates(template_strs):
+    """Compile the templates returned by CodeProcessor.template_strs().
+    
+    Returns a dict of the same form, with CompiledTemplate objects in place
+    of the template strings.
+    
+    """
+    templates = {}
+    for name, template in template_strs.iteritems():
+        if isinstance(template, dict):
+            templates[name] = dict((f, compile_template(t))
+                                   for f, t in template.iteritems())
+        else:
+            templates[name] = compile_template(template)
+    return templates
+
 class CodeProcessor(object):
     "Base Class for code-processor classes, used for processing code blocks"
+
+    # names of instance attributes which count things across the document
+    # (e.g. figure numbers).  They are saved with cached block results, so
+    # that replaying a block from the cache leaves them as processing would.
+    # Processors defining counters should also override advance_counters().
+    counter_names = ()
+
+    # the (timeout, memlimit) of the block being processed (see
+    # ExecutionEngine); set by merge_options_and_process()
+    execution_limits = (None, None)
+
+    # the maximum number of blocks of this processor which the thread and
+    # process executors (see --executor) process at once, or None for no
+    # limit; e.g. 1 for a processor using a resource which can't be shared
+    max_concurrency = None
+
     def __init__(self, all_processors):
         """
         *codeblock_options* -- a dictionary containing options specified for
@@ -48,6 +883,9 @@ class CodeProcessor(object):
 
         # dict with name->processor instance mapping
         self.processors = all_processors
+        
+        # the output templates, compiled once (see template_strs())
+        self.templates = compile_templates(self.template_strs())
 
     def name(self):
         "Return a string representing the name of this code-processor"
@@ -58,6 +896,30 @@ class CodeProcessor(object):
         # OVERRIDE THIS METHOD IF YOUR PROCESSOR NEEDS SPECIFIC OPTION DEFAULTS
         return {}
 
+    def template_strs(self):
+        """Return a dictionary of the processor's output templates.
+        
+        The keys are template names, and the values string.Template strings,
+        or dictionaries mapping output formats (see --format) to template
+        strings.  The templates are compiled when the processor is created,
+        and are used with render_template().
+        
+        """
+        # OVERRIDE THIS METHOD IF YOUR PROCESSOR USES OUTPUT TEMPLATES
+        return {}
+
+    def render_template(self, template_name, substitution_vars):
+        """Return the named output template, substituted with the variables.
+        
+        For templates given per output format, the one of the current format
+        is used.
+        
+        """
+        template = self.templates[template_name]
+        if isinstance(template, dict):
+            template = template[self.settings['format']]
+        return template.render(substitution_vars)
+
     def process_foreign(self, processor_name, codeblock, codeblock_options):
         """Process specified codeblock with the named processor and options.
         
@@ -76,14 +938,48 @@ class CodeProcessor(object):
                                                             codeblock,
                                                             codeblock_options)
 
-    def merge_options_and_process(self, codeblock, codeblock_options):
-        "Call self.process_code() after combining options and option-defaults."
+    def merge_options(self, codeblock_options):
+        """Return *codeblock_options* combined with the option-defaults.
+        
+        default_block_options() is only called once per processor instance;
+        the returned dictionary is a new one for every call.
+        
+        """
+        try:
+            defaults = self.option_defaults
+        except AttributeError:
+            defaults = self.option_defaults = self.default_block_options()
         
-        opts = {}
-        opts.update(self.default_block_options())
+        opts = dict(defaults)
         opts.update(codeblock_options)
         
-        return self.process_code(codeblock, opts)
+        return opts
+
+    def merge_options_and_process(self, codeblock, codeblock_options):
+        """Call self.process_code() after combining options and option-defaults.
+        
+        If the block's execution has to be stopped (see ExecutionEngine), the
+        block's output is replaced by an error message (see error_text()).
+        
+        """
+        self.execution_limits = execution_limits(codeblock_options)
+        if execution_engine is None and self.execution_limits != (None, None):
+            print "WARNING: the time and memory limits of code-blocks are " \
+                  "only enforced with --isolate"
+        try:
+            return self.process_code(codeblock,
+                                     self.merge_options(codeblock_options))
+        except ChunkKilled, e:
+            print "WARNING: code-block stopped: %s" % e
+            return (self.error_text("code-block stopped: %s" % e), codeblock)
+    
+    def error_text(self, message):
+        "Return document text which shows the error *message*."
+        message = 'PWEAVE ERROR: ' + message
+        if self.settings['format'] == 'tex':
+            return '\n\\begin{verbatim}\n%s\n\\end{verbatim}\n' % message
+        else:
+            return '\n::\n\n  %s\n\n' % message
 
     def process_code(self, codeblock, codeblock_options):
         """Process a code-block; return text to include in output documents.
@@ -119,21 +1015,124 @@ class CodeProcessor(object):
         """
         # exec_namespaces is a dictionary global to the pweave module.
         if namespace_name not in exec_namespaces:
-            exec_namespaces[namespace_name] = {}
+            if execution_engine is not None:
+                exec_namespaces[namespace_name] = RemoteNamespace(
+                                            execution_engine, namespace_name)
+            else:
+                exec_namespaces[namespace_name] = {}
         
+        self.namespace_name = namespace_name
         self.execution_namespace = exec_namespaces[namespace_name]
 
+    def block_inputs(self, codeblock_options):
+        """Return the absolute paths of the files a block reads.
+        
+        Changes of these files invalidate the block's cached results, and are
+        noticed by --watch.  *codeblock_options* are the block's own (not
+        merged) options; by default, the files named by its 'inputs' option
+        are returned.
+        
+        """
+        # OVERRIDE THIS METHOD IF YOUR PROCESSOR READS FILES NAMED BY OPTIONS
+        return block_inputs(codeblock_options)
+
+    def get_counters(self):
+        "Return a dict with the current values of the counter_names attributes."
+        return dict((k, getattr(self, k)) for k in self.counter_names)
+
+    def set_counters(self, counters):
+        "Restore counter attributes from a dict returned by get_counters()."
+        for k, v in counters.iteritems():
+            setattr(self, k, v)
+
+    def advance_counters(self, codeblock_options):
+        """Update the counters as processing a block with these options would.
+        
+        This is used to number figures etc. as in document order when blocks
+        are processed out of order (e.g. in parallel).  *codeblock_options*
+        are the merged block options.
+        
+        """
+        # OVERRIDE THIS METHOD IF YOUR PROCESSOR DEFINES counter_names
+        pass
+
+    def save_figure(self, filename, **savefig_kwargs):
+        """Save the current matplotlib figure to *filename*.
+        
+        Processors should use this instead of calling plt.savefig() directly,
+        so that the written file is known to the chunk cache, and so that the
+        figure may be rendered in the background (see FigureRenderer).  The
+        file is therefore not necessarily written when this method returns.
+        
+        """
+        start = time.time()
+        if isinstance(getattr(self, 'execution_namespace', None),
+                      RemoteNamespace):
+            # the figure was drawn by the namespace's worker process
+            figure_renderer.record(filename,
+                        self.execution_namespace.save_figure(filename,
+                                savefig_kwargs,
+                                figure_renderer.manifest_entry(filename)))
+        else:
+            figure_renderer.save(get_pyplot().gcf(), filename,
+                                 savefig_kwargs)
+        if profiler is not None:
+            profiler.add('savefig', time.time() - start)
+        generated_files.append(os.path.abspath(filename))
+
+    def write_file(self, filename, text):
+        """Write *text* to the file *filename*.
+        
+        Processors should use this for the files which their output refers to
+        (e.g. a part of a LaTeX document which is included with \\input), so
+        that the file is known to the chunk cache.  The file is only rewritten
+        if its contents change, so that tools such as latexmk do not rebuild
+        because of an untouched file.
+        
+        *text* may also be an iterable of strings, which are written one at a
+        time, so that a large file needn't be held in memory as one string.
+        
+        """
+        if isinstance(text, basestring):
+            text = [text]
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmp_filename, 'wb')
+        for piece in text:
+            f.write(piece)
+        f.close()
+        if os.path.isfile(filename) and \
+           filecmp.cmp(tmp_filename, filename, shallow=False):
+            os.remove(tmp_filename)
+        else:
+            os.rename(tmp_filename, filename)
+        generated_files.append(os.path.abspath(filename))
+
+    def clear_figure(self):
+        """Clear the current matplotlib figure.
+        
+        Processors should use this instead of calling plt.clf() directly,
+        since the figure may have been drawn in another process (see
+        ExecutionEngine).
+        
+        """
+        if isinstance(getattr(self, 'execution_namespace', None),
+                      RemoteNamespace):
+            self.execution_namespace.clear_figure()
+        else:
+            get_pyplot().clf()
+
     def exec_code(self, code_as_string):
         """Execute a block of code it's own (persistent) global namespace.
         
         *code_as_string* is executed as a chunk of python code within a
         namespace separate from that of this module.  The output produced
-        by this code is returned.
+        by this code (see the --capture option) is returned, also if it is
+        executed by another processor's exec_code() called from this code.
+        If the namespace lives in a worker process
+        (see ExecutionEngine), the code is executed there, with the block's
+        execution_limits.
         
         """
-        tmp = StringIO.StringIO()
-        sys.stdout = tmp
-        
         # check to see if namespace has been set for this instance
         try:
             self.execution_namespace
@@ -141,21 +1140,77 @@ class CodeProcessor(object):
             # if not, then use the default namespace
             self.use_named_namespace('default')
         
-        # execute code, capturing stdout to tmp
-        try:
-            print(eval(code_as_string, self.execution_namespace))
-        except:
-            exec(code_as_string, self.execution_namespace)
-        result = tmp.getvalue()
-        
-        # stop capturing and restore normal stdout
-        sys.stdout = sys.__stdout__
-        tmp.close()
+        start = time.time()
+        if isinstance(self.execution_namespace, RemoteNamespace):
+            timeout, memlimit = self.execution_limits
+            result = self.execution_namespace.execute(code_as_string,
+                                        timeout, memlimit,
+                                        self.settings['capture'])
+        else:
+            result = execute_code(code_as_string, self.execution_namespace,
+                                  self.settings['capture'])
+        if profiler is not None:
+            profiler.add('exec', time.time() - start)
         
         return result
 
 
+class FormatProfile(object):
+    """The markup which the DefaultProcessor generates for an output format.
+    
+    *code_start*/*code_end* and *output_start*/*output_end* surround echoed
+    code and verbatim results, whose lines are indented by *code_indent*;
+    *term_start* starts the output of term=True blocks.  *figure* and
+    *image* are the templates including a figure with and without a caption
+    ($figname, $width and $caption are substituted).  If *teximg_format* is
+    set, figures are saved in the format of this setting as well.
+    
+    """
+    def __init__(self, code_start, code_end, output_start, output_end,
+                 code_indent, term_start, figure, image, teximg_format=None):
+        self.code_start = code_start
+        self.code_end = code_end
+        self.output_start = output_start
+        self.output_end = output_end
+        self.code_indent = code_indent
+        self.term_start = term_start
+        self.figure = compile_template(figure)
+        self.image = compile_template(image)
+        self.teximg_format = teximg_format
+
+rst_figure_template = """.. figure:: $figname
+   :width: $width
+
+   $caption
+
+"""
+
+rst_image_template = """.. image:: $figname
+   :width: $width
+
+"""
+
+# output format (see --format) -> FormatProfile; the profile of a run is
+# stored in settings['format_profile'] by weave_document()
+format_profiles = {
+    'tex': FormatProfile('\\begin{verbatim}\n', '\\end{verbatim}\n',
+                         '\\begin{verbatim}\n', '\\end{verbatim}\n',
+                         '', '\n\\begin{verbatim}\n',
+                         '\\begin{figure}\n'
+                         '\\includegraphics{$figname}\n'
+                         '\\caption{$caption}\n'
+                         '\\end{figure}\n',
+                         '\\includegraphics{$figname}\n\n'),
+    'rst': FormatProfile('::\n\n', '\n\n', '::\n\n', '\n\n', '  ', '\n',
+                         rst_figure_template, rst_image_template),
+    'sphinx': FormatProfile('::\n\n', '\n\n', '::\n\n', '\n\n', '  ', '\n',
+                            rst_figure_template, rst_image_template,
+                            'sphinxteximg_format'),
+    }
+
 class DefaultProcessor(CodeProcessor):
+    counter_names = ('nfig',)
+
     def __init__(self, all_processors):
         super(DefaultProcessor, self).__init__(all_processors)
         self.nfig = 1
@@ -178,128 +1233,123 @@ class DefaultProcessor(CodeProcessor):
         
         return option_defaults
 
+    def advance_counters(self, codeblock_options):
+        "Update the counters as processing a block with these options would."
+        if codeblock_options['fig'].lower() == 'true':
+            self.nfig += 1
+
+    def format_profile(self):
+        "Return the FormatProfile of the output format."
+        profile = self.settings['format_profile']
+        if profile is None:
+            profile = format_profiles[self.settings['format']]
+        return profile
+
     def process_code(self, codeblock, codeblock_options):
-        outbuf = StringIO.StringIO() # temporary file obj for storing text
         blockoptions = codeblock_options
-        
-        # Format specific options for tex or rst
-        if self.settings['format'] == 'tex':
-            codestart = '\\begin{verbatim}\n' 
-            codeend = '\\end{verbatim}\n'
-            outputstart = '\\begin{verbatim}\n'
-            outputend = '\\end{verbatim}\n' 
-            codeindent = ''
-        elif self.settings['format'] == 'rst':
-            codestart = '::\n\n' 
-            codeend = '\n\n'
-            outputstart = '::\n\n' 
-            outputend = '\n\n' 
-            codeindent = '  '
-        elif self.settings['format'] == 'sphinx':
-            codestart = '::\n\n' 
-            codeend = '\n\n'
-            outputstart = '::\n\n' 
-            outputend = '\n\n' 
-            codeindent = '  '
+        profile = self.format_profile()
+        codeindent = profile.code_indent
+        parts = [] # the pieces of the document text
         
         #Output in doctests mode
-        #print dtmode
         if blockoptions['term'].lower() == 'true':
-            outbuf.write('\n')
-            if self.settings['format']=="tex": outbuf.write(codestart)
+            parts.append(profile.term_start)
             
             for x in codeblock.splitlines():
-                outbuf.write('>>> ' + x + '\n')
-                result = self.exec_code(x)
-                if len(result) > 0:
-                    outbuf.write(result)
+                parts.append('>>> ' + x + '\n')
+                parts.append(self.exec_code(x))
             
-            outbuf.write(codeend)
+            parts.append(profile.code_end)
         else:
             result = ''
             #include source in output file?
             if blockoptions['echo'].lower() == 'true':
-                outbuf.write(codestart)
-                for x in codeblock.splitlines():
-                    outbuf.write(codeindent + x + '\n')
-                outbuf.write(codeend)
+                parts.append(profile.code_start)
+                parts.extend([codeindent + x + '\n'
+                              for x in codeblock.splitlines()])
+                parts.append(profile.code_end)
 
             #evaluate code and include results in output file?
             if blockoptions['evaluate'].lower() == 'true':
-                if blockoptions['fig'].lower() == 'true':
-                    #A placeholder for figure options
-                    #import matplotlib
-                    #matplotlib.rcParams['figure.figsize'] = (6, 4.5)
-                    pass
-                
                 result = self.exec_code(codeblock).splitlines()
         
             #If we get results they are printed
             if len(result) > 0:
                 indent = codeindent # default indentation
+                verbatim = (blockoptions['results'] == "verbatim")
                 
-                if blockoptions['results'] == "verbatim":
-                    outbuf.write(outputstart)
+                if verbatim:
+                    parts.append(profile.output_start)
                 elif blockoptions['results'] in ['rst', 'tex']:
                     indent = ''
                 
-                for x in result:
-                    outbuf.write(indent + x + '\n')
-                outbuf.write('\n')
+                parts.extend([indent + x + '\n' for x in result])
+                parts.append('\n')
                 
-                if blockoptions['results'] == "verbatim":
-                    outbuf.write(outputend)
+                if verbatim:
+                    parts.append(profile.output_end)
         
         #Save and include a figure?
         if blockoptions['fig'].lower() == 'true':
             figname = os.path.join(self.settings['imgfolder_path'],'Fig' +str(self.nfig) \
                     + self.settings['img_format'])
-            plt.savefig(figname, dpi = 200)
+            self.save_figure(figname, dpi = 200)
             
             #TODO: why can't we just set 'img_format' for sphinx like we do for
             #      tex and rst?
-            if self.settings['format'] == 'sphinx':
+            if profile.teximg_format is not None:
                 figname2_base = os.path.join(self.settings['imgfolder_path'], 'Fig' + str(self.nfig)) 
-                figname2 = figname2_base + self.settings['sphinxteximg_format']
-                figname2_base_rel = \
-                    os.path.relpath(figname2_base, self.settings['base_output_path'])
-                plt.savefig(figname2)
-            plt.clf()
-            if self.settings['format'] == 'rst':
-                if blockoptions['caption']:
-                    #If the image has a caption, use Figure directive
-                    outbuf.write('.. figure:: ' + figname + '\n')
-                    outbuf.write('   :width: ' + blockoptions['width'] + '\n\n')
-                    outbuf.write('   ' + blockoptions['caption'] + '\n\n')
-                else:
-                    outbuf.write('.. image:: ' + figname + '\n')
-                    outbuf.write('   :width: ' + blockoptions['width'] + '\n\n')
-            elif self.settings['format'] == 'sphinx':
-                if blockoptions['caption']:
-                    outbuf.write('.. figure:: ' + figname2_base_rel + '.*\n')
-                    outbuf.write('   :width: ' + blockoptions['width'] + '\n\n')
-                    outbuf.write('   ' + blockoptions['caption'] + '\n\n')
-                else:
-                    outbuf.write('.. image:: ' + figname2_base_rel + '.*\n')
-                    outbuf.write('   :width: ' + blockoptions['width'] + '\n\n')
-            elif self.settings['format'] == 'tex':
-                if blockoptions['caption']:
-                    outbuf.write('\\begin{figure}\n')
-                    outbuf.write('\\includegraphics{'+ figname + '}\n')
-                    outbuf.write('\\caption{' + blockoptions['caption'] + '}\n')
-                    outbuf.write('\\end{figure}\n')
-                else:
-                    outbuf.write('\\includegraphics{'+ figname + '}\n\n')
+                figname2 = figname2_base + self.settings[profile.teximg_format]
+                self.save_figure(figname2)
+                figname = os.path.relpath(figname2_base,
+                                    self.settings['base_output_path']) + '.*'
+            self.clear_figure()
+            
+            substitution_vars = {'figname': figname,
+                                 'width': blockoptions['width'],
+                                 'caption': blockoptions['caption']}
+            if blockoptions['caption']:
+                #If the image has a caption, use a figure
+                parts.append(profile.figure.render(substitution_vars))
+            else:
+                parts.append(profile.image.render(substitution_vars))
 
             self.nfig += 1
         
-        document_text = outbuf.getvalue()
-        outbuf.close()
+        document_text = ''.join(parts)
         
         return (document_text, codeblock) # document_text, code_text
 
-def get_options(optionstring):
-    """Parse option string into dictionary.
+class BlockOptions(dict):
+    """Read-only dictionary of the options parsed from a block-options string.
+    
+    Parsed options are shared by all blocks having the same options string
+    (see get_options()), so modifying them is not allowed.  *unparsed* is the
+    rest of the options string which could not be parsed, if any.
+    
+    """
+    unparsed = None
+    
+    def readonly(self, *args, **kwargs):
+        raise TypeError("block options cannot be modified")
+    
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = \
+            readonly
+    
+    def __reduce__(self):
+        return (BlockOptions, (dict(self),))
+
+# compiled grammar of block-option strings (see parse_options())
+block_name_regex = re.compile('^([^,"=]*),([^=].*)$')
+block_name_only_regex = re.compile('(^[^,"=]*)()$')
+option_pair_regex = re.compile(r'([^=,]*)=\s*("[^"]*"|[^,"]*),?')
+
+# least-recently-used cache of parsed option strings, used by get_options()
+parsed_options = OrderedDict()
+parsed_options_size = 4096
+
+def parse_options(optionstring):
+    """Parse option string into a BlockOptions dictionary.
     
     The string must be in one of the two following forms:
     
@@ -317,7 +1367,9 @@ def get_options(optionstring):
     this -- they may be used, but they will be treated as ordinary characters,
     and do not by themselves allow spaces / commas.
     
-    The dictionary containing the parsed key/value pairs is returned.
+    The dictionary containing the parsed key/value pairs is returned.  If
+    part of the string cannot be parsed, a warning is printed, and the part is
+    stored in the dictionary's *unparsed* attribute.
     
     """
     # use 'default' processor by default
@@ -328,13 +1380,13 @@ def get_options(optionstring):
             # consider this to be a "commented-out" block which is not
             # processed in any way, nor included in any output document.
             block_options['__pweave_do_not_process'] = True
-            return block_options
+            return BlockOptions(block_options)
             
         # match against a first element in the list which isn't an x=y pair
-        m = re.match('^([^,"=]*),([^=].*)$', optionstring)
+        m = block_name_regex.match(optionstring)
         if m is None:
             # try to match assuming there is only a block-name in the string
-            m = re.match('(^[^,"=]*)()$', optionstring)
+            m = block_name_only_regex.match(optionstring)
         
         if m is not None:
             key="__pweave_block_name"
@@ -342,33 +1394,52 @@ def get_options(optionstring):
             block_options[key] = val
             optionstring = m.groups()[-1]
     
-    while len(optionstring) > 0:
-        # match an x=y pair as one group, and whatever follows as another group
-        m = re.match('([^=,]*)=\s*("[^"]*"|[^,"]*),?(.*)', optionstring)
+    unparsed = None
+    pos = 0
+    while pos < len(optionstring):
+        # match an x=y pair, continuing after it on the next iteration
+        m = option_pair_regex.match(optionstring, pos)
         if m is not None:
             key=m.group(1).strip(" \t").strip('"')
             val=m.group(2).strip(" \t").strip('"')
             block_options[key] = val
-            optionstring = m.groups()[-1] # cut out matched front-part...
+            pos = m.end()
         else:
-            print "WARNING: unparseable block-options: ", optionstring
+            unparsed = optionstring[pos:]
+            print "WARNING: unparseable block-options: ", unparsed
             break
     
+    block_options = BlockOptions(block_options)
+    block_options.unparsed = unparsed
     return block_options
 
-def load_processor_plugins(settings):
-    "Import and instantiate all processor plugin-module classes."
-    # TODO: add documentation on how this works / what it does/returns
+def get_options(optionstring):
+    """Return the BlockOptions parsed from *optionstring* by parse_options().
     
-    # dict mapping names to processor class instances
-    # (necessary to initialize prior to instantiating a processor)
-    processors = {} 
-    if settings['use_legacy']:
-        processors = {'legacydefault': DefaultProcessor(processors)}
+    Parse results are memoized, since generated documents often repeat the
+    same option strings many times.  The returned dictionary is therefore
+    shared between calls, and cannot be modified.  Strings which cannot be
+    fully parsed are not memoized, so that each block using one is warned
+    about.
+    
+    """
+    block_options = parsed_options.get(optionstring)
+    if block_options is None:
+        block_options = parse_options(optionstring)
+        if block_options.unparsed is not None:
+            return block_options
+        if len(parsed_options) >= parsed_options_size:
+            parsed_options.popitem(last=False)
     else:
-        processors = {'default': DefaultProcessor(processors)}
+        del parsed_options[optionstring]
+    
+    # (re-)insert as the most recently used entry
+    parsed_options[optionstring] = block_options
+    
+    return block_options
 
-    # add the plugin-directory paths if they're not already in the path
+def plugin_directories(settings):
+    "Return the directories searched for plugins, in order of precedence."
     plugindir_paths = [
                     os.path.join(os.path.abspath('.'), 'pweave_plugins'),
                     os.path.join(os.path.expanduser('~'), '.pweave_plugins')
@@ -377,137 +1448,560 @@ def load_processor_plugins(settings):
     if settings['plugindir'] is not None:
         plugindir_paths.insert(0, os.path.abspath(settings['plugindir']))
     
-    files = []
-    for p in reversed(plugindir_paths):
-        if not p in sys.path:
-            sys.path.insert(0, p)
-        # make list of modules we find in the plugin path
+    return plugindir_paths
+
+def declared_processor_names(filename):
+    """Return the names of the processors defined in a plugin module file.
+    
+    The names are found without importing the module, as the string literals
+    returned by the name() methods of the module's classes.  Returns None if
+    the names cannot be determined this way (e.g. if a name() method computes
+    its result), so that the module has to be imported to find them.
+    
+    """
+    try:
+        tree = ast.parse(open(filename).read(), filename)
+    except (IOError, SyntaxError, TypeError):
+        return None
+    
+    names = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        for item in node.body:
+            if isinstance(item, ast.FunctionDef) and item.name == 'name':
+                returns = [n for n in ast.walk(item)
+                           if isinstance(n, ast.Return)]
+                if len(returns) != 1 or not isinstance(returns[0].value,
+                                                       ast.Str):
+                    return None
+                names.append(returns[0].value.s)
+    return names
+
+# directory of the files in which the processor names declared by plugin
+# modules are cached (see index_plugins())
+plugin_index_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                os.path.join(os.path.expanduser('~'), '.cache'),
+                                'pweave')
+
+def plugin_index_path(directories):
+    "Return the file caching the index of the plugin *directories*."
+    key = hashlib.sha1(repr(list(directories))).hexdigest()
+    return os.path.join(plugin_index_dir, 'plugins-%s.index' % key)
+
+def index_plugins(directories):
+    """Return the plugin modules in *directories*, and their processor names.
+    
+    Returns a list of (module name, processor names) tuples, in order of
+    precedence, where the processor names are None if they are unknown (see
+    declared_processor_names()).  A module name found in several directories
+    refers to the module in the first of them, like an import would.  The
+    names are cached in a file of *plugin_index_dir* which is specific to
+    the list of directories (see plugin_index_path()); a directory is listed
+    again when its modification time changes, and a module is parsed again
+    when its size or modification time changes.
+    
+    """
+    index_path = plugin_index_path(directories)
+    try:
+        cached_index = pickle.load(open(index_path, 'rb'))
+    except (IOError, EOFError, pickle.UnpicklingError):
+        cached_index = {}
+    
+    # directory -> (mtime, {filename: (file_signature, processor names)})
+    index = {}
+    modules = []
+    for directory in directories:
         try:
-            files.extend(os.listdir(p))
-        except:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            continue
+        cached_mtime, cached_files = cached_index.get(directory, (None, {}))
+        if mtime == cached_mtime:
+            filenames = cached_files.keys()
+        else:
+            filenames = [name for name in os.listdir(directory)
+                         if name.lower().endswith('.py')]
+        
+        files = {}
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            signature = file_signature(path)
+            if filename in cached_files and \
+                    cached_files[filename][0] == signature:
+                names = cached_files[filename][1]
+            else:
+                names = declared_processor_names(path)
+            files[filename] = (signature, names)
+            modules.append((filename[:-3], names))
+        index[directory] = (mtime, files)
+    
+    if index != cached_index:
+        # replace the file at once, since other pweave processes may read it
+        tmp_path = '%s.%d' % (index_path, os.getpid())
+        try:
+            if not os.path.isdir(plugin_index_dir):
+                os.makedirs(plugin_index_dir)
+            f = open(tmp_path, 'wb')
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError):
+            # the index only saves time
             pass
     
-    pyfile_regex = re.compile(".*\.py$", re.IGNORECASE) # create regular expression to match strings ending in '.py'
-    pyfiles = filter(pyfile_regex.search, files) # remove files which don't end with '.py'
-    plugins = [filename[:-3] for filename in pyfiles] # strip off '.py' on end of filenames
+    # only the first module of each name can be imported
+    seen = set()
+    unique_modules = []
+    for module_name, names in modules:
+        if module_name not in seen:
+            seen.add(module_name)
+            unique_modules.append((module_name, names))
+    return unique_modules
+
+class ProcessorRegistry(dict):
+    """Dictionary of processor instances, which imports plugins on demand.
+    
+    *modules* is the list of plugin modules returned by index_plugins().  A
+    plugin module is only imported when one of the processors it declares is
+    first looked up (or tested with 'in'); then all of its processor classes
+    are instantiated and added.  Modules whose processor names are unknown
+    are imported when a name is looked up which no known module declares.
+    
+    """
+    def __init__(self, modules):
+        dict.__init__(self)
+        # processor name -> name of the module declaring it
+        self.declared = {}
+        self.unknown_modules = []
+        for module_name, names in modules:
+            if names is None:
+                self.unknown_modules.append(module_name)
+            else:
+                for name in names:
+                    self.declared.setdefault(name, module_name)
+        self.imported_modules = set()
+    
+    def import_plugin(self, module_name):
+        "Import a plugin module, and add instances of its processor classes."
+        if module_name in self.imported_modules:
+            return
+        self.imported_modules.add(module_name)
+        module = __import__(module_name)
+        for value in vars(module).values():
+            if isinstance(value, type) and issubclass(value, CodeProcessor) \
+                    and value.__module__ == module.__name__:
+                # each processor instance gets this registry, so that it is
+                # able to make use of other processors.
+                processor = value(self)
+                name = processor.name()
+                if self.declared.get(name, module_name) == module_name:
+                    self[name] = processor
+    
+    def import_all(self):
+        "Import all plugin modules."
+        for module_name in set(self.declared.values()):
+            self.import_plugin(module_name)
+        for module_name in self.unknown_modules:
+            self.import_plugin(module_name)
+    
+    def __missing__(self, name):
+        if name in self.declared:
+            self.import_plugin(self.declared[name])
+        else:
+            for module_name in self.unknown_modules:
+                self.import_plugin(module_name)
+        if dict.__contains__(self, name):
+            return dict.__getitem__(self, name)
+        raise KeyError(name)
+    
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
     
-    # import the modules which we found in the plugin path
-    plugin_modules = {}
-    for plugin in plugins:
-        temp_module = __import__(plugin)
-        plugin_modules[plugin] = temp_module
+    def has_key(self, name):
+        return name in self
     
-    # create list of plugin class objects which have been loaded
-    loaded_plugin_classes = []
-    for module in plugin_modules.values():
+    def get(self, name, default=None):
         try:
-            # list of classes which are based on CodeProcessor
-            class_list = module.CodeProcessor.__subclasses__() 
-            loaded_plugin_classes.extend(class_list) # append list entries
-        except AttributeError:
-            # CodeProcessor not defined in the module (doesn't have any
-            # CodeProcessor classes)
-            pass
+            return self[name]
+        except KeyError:
+            return default
+
+def load_processor_plugins(settings):
+    """Return a ProcessorRegistry of the built-in and the plugin processors.
     
-    # create instances of each plugin class object,
-    # and store them in the global instance dictionary *processors*
-    for classObject in loaded_plugin_classes:
-        # the processors dict is passed to each processor instance, so that
-        # each processor is able to make use of other processors.
-        classInstance = classObject(processors)
-        cls_name = classInstance.name()
-        processors[cls_name] = classInstance
+    The plugin directories (see plugin_directories()) are added to sys.path,
+    and their modules are indexed, but they are only imported once one of
+    their processors is used.
+    
+    """
+    directories = plugin_directories(settings)
+    # add the plugin-directory paths if they're not already in the path
+    for p in reversed(directories):
+        if not p in sys.path:
+            sys.path.insert(0, p)
+    
+    processors = ProcessorRegistry(index_plugins(directories))
+    
+    # plugins may replace the built-in processors
+    builtin_names = ['default']
+    if settings['use_legacy']:
+        builtin_names.append('legacydefault')
+    for name in builtin_names:
+        if name not in processors.declared:
+            processors[name] = DefaultProcessor(processors)
     
     return processors
 
-def preprocess(input_text, processors):
-    """Preprocesses *input_text* and returns preprocessed document and code text.
+def source_file_path(path):
+    "Return the path of the source file of the module file *path*."
+    path = os.path.abspath(path)
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+def file_hash(path):
+    "Return the SHA-1 hash of the contents of the file *path*, or None."
+    try:
+        return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+    except IOError:
+        return None
+
+# the source files of this module and of pweave_modules; resolved now, since
+# the current directory may change (e.g. in the pweave server)
+pweave_source_paths = [source_file_path(__file__)] + \
+                      [source_file_path(sys.modules[name].__file__)
+                       for name in pweave_modules]
+
+def process_block(codeprocessor, codeblock, blockoptions, label, cache=None,
+                  lines=None):
+    """Process one code-block, and return its (document_text, code_text).
     
-    *input_text* should represent the entire contents of a pweave source file.
-    These contents will be processed according to the directives contained in
-    them, and the text for the resulting output document and python file will
-    be returned as the *doc_output_text* and *code_output_text* strings. 
+    If the block has a 'namespace' option, the processor executes the block
+    in the namespace with that name.  If a ChunkCache instance is given as
+    *cache*, the block is processed through it.  *label* identifies the block
+    in messages, and *lines* is the (first, last) line number of the block
+    in the source file, if known.
     
     """
-    pyfile = StringIO.StringIO()
-    outfile = StringIO.StringIO()
+    previous_namespace = codeprocessor.namespace_name
+    if 'namespace' in blockoptions:
+        codeprocessor.use_named_namespace(blockoptions['namespace'])
     
-    lines = input_text.splitlines(True) # keep carriage-returns
+    if profiler is not None:
+        profiler.start_block(label, lines, codeprocessor.name())
+    hits = cache.hits if cache is not None else 0
+    try:
+        if cache is not None:
+            return cache.process(codeprocessor, codeblock, blockoptions, label)
+        else:
+            return codeprocessor.merge_options_and_process(codeblock,
+                                                           blockoptions)
+    finally:
+        if profiler is not None:
+            profiler.end_block(cache is not None and cache.hits > hits)
+        codeprocessor.use_named_namespace(previous_namespace)
+
+def iter_source_lines(input_file):
+    """Yield the lines of *input_file*, as str.splitlines(True) would split them.
     
-    # Initialize some variables
-    state = 'text'
-    block = ''
+    The file is read lazily, so only one line is held in memory at a time.
     
+    """
+    for line in input_file:
+        # a file only splits lines at '\n', but a lone '\r' also ends a line
+        if '\r' in line[:-1]:
+            for subline in line.splitlines(True):
+                yield subline
+        else:
+            yield line
+
+# matches the first line of a code-block, capturing the block-options string;
+# equivalent to re.search('^<<(.*)>>=.*$', line.strip())
+block_start_regex = re.compile(r'\s*<<(.*)>>=')
+
+# number of lines after which a run of text is split into several tokens,
+# bounding the memory used by iter_chunks() for long runs of text
+text_token_lines = 1000
+
+def iter_chunks(lines):
+    """Split the lines of a pweave source file into text and code-block tokens.
+    
+    Yields (kind, header, body, line_span) tuples, in a single pass over the
+    iterable *lines*:
+    
+    ('text', None, text, line_span) -- a run of text lines (long runs are
+                                       split into several tokens).
+    
+    ('block', optionstring, code, line_span) -- a code-block; *optionstring*
+                                       is the text between '<<' and '>>=' of
+                                       the block's first line.
+    
+    *line_span* is the (first, last) line number of the token, counting from
+    1, where the span of a block includes its '<<...>>=' and '@' lines.  A
+    '<<...>>=' line within a code-block replaces the block's options.  A code-
+    block which is not terminated by an '@' line is dropped with a warning.
+    
+    """
+    match_start = block_start_regex.match
+    
+    text = []
+    text_start = 1
+    code = None # list of the current block's lines, if inside a block
+    
+    lineno = 0
+    for lineno, line in enumerate(lines, 1):
+        # cheap tests first: only a few lines can start or end a block
+        if '<<' in line:
+            m = match_start(line)
+        else:
+            m = None
+        
+        if m is not None:
+            if code is None:
+                if text:
+                    yield ('text', None, ''.join(text), (text_start, lineno-1))
+                    text = []
+                code = []
+                block_start = lineno
+            optionstring = m.group(1)
+        elif code is not None:
+            if line[:1] == '@':
+                yield ('block', optionstring, ''.join(code),
+                       (block_start, lineno))
+                code = None
+                text_start = lineno + 1
+            else:
+                code.append(line)
+        else:
+            if not text:
+                text_start = lineno
+            text.append(line)
+            if len(text) >= text_token_lines:
+                yield ('text', None, ''.join(text), (text_start, lineno))
+                text = []
+    
+    if text:
+        yield ('text', None, ''.join(text), (text_start, lineno))
+    if code is not None:
+        print "WARNING: code-block starting at line %d is not terminated " \
+              "by '@'; ignoring it." % block_start
+
+def iter_preprocess(lines, processors, cache=None, deferred_blocks=None):
+    """Preprocess the source *lines*, yielding the resulting text fragments.
+    
+    *lines* may be any iterable of the lines of a pweave source file (e.g.
+    the one returned by iter_source_lines()).  A (document_text, code_text)
+    tuple is yielded for each run of text (up to text_token_lines lines, see
+    iter_chunks()) and for each processed code-block as soon as it is
+    available, so that output can be written incrementally, and memory use
+    stays bounded by the size of the largest code-block or run of text.
+    
+    If a ChunkCache instance is given as *cache*, code-blocks are processed
+    through it, so that unchanged blocks are replayed from the cache.  If a
+    list is given as *deferred_blocks*, code-blocks are not processed, but are
+    appended to it (see preprocess_parallel()), and the block's index in the
+    list is yielded in place of its document_text and code_text.
+    
+    """
     # Create figure directory if it doesn't exist
     if os.path.isdir(settings['imgfolder_path']) == False:
         os.mkdir(settings['imgfolder_path'])
     
-    # Process the whole text file with a loop
-    for line in lines:
-        code = re.search('^<<(.*)>>=.*$', line.strip())
+    for kind, optionstring, body, (first_line, last_line) in iter_chunks(lines):
+        # text is copied to the output document unchanged
+        if kind == 'text':
+            yield (body, '')
+            continue
         
-        # if at the start of a code block
-        if code is not None:
-            state = 'code'
-            optionstring = code.group(1)
-            line = ''
+        blockoptions = get_options(optionstring)
         
-        # If the codeblock has ended, process it
-        if line.startswith('@'):
-            blockoptions = get_options(optionstring)
+        if blockoptions.has_key('__pweave_do_not_process'):
+            declared_inputs.update(block_inputs(blockoptions))
+            document_text, code_text = ('', '')
+        else:
+            try:
+                processor_name = blockoptions['p']
+                if processor_name not in processors:
+                    print "WARNING: processor '%s' not found; using default instead." % processor_name
+                codeprocessor = processors[processor_name]
+            except:
+                processor_name = 'default'
+                codeprocessor = processors['default']
+            declared_inputs.update(codeprocessor.block_inputs(blockoptions))
             
-            if blockoptions.has_key('__pweave_do_not_process'):
-                document_text, code_text = ('', '')
+            if '__pweave_block_name' in blockoptions:
+                label = "block '%s' (line %d)" % \
+                    (blockoptions['__pweave_block_name'], first_line)
             else:
-                try:
-                    processor_name = blockoptions['p']
-                    if processor_name not in processors:
-                        print "WARNING: processor '%s' not found; using default instead." % processor_name
-                    codeprocessor = processors[processor_name]
-                except:
-                    codeprocessor = processors['default']
-                
-                document_text, code_text = \
-                        codeprocessor.merge_options_and_process(block, blockoptions)
+                label = "block at line %d" % first_line
             
-            pyfile.write(code_text)
-            outfile.write(document_text)
-            block = ''
-            state = 'text'
-            line = ''
-    
-        # If processing a code block, store the block for processing
-        if state == 'code':
-            block = block + line
+            if deferred_blocks is not None:
+                document_text = code_text = len(deferred_blocks)
+                deferred_blocks.append({
+                    'codeprocessor': codeprocessor,
+                    'processor_name': processor_name,
+                    'codeblock': body,
+                    'blockoptions': blockoptions,
+                    'label': label,
+                    'lines': (first_line, last_line),
+                    'namespace': blockoptions.get('namespace',
+                                            codeprocessor.namespace_name),
+                    })
+            else:
+                document_text, code_text = process_block(codeprocessor,
+                                            body, blockoptions, label, cache,
+                                            (first_line, last_line))
+        
+        yield (document_text, code_text)
+
+def iter_fragments(lines, processors, cache=None, jobs=1):
+    """Like iter_preprocess(), but optionally processing blocks in parallel.
+    
+    Unless the executor (see --executor) is 'inline', independent groups of
+    code-blocks are processed by up to *jobs* workers of the executor (see
+    preprocess_parallel()); the default is 'process' if *jobs* is greater
+    than one.  This requires all blocks to be known in advance, so that
+    fragments are only yielded after all blocks have been processed.
+    
+    After the last fragment, this waits until all figures being rendered in
+    the background (see FigureRenderer) have been written.
+    
+    """
+    executor = settings['executor']
+    if executor is None:
+        executor = 'process' if jobs > 1 else 'inline'
+    try:
+        if executor == 'inline':
+            for fragment in iter_preprocess(lines, processors, cache):
+                yield fragment
+        else:
+            deferred_blocks = []
+            fragments = list(iter_preprocess(lines, processors, cache,
+                                             deferred_blocks))
+            if deferred_blocks:
+                results = preprocess_parallel(deferred_blocks, jobs, cache,
+                                              executor)
             
-        # If processing text, copy the line to the output file 
-        if state == 'text':
-            outfile.write(line)
+            for document_text, code_text in fragments:
+                if isinstance(document_text, int):
+                    yield results[document_text]
+                else:
+                    yield (document_text, code_text)
+    except:
+        figure_renderer.cancel()
+        raise
     
-    doc_output = outfile.getvalue() 
-    code_output = pyfile.getvalue()
-    outfile.close()
-    pyfile.close()
+    start = time.time()
+    figure_renderer.finish()
+    if profiler is not None:
+        profiler.add('figure_wait', time.time() - start)
+
+def preprocess(input_text, processors, cache=None, jobs=1):
+    """Preprocesses *input_text* and returns preprocessed document and code text.
+    
+    *input_text* should represent the entire contents of a pweave source file.
+    These contents will be processed according to the directives contained in
+    them, and the text for the resulting output document and python file will
+    be returned as the *doc_output_text* and *code_output_text* strings. 
+    
+    *cache* and *jobs* are as for iter_fragments().
+    
+    """
+    lines = input_text.splitlines(True) # keep carriage-returns
+    
+    doc_pieces = []
+    code_pieces = []
+    for document_text, code_text in iter_fragments(lines, processors, cache,
+                                                   jobs):
+        doc_pieces.append(document_text)
+        code_pieces.append(code_text)
+    
+    doc_output = ''.join(doc_pieces)
+    code_output = ''.join(code_pieces)
     
     return (doc_output, code_output)
 
 def weave_and_tangle(input_filename, doc_output_filename, code_output_filename,
-                        processors):
-    "Process a pweave file, writing the results to the specified output files."
+                        processors, cache=None, jobs=1):
+    """Process a pweave file, writing the results to the specified output files.
+    
+    The input file is read, and the output files are written, incrementally.
+    The output is written to temporary files which replace the output files
+    at the end, so that these are left untouched if processing fails.
     
-    input_text = open(input_filename, 'r').read()
+    """
+    input_file = open(input_filename, 'r')
+    doc_tmp_filename = doc_output_filename + '.pweave_tmp'
+    code_tmp_filename = code_output_filename + '.pweave_tmp'
+    doc_file = open(doc_tmp_filename, 'w')
+    code_file = open(code_tmp_filename, 'w')
     
-    document_text, code_text = preprocess(input_text, processors)
+    try:
+        for document_text, code_text in iter_fragments(
+                iter_source_lines(input_file), processors, cache, jobs):
+            if profiler is not None:
+                start = time.time()
+            doc_file.write(document_text)
+            code_file.write(code_text)
+            if profiler is not None:
+                profiler.add('assembly', time.time() - start)
+    except:
+        doc_file.close()
+        code_file.close()
+        os.remove(doc_tmp_filename)
+        os.remove(code_tmp_filename)
+        raise
     
-    open(doc_output_filename, 'w').write(document_text)
-    open(code_output_filename, 'w').write(code_text)  
+    start = time.time()
+    input_file.close()
+    doc_file.close()
+    code_file.close()
+    os.rename(doc_tmp_filename, doc_output_filename)
+    os.rename(code_tmp_filename, code_output_filename)
+    if profiler is not None:
+        profiler.add('assembly', time.time() - start)
     
     # Done processing the file and saving results; tell the user what has happened
     print 'Output written to', doc_output_filename
     print 'Code extracted to', code_output_filename
+    if cache is not None:
+        cache.finish()
+        print 'Chunk cache: %d hits, %d misses' % (cache.hits, cache.misses)
+        if cache.checkpoints:
+            print 'Checkpoints: %d replayed blocks not re-executed' % \
+                    cache.skipped_by_checkpoint
     
 
 def run_pweave(settings):
+    """Weave and tangle the source file named in *settings*.
+    
+    With --isolate (or a time or memory limit for code-blocks), the code is
+    executed in worker processes of an ExecutionEngine, which are stopped
+    when done.
+    
+    """
+    global execution_engine
+    
+    if settings['isolate'] or settings['timeout'] or settings['memlimit']:
+        execution_engine = ExecutionEngine()
+        exec_namespaces.clear()
+    try:
+        weave_document(settings)
+    finally:
+        if execution_engine is not None:
+            execution_engine.shutdown()
+            execution_engine = None
+            exec_namespaces.clear()
+
+def weave_document(settings):
+    "Weave and tangle the source file named in *settings* (see run_pweave())."
+    global profiler
+    
     processors = load_processor_plugins(settings)
     
     # set the default sourcefile type if none was provided
@@ -529,6 +2023,9 @@ def run_pweave(settings):
         settings['sphinxteximg_format'] = '.pdf'
         ext = '.rst'
     
+    # the markup generated by the DefaultProcessor
+    settings['format_profile'] = format_profiles[settings['format']]
+    
     # Override the default fig format with command line option
     if settings['img_format'] > 0:
         settings['img_format'] = '.' + settings['img_format']
@@ -551,7 +2048,28 @@ def run_pweave(settings):
             # already exists or failed to create
             pass
     
-    weave_and_tangle(infile, outfile_fname, pyfile_fname, processors)
+    cache = make_cache(settings)
+    
+    figure_renderer.jobs = settings['render_jobs']
+    
+    if settings['profile']:
+        profiler = Profiler()
+    else:
+        profiler = None
+    
+    start = time.time()
+    weave_and_tangle(infile, outfile_fname, pyfile_fname, processors, cache,
+                     settings['jobs'])
+    
+    if profiler is not None:
+        total_time = time.time() - start
+        print
+        print profiler.report(total_time)
+        profile_fname = settings['profile_file']
+        if profile_fname is None:
+            profile_fname = basename + '.profile.json'
+        profiler.write_json(profile_fname, infile, total_time)
+        print 'Profile written to', profile_fname
     
 def regularize_paths(settings_dict):
     """
@@ -583,11 +2101,151 @@ def regularize_paths(settings_dict):
     # "../../some/path"
     s['imgfolder_path_relative'] = os.path.relpath(s['imgfolder_path'],
                                                    s['base_output_path'])
+
+def expand_sourcefile_args(args):
+    """Return the list of source files named by command-line arguments.
     
+    Each argument may be a file, a glob pattern, or a directory; a directory
+    stands for all files directly inside it whose names end with '_pweave'
+    (e.g. 'report.tex_pweave').
+    
+    """
+    sourcefiles = []
+    for arg in args:
+        if os.path.isdir(arg):
+            sourcefiles.extend(sorted(os.path.join(arg, fname)
+                                      for fname in os.listdir(arg)
+                                      if fname.endswith('_pweave')))
+        elif os.path.exists(arg) or not glob.has_magic(arg):
+            sourcefiles.append(arg)
+        else:
+            sourcefiles.extend(sorted(glob.glob(arg)))
+    
+    # remove duplicates (e.g. a file matched by two patterns)
+    seen = set()
+    unique_sourcefiles = []
+    for sourcefile in sourcefiles:
+        if os.path.abspath(sourcefile) not in seen:
+            seen.add(os.path.abspath(sourcefile))
+            unique_sourcefiles.append(sourcefile)
+    
+    return unique_sourcefiles
 
-if __name__ == "__main__":
-    # Command line options
-    parser = OptionParser(usage="%prog [options] sourcefile", version="%prog 0.12")
+# settings shared by all files of a batch; see run_batch()
+batch_settings = None
+
+def weave_file(sourcefile):
+    """Weave one source file of a batch, in a worker process of run_batch().
+    
+    The file is processed with its own copy of *batch_settings*, and with
+    processors and namespaces of its own.  Returns a tuple of the file name,
+    the elapsed wall time, and None or the traceback of the error which
+    stopped processing the file.
+    
+    """
+    global settings
+    
+    start = time.time()
+    try:
+        settings = copy.copy(batch_settings)
+        settings['sourcefile_path'] = sourcefile
+        regularize_paths(settings)
+        if settings['imgfolder_path'] in settings['shared_imgfolders']:
+            # a subdirectory named like the output files, since the figure
+            # names of different files are the same
+            name = os.path.basename(os.path.splitext(sourcefile)[0])
+            settings['imgfolder_path'] = os.path.join(
+                                            settings['imgfolder_path'], name)
+            settings['imgfolder_path_relative'] = os.path.join(
+                                    settings['imgfolder_path_relative'], name)
+        run_pweave(settings)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    
+    return (sourcefile, time.time() - start, error)
+
+def run_batch(settings, sourcefiles):
+    """Weave several source files in settings['jobs'] worker processes.
+    
+    The plugins used by the files (and matplotlib, if the files contain
+    figures) are imported once, before the worker processes are forked; each
+    file is processed in a freshly forked worker, so that namespaces,
+    settings and figure counters are not shared between files.  Files whose
+    figures would be saved in the same directory get a subdirectory each
+    (see weave_file()).  A table of the per-file wall times is printed at
+    the end.  Returns the number of files which could not be processed.
+    
+    """
+    global batch_settings
+    
+    # import the plugin modules used by the files (and matplotlib, if they
+    # make figures) here, so that the workers inherit them
+    processor_names = set()
+    figures = False
+    for sourcefile in sourcefiles:
+        input_file = open(sourcefile, 'r')
+        for kind, optionstring, body, lines in iter_chunks(
+                                            iter_source_lines(input_file)):
+            if kind == 'block':
+                blockoptions = get_options(optionstring)
+                processor_names.add(blockoptions.get('p', 'default'))
+                if blockoptions.get('fig', '').lower() == 'true':
+                    figures = True
+        input_file.close()
+    
+    processors = load_processor_plugins(settings)
+    for name in processor_names:
+        # looking a processor up imports its plugin
+        processors.get(name)
+    if figures or 'mplfig' in processor_names:
+        get_pyplot()
+    
+    batch_settings = copy.copy(settings)
+    # the workers of a pool cannot have workers of their own
+    batch_settings['jobs'] = 1
+    
+    imgfolder_counts = defaultdict(int)
+    for sourcefile in sourcefiles:
+        file_settings = copy.copy(settings)
+        file_settings['sourcefile_path'] = sourcefile
+        regularize_paths(file_settings)
+        imgfolder_counts[file_settings['imgfolder_path']] += 1
+    batch_settings['shared_imgfolders'] = set(
+                folder for folder, count in imgfolder_counts.iteritems()
+                if count > 1)
+    
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, settings['jobs']), maxtasksperchild=1)
+    try:
+        results = pool.map(weave_file, sourcefiles, 1)
+    finally:
+        pool.close()
+        pool.join()
+    total_time = time.time() - start
+    
+    failures = 0
+    for sourcefile, elapsed, error in results:
+        if error is not None:
+            failures += 1
+            print '\nError while processing %s:\n%s' % (sourcefile, error)
+    
+    width = max([len(f) for f in sourcefiles] + [len('Source file')])
+    print
+    print '%-*s  %10s  %s' % (width, 'Source file', 'Time [s]', 'Status')
+    for sourcefile, elapsed, error in sorted(results, key=lambda r: -r[1]):
+        status = 'ok' if error is None else 'FAILED'
+        print '%-*s  %10.2f  %s' % (width, sourcefile, elapsed, status)
+    print '%d files processed in %.2f s (%d failed)' % (len(results),
+                                                       total_time, failures)
+    
+    return failures
+    
+
+def build_option_parser():
+    "Return the OptionParser for pweave's command line."
+    parser = OptionParser(usage="%prog [options] sourcefile [sourcefile ...]",
+                          version="%prog 0.12")
     parser.add_option("-f", "--source-format", dest="format", default=None,
           help="Native sourcefile format: 'tex' (default), 'rst' or 'sphinx'")
     
@@ -610,24 +2268,176 @@ if __name__ == "__main__":
     
     parser.add_option("-p", "--plugin-directory", dest="plugindir",
           help="Optional directory containing pweave plugin files.")
-    cmdline_opts, cmdline_args = parser.parse_args()
-    if len(sys.argv)==1:
+    
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+          help="Number of worker processes for executing code-blocks of "
+               "different namespaces (or, with --analyze-dependencies, "
+               "independent groups of code-blocks) in parallel. If several "
+               "source files are given, the files are instead processed in "
+               "parallel. Default is 1.")
+    
+    parser.add_option("--executor", dest="executor", default=None,
+          type="choice", choices=['inline'] + sorted(executors.keys()),
+          help="How code-blocks are processed: 'inline' (one after another), "
+               "or in JOBS workers, 'thread' (threads), 'process' (worker "
+               "processes) or 'socket' (the pweave server, see --serve). "
+               "Default is 'inline', or 'process' with --jobs.")
+
+    parser.add_option("--render-jobs", dest="render_jobs", type="int",
+          default=0,
+          help="Number of background processes in which figures are "
+               "rendered and saved, while the following code-blocks are "
+               "executed. Default is 0 (save figures immediately).")
+
+    parser.add_option("--capture", dest="capture", default="stdout",
+          type="choice", choices=sorted(capture_modes.keys()),
+          help="Output of code-blocks to include in the document: 'stdout' "
+               "(default), 'stderr' (stdout and stderr) or 'fd' (stdout and "
+               "stderr, including output written to their file descriptors, "
+               "e.g. by C extensions).")
+
+    parser.add_option("--isolate", action="store_true", dest="isolate",
+          default=False,
+          help="Execute the code-blocks of each namespace in a separate "
+               "worker process, which is killed if a code-block exceeds its "
+               "time or memory limit.")
+
+    parser.add_option("--timeout", dest="timeout", type="float", default=None,
+          help="Default time limit in seconds for executing a code-block "
+               "(see the 'timeout' block option); implies --isolate.")
+
+    parser.add_option("--memlimit", dest="memlimit", type="float",
+          default=None,
+          help="Default limit in megabytes of the memory a code-block may "
+               "allocate (see the 'memlimit' block option); implies "
+               "--isolate.")
+
+    parser.add_option("--cache", action="store_true", dest="cache",
+          default=False,
+          help="Replay code-blocks which are unchanged since an earlier run "
+               "from the code-block cache, instead of executing them.")
+    
+    parser.add_option("--cache-dir", dest="cache_dir", default=None,
+          help="Directory in which processed code-blocks are cached. Default "
+               "is '.pweave_cache' in the base output directory.")
+    
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+          default=256,
+          help="Maximum size of the code-block cache in megabytes; least "
+               "recently used entries are evicted first. Default is 256.")
+    
+    parser.add_option("--checkpoint", action="store_true", dest="checkpoint",
+          default=False,
+          help="Save the namespace after each executed code-block in the "
+               "cache, so that later runs can resume from it instead of "
+               "re-executing all preceding code-blocks; implies --cache.")
+    
+    parser.add_option("--analyze-dependencies", action="store_true",
+          dest="analyze_dependencies", default=False,
+          help="Determine which names each code-block reads and writes, and "
+               "only re-execute changed code-blocks and the code-blocks "
+               "depending on them (instead of all following code-blocks).")
+    
+    parser.add_option("--explain-rebuild", action="store_true",
+          dest="explain_rebuild", default=False,
+          help="Print why each executed code-block could not be replayed "
+               "from the code-block cache; implies --cache.")
+    
+    parser.add_option("--profile", action="store_true", dest="profile",
+          default=False,
+          help="Print the wall time, CPU time and memory use of each "
+               "code-block, the most expensive first, and write them to a "
+               "JSON file.")
+    
+    parser.add_option("--profile-file", dest="profile_file", default=None,
+          help="JSON file written by --profile. Default is the name of the "
+               "source file with the extension '.profile.json'.")
+    
+    parser.add_option("--watch", action="store_true", dest="watch",
+          default=False,
+          help="Weave the source file again whenever it, a file declared in "
+               "the 'inputs' option of a code-block, or a plugin changes.")
+    
+    parser.add_option("--serve", action="store_true", dest="serve",
+          default=False,
+          help="Run as a server which keeps the plugins (and the modules "
+               "given with --preload) imported, and processes the source "
+               "files of later pweave invocations in forked processes.")
+    
+    parser.add_option("--server-socket", dest="server_socket",
+          default=default_server_socket,
+          help="Unix socket of the pweave server. Default is "
+               "'~/.pweave_server'.")
+    
+    parser.add_option("--preload", dest="preload", default=None,
+          help="Comma-separated list of modules which the server imports "
+               "at startup (e.g. 'numpy,scipy').")
+    
+    parser.add_option("--server", action="store_true", dest="server",
+          default=False,
+          help="Let the pweave server (see --serve) process the source files, "
+               "if one is running with the same version of pweave and of the "
+               "plugins.")
+    
+    return parser
+
+def main(argv, use_server=True):
+    """Run pweave with the command line arguments *argv*.
+    
+    With --server, the arguments are passed on to the pweave server, if one
+    is running (see run_via_server()).  Returns the exit status.
+    
+    """
+    global settings
+    
+    parser = build_option_parser()
+    cmdline_opts, cmdline_args = parser.parse_args(argv)
+    if len(argv) == 0:
         parser.print_help()
-        sys.exit()
+        return 0
     
     # convert options object to a 'settings' dictionary -- default value of
     # unknown keys is None
     settings = defaultdict(lambda: None)
     settings.update(cmdline_opts.__dict__)
     
+    if settings['serve']:
+        return serve(settings)
+    
+    # a watching process is long-lived anyway, and restarts itself
+    if use_server and settings['server'] and not settings['watch']:
+        status = run_via_server(settings['server_socket'], argv)
+        if status is not None:
+            return status
+    
+    # source files may be given as files, glob patterns or directories
+    sourcefiles = expand_sourcefile_args(cmdline_args)
+    if len(sourcefiles) == 0:
+        parser.error("no source files found")
+    
+    if len(sourcefiles) > 1:
+        if settings['watch']:
+            parser.error("--watch takes a single source file")
+        return int(run_batch(settings, sourcefiles) > 0)
+    
     # add information from the arguments (e.g. the specified source-file) to
     # the options dictionary; *only the options dictionary* is passed to other
     # functions/classes.
-    settings['sourcefile_path'] = cmdline_args[0]
+    settings['sourcefile_path'] = sourcefiles[0]
     
     # after all arguments have been added, convert paths in the settings
     # dictionary to absolute paths, and add some relative and base paths.
     regularize_paths(settings)
     
+    if settings['watch']:
+        try:
+            watch(settings)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    
     run_pweave(settings)
+    return 0
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
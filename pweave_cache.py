@@ -0,0 +1,861 @@
+"""
+The on-disk cache of processed code-blocks (see ChunkCache and --cache), and
+the analysis of the names which code-blocks read and write, by which a block
+only depends on the blocks it uses (see --analyze-dependencies).
+
+This module is imported by pweave.py, and uses its globals.
+
+"""
+import os
+import sys
+import ast
+import types
+import hashlib
+import threading
+import cPickle as pickle
+try:
+    # dill can pickle many more kinds of objects (e.g. functions defined in
+    # code-blocks), which makes namespace checkpoints more often usable.
+    import dill as namespace_pickle
+except ImportError:
+    namespace_pickle = pickle
+from collections import defaultdict
+
+import pweave
+
+class CacheIndex(dict):
+    """Maps the entry filenames of a ChunkCache to [size, last-access time].
+    
+    The total size of the entries is kept in *total_size*, so that it needn't
+    be summed up whenever an entry is stored.
+    
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.total_size = 0
+    
+    def __setitem__(self, fname, value):
+        if fname in self:
+            self.total_size -= self[fname][0]
+        dict.__setitem__(self, fname, value)
+        self.total_size += value[0]
+    
+    def __delitem__(self, fname):
+        self.total_size -= self[fname][0]
+        dict.__delitem__(self, fname)
+    
+    def pop(self, fname, *default):
+        if fname in self:
+            self.total_size -= self[fname][0]
+        return dict.pop(self, fname, *default)
+
+# names of builtins through which code can read or write arbitrary names
+namespace_access_functions = ['eval', 'execfile', 'globals', 'locals', 'vars']
+
+class NameCollector(ast.NodeVisitor):
+    """Collect the global names read and written by a python syntax tree.
+    
+    Attribute/subscript assignments count as writing the object's name, and
+    so does calling a method of the object or passing it to a call.  Every
+    (non-local) name that is loaded anywhere counts as read.  Star-imports
+    set *writes_all*, and exec statements or calls to eval() and friends set
+    both *reads_all* and *writes_all*.
+    
+    The analysis only follows names, so it misses state shared otherwise:
+    an object modified through another name bound to it (e.g. 'M = L'
+    followed by 'M.append(1)'), or through a container holding it, and state
+    outside the namespace, such as files or the state of a module changed by
+    a function imported from it (e.g. 'from random import seed').
+    
+    *bindings* are the names which are actually bound (by assignments,
+    imports, function and class definitions etc.), as opposed to mutated.
+    The bodies of functions (and lambdas) are not executed where they are
+    defined, so their free names are collected separately, as
+    *deferred_reads* and *deferred_writes*: they are used whenever the
+    functions are called (see resolve_names()).
+    
+    """
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.bindings = set()
+        self.declared_globals = set()
+        self.deferred_reads = set()
+        self.deferred_writes = set()
+        self.reads_all = False
+        self.writes_all = False
+    
+    def root_name(self, node):
+        "Return the name at the root of an attribute/subscript expression."
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            return node.id
+        return None
+    
+    def bind(self, name):
+        self.writes.add(name)
+        self.bindings.add(name)
+    
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        else:
+            self.bind(node.id)
+    
+    def visit_mutation(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            name = self.root_name(node)
+            if name is not None:
+                self.writes.add(name)
+        self.generic_visit(node)
+    
+    visit_Attribute = visit_mutation
+    visit_Subscript = visit_mutation
+    
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.reads.add(node.target.id)
+        self.generic_visit(node)
+    
+    def visit_Call(self, node):
+        # a call may modify the object a method is called on, and the
+        # objects passed as arguments
+        arguments = node.args + [k.value for k in node.keywords] + \
+                    [n for n in [node.starargs, node.kwargs] if n]
+        if isinstance(node.func, ast.Attribute):
+            arguments.append(node.func)
+        for n in arguments:
+            name = self.root_name(n)
+            if name is not None:
+                self.writes.add(name)
+        
+        if isinstance(node.func, ast.Name) and \
+                node.func.id in namespace_access_functions:
+            self.reads_all = self.writes_all = True
+        self.generic_visit(node)
+    
+    def visit_Exec(self, node):
+        self.reads_all = self.writes_all = True
+        self.generic_visit(node)
+    
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.bind(alias.asname or alias.name.split('.')[0])
+    
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.writes_all = True
+            else:
+                self.bind(alias.asname or alias.name)
+    
+    def visit_scope(self, body, arguments=None, function=True):
+        """Collect the non-local names used inside a function or class body.
+        
+        The names of a function body are deferred until the function is
+        called, while a class body is executed right away (apart from the
+        bodies of its methods).
+        
+        """
+        inner = NameCollector()
+        if arguments is not None:
+            # default values are evaluated where the function is defined
+            for n in arguments.defaults:
+                self.visit(n)
+            for n in arguments.args:
+                inner.visit(n)
+            inner.bindings.update([n for n in [arguments.vararg,
+                                               arguments.kwarg] if n])
+        for child in body:
+            inner.visit(child)
+        
+        local_names = inner.bindings - inner.declared_globals
+        if function:
+            self.deferred_reads.update((inner.reads | inner.deferred_reads)
+                                       - local_names)
+            self.deferred_writes.update((inner.writes | inner.deferred_writes)
+                                        - local_names)
+        else:
+            # names bound in a class body are not visible in its methods
+            self.reads.update(inner.reads - local_names)
+            self.writes.update(inner.writes - local_names)
+            self.deferred_reads.update(inner.deferred_reads)
+            self.deferred_writes.update(inner.deferred_writes)
+        self.reads_all = self.reads_all or inner.reads_all
+        self.writes_all = self.writes_all or inner.writes_all
+    
+    def visit_Global(self, node):
+        self.declared_globals.update(node.names)
+    
+    def visit_FunctionDef(self, node):
+        self.bind(node.name)
+        for n in node.decorator_list:
+            self.visit(n)
+        self.visit_scope(node.body, node.args)
+    
+    def visit_Lambda(self, node):
+        self.visit_scope([node.body], node.args)
+    
+    def visit_ClassDef(self, node):
+        self.bind(node.name)
+        for n in node.decorator_list + node.bases:
+            self.visit(n)
+        self.visit_scope(node.body, function=False)
+
+def analyze_code(codeblock):
+    """Return a NameCollector for *codeblock*, or None if it isn't python code.
+    
+    Blocks which cannot be parsed (e.g. text for a non-executing processor)
+    are considered not to use their namespace at all.
+    
+    """
+    try:
+        tree = ast.parse(codeblock)
+    except (SyntaxError, TypeError, ValueError):
+        return None
+    
+    collector = NameCollector()
+    collector.visit(tree)
+    
+    return collector
+
+def resolve_names(names, deferred):
+    """Return the (reads, writes) of a block, including those of its calls.
+    
+    *names* is the NameCollector of the block, and *deferred* maps names of
+    the block's namespace to the (reads, writes) sets of the functions their
+    values may hold or have been computed with.  The free names of the
+    functions which the block may call (i.e. of the names it reads, and of
+    the functions it defines) are added to the block's own names, using the
+    writers of these names as of the block rather than those at the time
+    the functions were defined.
+    
+    *deferred* is updated with the names the block writes, which may hold
+    (or depend on) these functions from now on.
+    
+    """
+    deferred_reads = set(names.deferred_reads)
+    deferred_writes = set(names.deferred_writes)
+    seen = set()
+    stack = list(names.reads | names.deferred_reads)
+    while stack:
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name in deferred:
+            function_reads, function_writes = deferred[name]
+            deferred_reads.update(function_reads)
+            deferred_writes.update(function_writes)
+            stack.extend(function_reads)
+    
+    reads = names.reads | deferred_reads
+    writes = names.writes | deferred_writes
+    if deferred_reads or deferred_writes:
+        for name in writes:
+            function_reads, function_writes = deferred.setdefault(name,
+                                                            (set(), set()))
+            function_reads.update(deferred_reads)
+            function_writes.update(deferred_writes)
+    
+    return reads, writes
+
+class CachedBlock(object):
+    "Bookkeeping for one code-block processed through a ChunkCache."
+    def __init__(self, position, label, codeprocessor, codeblock,
+                 codeblock_options):
+        self.position = position
+        self.label = label
+        self.codeprocessor = codeprocessor
+        self.codeblock = codeblock
+        self.codeblock_options = codeblock_options
+        self.namespace_name = codeprocessor.namespace_name
+        # processor counters before processing the block
+        self.counters = codeprocessor.get_counters()
+        # list of (upstream CachedBlock, names) pairs; *names* is the set of
+        # names through which this block depends on the upstream block, or
+        # None if they are unknown.
+        self.dependencies = []
+        self.executed = False
+        # True once no block upstream of this one is pending execution (see
+        # ChunkCache.catch_up())
+        self.caught_up = False
+        
+        self.content_key = None # hash of the block apart from its upstream
+        self.key = None         # cache key, including dependencies' keys
+        self.state_key = None   # hash of all blocks of the namespace so far
+
+class ChunkCache(object):
+    """On-disk cache of the results of processed code-blocks.
+    
+    A block's cache key is built from the processor name, the merged block
+    options, the block text, the processor's counters (see
+    CodeProcessor.counter_names), the output-related settings, the source of
+    the processor's code (see code_fingerprint()), and the keys of the
+    upstream blocks the block depends on.  Each entry stores the
+    (document_text, code_text) tuple returned by merge_options_and_process(),
+    the contents of any files written through CodeProcessor.save_figure(), and
+    the processor's counters after the block.
+    
+    By default a block depends on the preceding block which shares its
+    namespace, and therefore (transitively) on all of them.  If
+    *analyze_dependencies* is true, the names each block reads and writes are
+    determined with the ast module instead, and a block only depends on the
+    upstream blocks which write names that it reads.
+    
+    A block found in the cache is replayed instead of executed.  Since a
+    replayed block does not change its namespace, the replayed blocks of a
+    namespace are remembered, and those which a block depends on are
+    re-executed (discarding their output) before that block is executed.
+    
+    If *checkpoints* is true, the namespace of each executed block is also
+    saved to the cache (see save_checkpoint()).  Re-executing replayed blocks
+    then starts from the checkpoint of the latest replayed block which could
+    be restored, instead of from the first replayed block.
+    
+    If *explain* is true, the reason for executing each block is printed.
+    
+    Entries are evicted in least-recently-used order once the total size of
+    the cache directory exceeds *max_size* bytes.
+    
+    """
+    # increment whenever the format of keys or entries changes
+    version = 4
+    
+    def __init__(self, cache_dir, max_size, settings, checkpoints=False,
+                 analyze_dependencies=False, explain=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.settings = settings
+        self.checkpoints = checkpoints
+        self.analyze_dependencies = analyze_dependencies
+        self.explain = explain
+        self.reset()
+        
+        # (key, entry, filenames) of the processed blocks whose figures were
+        # still being rendered; they are stored by finish()
+        self.unstored_entries = []
+        
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        
+        # processor class -> hashes of the source files of its code (see
+        # code_fingerprint())
+        self.code_hashes = {}
+        
+        # entry filename -> [size, last-access time]
+        self.index = CacheIndex()
+        # guards the index, for blocks processed by several threads (see
+        # ThreadExecutor)
+        self.lock = threading.RLock()
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('.pickle'):
+                st = os.stat(os.path.join(cache_dir, fname))
+                self.index[fname] = [st.st_size, st.st_mtime]
+        
+        # content keys of the blocks seen when the source file was last
+        # processed, used to explain why a block is executed.
+        source_hash = hashlib.sha1(settings['sourcefile_path']).hexdigest()
+        self.manifest_path = os.path.join(cache_dir, source_hash + '.manifest')
+        try:
+            self.previous_content_keys = \
+                    pickle.load(open(self.manifest_path, 'rb'))
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.previous_content_keys = None
+        
+        # code objects compiled when the source file was last processed
+        compiled_code = pweave.compiled_code
+        self.compiled_code_path = os.path.join(cache_dir, source_hash +
+                                               compiled_code.file_suffix)
+        compiled_code.load(self.compiled_code_path)
+    
+    def reset(self):
+        """Forget all blocks processed so far, and zero the statistics.
+        
+        This allows processing a separate sequence of blocks (e.g. a partition
+        of the document, see process_partition()) with the same cache.
+        
+        """
+        self.hits = 0
+        self.misses = 0
+        # number of replayed blocks whose re-execution a checkpoint made
+        # unnecessary
+        self.skipped_by_checkpoint = 0
+        # number of blocks processed so far, in all namespaces
+        self.block_count = 0
+        # content keys of all blocks processed so far
+        self.content_keys = set()
+        
+        # namespace name -> list of the CachedBlocks processed in it so far
+        self.namespace_blocks = defaultdict(list)
+        # namespace name -> {name: CachedBlocks writing that name}
+        self.namespace_writers = defaultdict(lambda: defaultdict(list))
+        # namespace name -> CachedBlocks whose written names are unknown
+        self.namespace_unknown_writers = defaultdict(list)
+        # namespace name -> {name: free (reads, writes) of the functions it
+        # may hold} (see resolve_names())
+        self.namespace_deferred = defaultdict(dict)
+        # namespace name -> list of replayed, not-yet-executed CachedBlocks
+        self.pending_blocks = defaultdict(list)
+    
+    def settings_fingerprint(self):
+        "Return the settings which influence the text generated for a block."
+        keys = ['format', 'img_format', 'sphinxteximg_format',
+                'imgfolder_path', 'base_output_path', 'capture']
+        return [(k, self.settings[k]) for k in keys]
+    
+    def code_fingerprint(self, codeprocessor):
+        """Return the hashes of the source files of the processor's code.
+        
+        These are pweave.py, its modules (see pweave_modules) and the modules
+        defining the processor's class and its base classes, so that results
+        are not replayed after the code which produced them was edited.
+        
+        """
+        cls = type(codeprocessor)
+        if cls not in self.code_hashes:
+            paths = set(pweave.pweave_source_paths)
+            for base in cls.__mro__:
+                module = sys.modules.get(base.__module__)
+                if getattr(module, '__file__', None) is not None:
+                    paths.add(pweave.source_file_path(module.__file__))
+            self.code_hashes[cls] = sorted(pweave.file_hash(path)
+                                           for path in paths)
+        return self.code_hashes[cls]
+    
+    def content_key(self, cached_block):
+        """Return the hash of a block's processor, options, text and counters.
+        
+        The size and modification time of the block's declared input files
+        are included as well.
+        
+        """
+        codeprocessor = cached_block.codeprocessor
+        opts = codeprocessor.merge_options(cached_block.codeblock_options)
+        inputs = [(path, pweave.file_signature(path))
+                  for path in codeprocessor.block_inputs(
+                                            cached_block.codeblock_options)]
+        key_data = (self.version,
+                    codeprocessor.name(),
+                    sorted(opts.items()),
+                    cached_block.codeblock,
+                    inputs,
+                    sorted(cached_block.counters.items()),
+                    self.settings_fingerprint(),
+                    self.code_fingerprint(codeprocessor))
+        
+        return hashlib.sha1(repr(key_data)).hexdigest()
+    
+    def find_dependencies(self, cached_block):
+        "Return the (CachedBlock, names) pairs *cached_block* depends on."
+        namespace_name = cached_block.namespace_name
+        upstream_blocks = self.namespace_blocks[namespace_name]
+        
+        if not self.analyze_dependencies:
+            return [(b, None) for b in upstream_blocks[-1:]]
+        
+        names = analyze_code(cached_block.codeblock)
+        if names is None:
+            return []
+        
+        reads, writes = resolve_names(names,
+                                      self.namespace_deferred[namespace_name])
+        if names.reads_all:
+            dependencies = [(b, None) for b in upstream_blocks]
+        else:
+            writers = self.namespace_writers[namespace_name]
+            found = {} # upstream position -> (block, names)
+            for name in reads:
+                for b in writers.get(name, []):
+                    found.setdefault(b.position, (b, set()))[1].add(name)
+            for b in self.namespace_unknown_writers[namespace_name]:
+                found[b.position] = (b, None)
+            dependencies = [found[pos] for pos in sorted(found)]
+        
+        # register the names written by this block for downstream blocks
+        if names.writes_all:
+            self.namespace_unknown_writers[namespace_name].append(cached_block)
+        for name in writes:
+            self.namespace_writers[namespace_name][name].append(cached_block)
+        
+        return dependencies
+    
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+    
+    def load(self, key):
+        "Return the cache entry stored under *key*, or None if there is none."
+        fname = key + '.pickle'
+        self.lock.acquire()
+        try:
+            if fname not in self.index:
+                return None
+            try:
+                entry = pickle.load(open(self.entry_path(key), 'rb'))
+            except (IOError, EOFError, pickle.UnpicklingError):
+                self.index.pop(fname)
+                return None
+            
+            # mark the entry as recently used
+            os.utime(self.entry_path(key), None)
+            self.index[fname][1] = os.stat(self.entry_path(key)).st_mtime
+        finally:
+            self.lock.release()
+        
+        return entry
+    
+    def store(self, key, entry):
+        "Write *entry* to the cache under *key*, then enforce the size limit."
+        path = self.entry_path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        f = open(tmp_path, 'wb')
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        
+        self.lock.acquire()
+        try:
+            os.rename(tmp_path, path)
+            st = os.stat(path)
+            self.index[key + '.pickle'] = [st.st_size, st.st_mtime]
+            self.evict()
+        finally:
+            self.lock.release()
+    
+    def evict(self):
+        """Remove least-recently-used entries if the cache exceeds max_size.
+        
+        Entries are removed until the cache is a tenth smaller than max_size,
+        so that the entries needn't be sorted again for each stored block.
+        
+        """
+        if self.index.total_size <= self.max_size:
+            return
+        by_age = sorted(self.index.items(), key=lambda item: item[1][1])
+        for fname, (size, atime) in by_age:
+            if self.index.total_size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except OSError:
+                pass
+            del self.index[fname]
+    
+    def finish(self):
+        "Record the blocks and compiled code of this run, for the next run."
+        for key, entry, filenames in self.unstored_entries:
+            pweave.figure_renderer.wait(filenames)
+            entry['files'] = self.read_files(filenames)
+            self.store(key, entry)
+        del self.unstored_entries[:]
+        
+        f = open(self.manifest_path, 'wb')
+        pickle.dump(self.content_keys, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        pweave.compiled_code.save(self.compiled_code_path)
+    
+    def read_files(self, filenames):
+        "Return a dict mapping output-relative paths to the files' contents."
+        files = {}
+        for fname in filenames:
+            relpath = os.path.relpath(fname, self.settings['base_output_path'])
+            files[relpath] = open(fname, 'rb').read()
+        
+        return files
+    
+    def restore_files(self, files):
+        "Write cached files which are missing or differ from the cached copy."
+        for relpath, data in files.iteritems():
+            fname = os.path.join(self.settings['base_output_path'], relpath)
+            if os.path.isfile(fname) and open(fname, 'rb').read() == data:
+                continue
+            dirname = os.path.dirname(fname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            open(fname, 'wb').write(data)
+    
+    def save_checkpoint(self, namespace_name, key):
+        """Save the namespace *namespace_name* under the state-key *key*.
+        
+        Modules are saved by name and re-imported when the checkpoint is
+        restored; all other values are pickled together (with dill, if it is
+        installed).  If some value cannot be pickled, only the names of the
+        unpicklable values are saved, so that restore_checkpoint() can report
+        why the checkpoint is unusable.
+        
+        pyplot's figures (and its current figure) cannot be saved, so a
+        checkpoint saved while figures are open is never restored.
+        
+        """
+        checkpoint_key = key + '-namespace'
+        if checkpoint_key + '.pickle' in self.index:
+            return
+        
+        modules = {}
+        values = {}
+        for name, value in pweave.exec_namespaces[namespace_name].iteritems():
+            if name == '__builtins__':
+                continue
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+            else:
+                values[name] = value
+        
+        checkpoint = {'modules': modules, 'values': None, 'unpicklable': [],
+                      'open_figures': pweave.have_open_figures()}
+        if checkpoint['open_figures']:
+            self.store(checkpoint_key, checkpoint)
+            return
+        
+        try:
+            checkpoint['values'] = namespace_pickle.dumps(values,
+                                                    pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # pickling arbitrary objects can fail with nearly any exception
+            for name, value in values.iteritems():
+                try:
+                    namespace_pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    checkpoint['unpicklable'].append(name)
+        
+        self.store(checkpoint_key, checkpoint)
+    
+    def restore_checkpoint(self, namespace_name, key, verbose=True):
+        """Restore the namespace *namespace_name* saved under state-key *key*.
+        
+        Returns True if the checkpoint could be restored, otherwise False.  If
+        *verbose* is true, the reason for an unusable checkpoint is printed.
+        
+        """
+        checkpoint = self.load(key + '-namespace')
+        if checkpoint is None:
+            return False
+        if checkpoint['open_figures']:
+            if verbose:
+                print "Checkpoint of namespace '%s' not usable (matplotlib " \
+                      "figures were open); re-executing instead." % \
+                      namespace_name
+            return False
+        if checkpoint['values'] is None:
+            if verbose:
+                print "Checkpoint of namespace '%s' not usable (unpicklable " \
+                      "values: %s); re-executing instead." % \
+                      (namespace_name,
+                       ', '.join(sorted(checkpoint['unpicklable'])))
+            return False
+        
+        try:
+            values = namespace_pickle.loads(checkpoint['values'])
+            for name, module_name in checkpoint['modules'].iteritems():
+                __import__(module_name)
+                values[name] = sys.modules[module_name]
+        except Exception, e:
+            if verbose:
+                print "Checkpoint of namespace '%s' not usable (%s); " \
+                      "re-executing instead." % (namespace_name, e)
+            return False
+        
+        # update in place, since processors keep references to the dict
+        namespace = pweave.exec_namespaces[namespace_name]
+        namespace.clear()
+        namespace.update(values)
+        
+        return True
+    
+    def makes_figure(self, cached_block):
+        "Return whether *cached_block* is a figure block."
+        codeprocessor = cached_block.codeprocessor
+        opts = codeprocessor.merge_options(cached_block.codeblock_options)
+        return codeprocessor.name() == 'mplfig' or \
+               str(opts.get('fig', '')).lower() == 'true'
+    
+    def explain_execution(self, cached_block):
+        "Print why *cached_block* is about to be executed."
+        if self.previous_content_keys is None:
+            reason = "no earlier run is recorded in the cache"
+        elif cached_block.content_key not in self.previous_content_keys:
+            reason = "it changed since the last run"
+        else:
+            rerun = [(b, names) for b, names in cached_block.dependencies
+                        if b.executed]
+            if rerun and not self.analyze_dependencies:
+                reason = "it follows re-run %s in namespace '%s'" % \
+                            (rerun[0][0].label, cached_block.namespace_name)
+            elif rerun:
+                reason = "it depends on " + ', '.join(
+                    "re-run %s (via %s)" % (b.label,
+                        ', '.join(sorted(names)) if names else 'unknown names')
+                    for b, names in rerun)
+            else:
+                reason = "no cached result was found"
+        
+        print "Executing %s: %s" % (cached_block.label, reason)
+    
+    def catch_up(self, cached_block):
+        "Bring the namespace up to date with the blocks *cached_block* needs."
+        namespace_name = cached_block.namespace_name
+        pending = self.pending_blocks.pop(namespace_name, [])
+        if not pending:
+            return
+        
+        # replayed blocks which cached_block depends on, directly or not;
+        # dependencies point upstream, so blocks before the first pending
+        # block cannot lead to pending ones
+        first_pending = pending[0].position
+        needed = set()
+        visited = []
+        stack = [b for b, names in cached_block.dependencies]
+        while stack:
+            b = stack.pop()
+            if b.position >= first_pending and not b.caught_up and \
+                    b.position not in needed:
+                needed.add(b.position)
+                visited.append(b)
+                stack.extend(d for d, names in b.dependencies)
+        
+        # all pending blocks found are executed (or restored) below, and
+        # blocks replayed later can't be upstream of these
+        for b in visited:
+            b.caught_up = True
+        
+        needed_pending = [i for i, b in enumerate(pending)
+                            if b.position in needed]
+        if not needed_pending:
+            self.pending_blocks[namespace_name] = pending
+            return
+        
+        # A checkpoint holds the effects of *all* blocks up to its block, so
+        # it may only be used if no block after it has been executed yet.  It
+        # lacks pyplot's state, so it isn't used if the block executed right
+        # after it makes a figure (which may build on that state) either.
+        if self.checkpoints:
+            executed = [b.position
+                        for b in self.namespace_blocks[namespace_name]
+                        if b.executed and b is not cached_block]
+            last_executed = max(executed or [-1])
+            # only the most recent checkpoint's problems are worth reporting
+            verbose = True
+            for i in reversed(range(needed_pending[-1] + 1)):
+                if pending[i].position < last_executed:
+                    break
+                following = [pending[j] for j in needed_pending if j > i]
+                if self.makes_figure((following + [cached_block])[0]):
+                    continue
+                if self.restore_checkpoint(namespace_name,
+                                           pending[i].state_key, verbose):
+                    if self.explain:
+                        print "Restored namespace '%s' from the checkpoint " \
+                              "after %s" % (namespace_name, pending[i].label)
+                    self.skipped_by_checkpoint += \
+                            len([j for j in needed_pending if j <= i])
+                    pending = pending[i+1:]
+                    break
+                verbose = False
+        
+        # execute the needed blocks, discarding their output
+        remaining = []
+        for b in pending:
+            if b.position not in needed:
+                remaining.append(b)
+                continue
+            
+            if self.explain:
+                print "Executing %s: it is needed by %s" % (b.label,
+                                                            cached_block.label)
+            current_counters = b.codeprocessor.get_counters()
+            b.codeprocessor.set_counters(b.counters)
+            b.codeprocessor.merge_options_and_process(b.codeblock,
+                                                      b.codeblock_options)
+            b.codeprocessor.set_counters(current_counters)
+            b.executed = True
+            
+            # the namespace only holds the state after all blocks up to b if
+            # no earlier block is still left to execute
+            if self.checkpoints and not remaining:
+                self.save_checkpoint(namespace_name, b.state_key)
+        
+        self.pending_blocks[namespace_name] = remaining
+    
+    def process(self, codeprocessor, codeblock, codeblock_options,
+                label='code-block'):
+        """Replay a block from the cache, or process it and cache the result.
+        
+        *label* is used to identify the block in explanations.  Returns the
+        (document_text, code_text) tuple of the block.
+        
+        """
+        namespace_name = codeprocessor.namespace_name
+        blocks = self.namespace_blocks[namespace_name]
+        
+        cached_block = CachedBlock(self.block_count, label, codeprocessor,
+                                   codeblock, codeblock_options)
+        self.block_count += 1
+        cached_block.content_key = self.content_key(cached_block)
+        cached_block.dependencies = self.find_dependencies(cached_block)
+        cached_block.key = hashlib.sha1(cached_block.content_key + ''.join(
+                    b.key for b, names in cached_block.dependencies)
+                ).hexdigest()
+        previous_state_key = blocks[-1].state_key if blocks else ''
+        cached_block.state_key = hashlib.sha1(previous_state_key +
+                                              cached_block.key).hexdigest()
+        blocks.append(cached_block)
+        self.content_keys.add(cached_block.content_key)
+        
+        entry = self.load(cached_block.key)
+        if entry is not None:
+            self.hits += 1
+            self.restore_files(entry['files'])
+            self.pending_blocks[namespace_name].append(cached_block)
+            codeprocessor.set_counters(entry['counters'])
+            
+            return (entry['document_text'], entry['code_text'])
+        
+        self.misses += 1
+        self.catch_up(cached_block)
+        if self.explain:
+            self.explain_execution(cached_block)
+        
+        del pweave.generated_files[:]
+        engine = pweave.execution_engine
+        kills = engine.kills if engine is not None else 0
+        document_text, code_text = \
+                codeprocessor.merge_options_and_process(codeblock,
+                                                        codeblock_options)
+        cached_block.executed = True
+        if engine is not None and engine.kills > kills:
+            # the block was stopped; execute it again next time
+            return (document_text, code_text)
+        entry = {
+                 'document_text': document_text,
+                 'code_text': code_text,
+                 'counters': codeprocessor.get_counters(),
+                }
+        if pweave.figure_renderer.is_pending(pweave.generated_files):
+            self.unstored_entries.append((cached_block.key, entry,
+                                          list(pweave.generated_files)))
+        else:
+            entry['files'] = self.read_files(pweave.generated_files)
+            self.store(cached_block.key, entry)
+        if self.checkpoints and not self.pending_blocks[namespace_name]:
+            self.save_checkpoint(namespace_name, cached_block.state_key)
+        
+        return (document_text, code_text)
+
+def make_cache(settings):
+    "Return the ChunkCache for *settings*, or None if no cache is used."
+    if not (settings['cache'] or settings['checkpoint'] or
+            settings['explain_rebuild']):
+        return None
+    if settings['cache_dir'] is None:
+        settings['cache_dir'] = os.path.join(settings['base_output_path'],
+                                             '.pweave_cache')
+    checkpoints = settings['checkpoint']
+    if checkpoints and pweave.execution_engine is not None:
+        print "NOTE: --checkpoint is not used when code is executed in " \
+              "worker processes (--isolate)"
+        checkpoints = False
+    return ChunkCache(settings['cache_dir'],
+                      settings['cache_size'] * 1024 * 1024, settings,
+                      checkpoints, settings['analyze_dependencies'],
+                      settings['explain_rebuild'])
@@ -0,0 +1,426 @@
+"""
+Processing code-blocks in parallel (see --jobs and --executor): the blocks
+are partitioned into groups which can be processed independently, and the
+partitions are processed in threads, in forked worker processes, or by the
+pweave server.
+
+This module is imported by pweave.py, and uses its globals.
+
+"""
+import os
+import sys
+import copy
+import threading
+import multiprocessing
+import cPickle as pickle
+from collections import defaultdict
+
+import pweave
+
+def partition_blocks(blocks, analyze_dependencies):
+    """Group code-blocks into partitions which can be processed independently.
+    
+    *blocks* is a list of dicts having (at least) the keys 'namespace' and
+    'codeblock'.  Blocks are partitioned by namespace, and if
+    *analyze_dependencies* is true, further into groups of blocks which do not
+    share any names (see NameCollector); blocks which aren't python code form
+    partitions of their own.  Returns a list of lists of block indices, each
+    in document order.
+    
+    """
+    # union-find forest over block indices
+    parent = range(len(blocks))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    def union(i, j):
+        parent[find(i)] = find(j)
+    
+    namespace_first = {}   # namespace -> index of its first block
+    namespace_blocks = defaultdict(list)
+    writers = defaultdict(lambda: defaultdict(list))
+    unknown_writers = defaultdict(list)
+    deferred = defaultdict(dict) # see resolve_names()
+    
+    for i, block in enumerate(blocks):
+        ns = block['namespace']
+        if not analyze_dependencies:
+            union(i, namespace_first.setdefault(ns, i))
+            continue
+        
+        names = pweave.analyze_code(block['codeblock'])
+        if names is None:
+            continue
+        
+        # a block calling a function depends on the writers of the names the
+        # function uses, too
+        reads, writes = pweave.resolve_names(names, deferred[ns])
+        if names.reads_all:
+            for j in namespace_blocks[ns]:
+                union(i, j)
+        for name in reads:
+            for j in writers[ns][name]:
+                union(i, j)
+        for j in unknown_writers[ns]:
+            union(i, j)
+        
+        if names.writes_all:
+            unknown_writers[ns].append(i)
+        for name in writes:
+            writers[ns][name].append(i)
+        namespace_blocks[ns].append(i)
+    
+    partitions = defaultdict(list)
+    for i in range(len(blocks)):
+        partitions[find(i)].append(i)
+    
+    return sorted(partitions.values())
+
+# code-blocks (and the ChunkCache, if any) to be processed by
+# process_partition() in the worker processes of ProcessExecutor.
+# Worker processes are forked, so they inherit these.
+parallel_blocks = []
+
+parallel_cache = None
+
+# processor name -> semaphore limiting the number of its blocks processed at
+# once (see CodeProcessor.max_concurrency); set up by the executors
+processor_semaphores = {}
+
+def process_blocks(blocks, block_indices, cache=None, copy_processors=False):
+    """Process the blocks *block_indices* of *blocks*, in this order.
+    
+    *blocks* is a list as for preprocess_parallel(), including the processor
+    counters of each block.  If *copy_processors* is true, the blocks are
+    processed by copies of their processors, so that other threads can use
+    the processors at the same time.  Returns a list of (index,
+    document_text, code_text) tuples.
+    
+    """
+    copies = {}
+    results = []
+    for i in block_indices:
+        block = blocks[i]
+        codeprocessor = block['codeprocessor']
+        if copy_processors:
+            if id(codeprocessor) not in copies:
+                copies[id(codeprocessor)] = copy.copy(codeprocessor)
+            codeprocessor = copies[id(codeprocessor)]
+        codeprocessor.set_counters(block['counters'])
+        
+        semaphore = processor_semaphores.get(block['processor_name'])
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            document_text, code_text = \
+                    pweave.process_block(codeprocessor, block['codeblock'],
+                                         block['blockoptions'], block['label'],
+                                         cache, block['lines'])
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+        results.append((i, document_text, code_text))
+    return results
+
+def cache_statistics(cache, code=True):
+    """Return the statistics of *cache* to be merged by preprocess_parallel(),
+    or None if no cache is used.  If *code* is false, the compiled code is
+    not included (it is shared within a process)."""
+    if cache is None:
+        return None
+    return (cache.hits, cache.misses, cache.skipped_by_checkpoint,
+            cache.content_keys,
+            pweave.compiled_code.export_used() if code else None)
+
+def process_partition(block_indices):
+    """Process the code-blocks of one partition in a worker process.
+    
+    Each partition is processed with fresh namespaces and matplotlib state.
+    Returns a list of (index, document_text, code_text) tuples, the cache
+    statistics and compiled code of the partition (or None if no cache is
+    used), and the Profiler records of its blocks (or None if not profiling).
+    
+    """
+    for namespace in pweave.exec_namespaces.itervalues():
+        namespace.clear()
+    pweave.close_figures()
+    
+    cache = parallel_cache
+    if cache is not None:
+        cache.reset()
+    profiler = pweave.profiler
+    if profiler is not None:
+        del profiler.blocks[:]
+    
+    results = process_blocks(parallel_blocks, block_indices, cache)
+    
+    if profiler is not None:
+        profile = profiler.blocks
+    else:
+        profile = None
+    
+    return results, cache_statistics(cache), profile
+
+class ProcessExecutor(object):
+    """Processes partitions of code-blocks in a pool of forked worker
+    processes, each partition with fresh namespaces (see process_partition()).
+    """
+    # whether partitions may share a namespace
+    split_namespaces = True
+    
+    def __init__(self, jobs):
+        self.jobs = jobs
+    
+    def map(self, blocks, partitions, cache):
+        "Process *partitions*, returning the result of each partition."
+        global parallel_blocks, parallel_cache
+        
+        parallel_blocks = blocks
+        parallel_cache = cache
+        for name, limit in concurrency_limits(blocks).iteritems():
+            processor_semaphores[name] = multiprocessing.BoundedSemaphore(limit)
+        pool = multiprocessing.Pool(min(self.jobs, len(partitions)) or 1)
+        try:
+            return pool.map(process_partition, partitions, 1)
+        finally:
+            pool.close()
+            pool.join()
+            parallel_blocks = []
+            parallel_cache = None
+            processor_semaphores.clear()
+
+class ThreadExecutor(object):
+    """Processes partitions of code-blocks in threads of this process.
+    
+    The partitions use this process's namespaces, so each namespace forms a
+    single partition.  Blocks are processed by copies of their processors.
+    Python code only runs in one thread at a time, so this helps processors
+    which wait for I/O (files, databases, subprocesses), not ones which
+    compute; matplotlib's pyplot state is shared by all threads, so blocks
+    drawing figures should not be processed this way.
+    
+    """
+    split_namespaces = False
+    
+    def __init__(self, jobs):
+        self.jobs = jobs
+    
+    def process(self, blocks, block_indices, cache):
+        "Process one partition, in the calling thread."
+        if cache is not None:
+            # separate statistics and block history; shares the index
+            cache = copy.copy(cache)
+            cache.reset()
+        results = process_blocks(blocks, block_indices, cache,
+                                 copy_processors=True)
+        # the profiler records were added to the global profiler directly
+        return results, cache_statistics(cache, code=False), None
+    
+    def map(self, blocks, partitions, cache):
+        "Process *partitions*, returning the result of each partition."
+        for name, limit in concurrency_limits(blocks).iteritems():
+            processor_semaphores[name] = threading.BoundedSemaphore(limit)
+        try:
+            return run_in_threads(self.jobs, self.process,
+                                  [(blocks, partition, cache)
+                                   for partition in partitions])
+        finally:
+            processor_semaphores.clear()
+
+class SocketExecutor(object):
+    """Processes partitions of code-blocks in the pweave server (see --serve).
+    
+    Each partition is sent to the server over its Unix socket, and processed
+    in a process forked from the server, with fresh namespaces and the
+    processors of the server's plugins (see process_partition_request()).
+    Up to *jobs* partitions are processed at once.  The concurrency limits of
+    processors are not applied.
+    
+    """
+    split_namespaces = True
+    
+    def __init__(self, jobs):
+        self.jobs = max(jobs, 1)
+    
+    def process(self, blocks, block_indices):
+        "Let the server process one partition; return its result."
+        settings = pweave.settings
+        connection = pweave.connect_to_server(settings['server_socket'])
+        if connection is None:
+            raise UserWarning("no pweave server is running on %s (start one "
+                              "with --serve)" % settings['server_socket'])
+        try:
+            request = {
+                       'partition': [dict(blocks[i], index=i,
+                                          codeprocessor=None)
+                                     for i in block_indices],
+                       'settings': dict(settings),
+                       'cwd': os.getcwd(),
+                       'environ': dict(os.environ),
+                       'signature': pweave.code_signature(settings),
+                      }
+            request_file = connection.makefile('wb')
+            pickle.dump(request, request_file, pickle.HIGHEST_PROTOCOL)
+            request_file.flush()
+            try:
+                status, result = pickle.load(connection.makefile('rb'))
+            except EOFError:
+                raise UserWarning("the pweave server closed the connection "
+                                  "without a result")
+        finally:
+            connection.close()
+        
+        if status == 'mismatch':
+            raise UserWarning("the pweave server on %s runs another version "
+                              "of pweave.py or of the plugins" %
+                              settings['server_socket'])
+        if status == 'error':
+            raise pweave.RemoteExecutionError(result)
+        results, stats, profile, output = result
+        sys.stdout.write(output)
+        return results, stats, profile
+    
+    def map(self, blocks, partitions, cache):
+        "Process *partitions*, returning the result of each partition."
+        return run_in_threads(self.jobs, self.process,
+                              [(blocks, partition) for partition in partitions])
+
+# --executor name -> class processing partitions of code-blocks for
+# preprocess_parallel(); 'inline' processes blocks serially instead (see
+# iter_fragments())
+executors = {
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+    'socket': SocketExecutor,
+}
+
+def concurrency_limits(blocks):
+    """Return the CodeProcessor.max_concurrency of the processors of *blocks*
+    which have one, by processor name."""
+    limits = {}
+    for block in blocks:
+        limit = block['codeprocessor'].max_concurrency
+        if limit:
+            limits[block['processor_name']] = limit
+    return limits
+
+def run_in_threads(jobs, function, arguments):
+    """Call function(*args) for each tuple in *arguments*, in up to *jobs*
+    threads.  Returns the results, in the order of *arguments*; the first
+    exception raised by a call is re-raised."""
+    results = [None] * len(arguments)
+    errors = []
+    lock = threading.Lock()
+    remaining = list(enumerate(arguments))
+    remaining.reverse()
+    
+    def worker():
+        while not errors:
+            lock.acquire()
+            try:
+                if not remaining:
+                    return
+                i, args = remaining.pop()
+            finally:
+                lock.release()
+            try:
+                results[i] = function(*args)
+            except:
+                errors.append(sys.exc_info())
+    
+    threads = [threading.Thread(target=worker)
+               for i in range(min(jobs, len(arguments)) or 1)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # a timeout keeps the main thread interruptible with Ctrl-C
+        while thread.is_alive():
+            thread.join(0.1)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def process_partition_request(request):
+    """Process the code-block partition of a SocketExecutor *request*, in a
+    process forked from the pweave server.  Returns the partition's result,
+    as process_partition() does, and its printed output."""
+    # the settings and state of pweave.py are replaced, as main() sets them
+    settings = defaultdict(lambda: None, request['settings'])
+    pweave.settings = settings
+    processors = pweave.load_processor_plugins(settings)
+    if settings['isolate'] or settings['timeout'] or settings['memlimit']:
+        pweave.execution_engine = pweave.ExecutionEngine()
+        pweave.exec_namespaces.clear()
+    profiler = pweave.Profiler() if settings['profile'] else None
+    pweave.profiler = profiler
+    pweave.figure_renderer.jobs = 0
+    
+    blocks = {}
+    for block in request['partition']:
+        block['codeprocessor'] = processors[block['processor_name']]
+        blocks[block['index']] = block
+    
+    output = pweave.OutputCapture(stderr=True, fd=True)
+    try:
+        with output:
+            cache = pweave.make_cache(settings)
+            results = process_blocks(blocks, sorted(blocks), cache)
+    finally:
+        if pweave.execution_engine is not None:
+            pweave.execution_engine.shutdown()
+    
+    profile = profiler.blocks if profiler is not None else None
+    return results, cache_statistics(cache), profile, output.getvalue()
+
+def preprocess_parallel(blocks, jobs, cache=None, executor='process'):
+    """Process code-blocks in *jobs* workers of the named *executor*.
+    
+    *blocks* is a list of dicts with the keys 'codeprocessor',
+    'processor_name', 'codeblock', 'blockoptions', 'label' and 'namespace',
+    in document order.  The blocks are partitioned (see partition_blocks()),
+    keeping the blocks of a namespace in order, and the executor processes
+    the partitions (see executors).  Processor counters are advanced here in
+    document order (see CodeProcessor.advance_counters()), so that each
+    worker starts a block with the counters serial processing would have
+    used.  Returns a list with the (document_text, code_text) tuple of each
+    block, in document order.
+    
+    """
+    for block in blocks:
+        codeprocessor = block['codeprocessor']
+        block['counters'] = codeprocessor.get_counters()
+        codeprocessor.advance_counters(
+                codeprocessor.merge_options(block['blockoptions']))
+    
+    executor = executors[executor](jobs)
+    analyze_dependencies = pweave.settings['analyze_dependencies']
+    partitions = partition_blocks(blocks, executor.split_namespaces and
+                                          analyze_dependencies)
+    # start the longest partitions first, for better load balancing
+    partitions.sort(key=len, reverse=True)
+    
+    partition_results = executor.map(blocks, partitions, cache)
+    
+    results = [None] * len(blocks)
+    for partition_result, stats, profile in partition_results:
+        for i, document_text, code_text in partition_result:
+            results[i] = (document_text, code_text)
+        if profile is not None:
+            profiler = pweave.profiler
+            for record in profile:
+                profiler.totals['blocks'] += record['wall']
+                profiler.totals['savefig'] += record['savefig']
+            profiler.blocks.extend(profile)
+        if stats is not None:
+            hits, misses, skipped_by_checkpoint, content_keys, code = stats
+            cache.hits += hits
+            cache.misses += misses
+            cache.skipped_by_checkpoint += skipped_by_checkpoint
+            cache.content_keys.update(content_keys)
+            if code is not None:
+                pweave.compiled_code.import_marshalled(code)
+    
+    return results
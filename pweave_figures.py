@@ -0,0 +1,217 @@
+"""
+Saving matplotlib figures for pweave: figure files are only rewritten when
+their contents change, and may be rendered in background processes (see
+FigureRenderer).
+
+This module is imported by pweave.py, and uses its globals.
+
+"""
+import os
+import re
+import sys
+import hashlib
+import StringIO
+import multiprocessing
+import cPickle as pickle
+from collections import OrderedDict
+
+import pweave
+
+# the creation dates which matplotlib writes into PDF and PostScript files,
+# and which would make every rendering of a figure different
+figure_date_regex = re.compile(r'/CreationDate \(D:[^)]*\)|'
+                               r'%%CreationDate:[^\n]*')
+
+def figure_digest(data):
+    "Return the hash of the figure file contents *data*, ignoring dates."
+    return hashlib.sha1(figure_date_regex.sub('', data)).hexdigest()
+
+def write_figure(figure, filename, savefig_kwargs, previous=None):
+    """Save *figure* to *filename*, unless the file would not change.
+    
+    The figure is rendered in memory, and the file is only written if its
+    current contents differ (apart from creation dates), so that its
+    modification time only changes when the figure does.  *previous* is the
+    (digest, file_signature) recorded when the file was last written, if
+    any; if the file still has that signature, it is not read again.  Returns
+    the (digest, file_signature) of the file.
+    
+    """
+    extension = os.path.splitext(filename)[1]
+    if not extension:
+        # let matplotlib choose the format (and extend the filename)
+        figure.savefig(filename, **savefig_kwargs)
+        return None
+    
+    kwargs = dict(savefig_kwargs)
+    kwargs.setdefault('format', extension[1:])
+    output = StringIO.StringIO()
+    plt = pweave.get_pyplot()
+    if plt.rcParams.get('svg.hashsalt', '') is None:
+        # otherwise the ids in SVG files are random
+        with plt.rc_context({'svg.hashsalt': 'pweave'}):
+            figure.savefig(output, **kwargs)
+    else:
+        figure.savefig(output, **kwargs)
+    data = output.getvalue()
+    digest = figure_digest(data)
+    
+    signature = pweave.file_signature(filename)
+    if previous is not None and previous[1] == signature:
+        old_digest = previous[0]
+    elif signature is not None:
+        old_digest = figure_digest(open(filename, 'rb').read())
+    else:
+        old_digest = None
+    
+    if digest != old_digest:
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        signature = pweave.file_signature(filename)
+    
+    return (digest, signature)
+
+def render_figure(data, filename, savefig_kwargs, previous):
+    "Like write_figure(), but for the pickled matplotlib figure *data*."
+    figure = pickle.loads(data)
+    try:
+        return write_figure(figure, filename, savefig_kwargs, previous)
+    finally:
+        pweave.get_pyplot().close(figure)
+
+class FigureRenderer(object):
+    """Saves matplotlib figures, optionally in background processes.
+    
+    If *jobs* is greater than zero, save() pickles the figure and hands it to
+    a pool of *jobs* worker processes, which render it while the following
+    code-blocks are processed; finish() waits until all figures are written.
+    Figures which cannot be pickled, and figures saved in a daemonic process
+    (such as a worker of preprocess_parallel(), which cannot have a pool of
+    its own), are saved immediately.
+    
+    Figure files are only written if their contents change (see
+    write_figure()).  The digests of the written files are kept in a
+    manifest file in each figure directory, so that unchanged files need not
+    be read again.
+    
+    """
+    manifest_name = '.pweave_figures'
+    
+    def __init__(self, jobs=0):
+        self.jobs = jobs
+        self.pool = None
+        # absolute filename -> AsyncResult of the figure's rendering
+        self.pending = OrderedDict()
+        # directory -> {filename: (digest, file_signature)} of its manifest
+        self.manifests = {}
+        # directories whose manifest has changed
+        self.modified_manifests = set()
+    
+    def manifest(self, directory):
+        "Return the manifest dictionary of *directory*, reading it if needed."
+        if directory not in self.manifests:
+            try:
+                manifest = pickle.load(open(os.path.join(directory,
+                                                self.manifest_name), 'rb'))
+            except (IOError, EOFError, pickle.UnpicklingError):
+                manifest = {}
+            self.manifests[directory] = manifest
+        return self.manifests[directory]
+    
+    def manifest_entry(self, filename):
+        "Return the recorded (digest, file_signature) of *filename*, or None."
+        directory, name = os.path.split(os.path.abspath(filename))
+        return self.manifest(directory).get(name)
+    
+    def record(self, filename, entry):
+        "Record the (digest, file_signature) *entry* of *filename*."
+        if entry is None:
+            return
+        directory, name = os.path.split(os.path.abspath(filename))
+        manifest = self.manifest(directory)
+        if manifest.get(name) != entry:
+            manifest[name] = entry
+            self.modified_manifests.add(directory)
+    
+    def save_manifests(self):
+        """Write the changed manifests, and forget all of them.
+        
+        A manifest is replaced atomically, so that a process reading it never
+        sees a partly written file.
+        
+        """
+        for directory in self.modified_manifests:
+            path = os.path.join(directory, self.manifest_name)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+            pickle.dump(self.manifests[directory], f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp_path, path)
+        self.modified_manifests.clear()
+        self.manifests.clear()
+    
+    def save(self, figure, filename, savefig_kwargs):
+        "Save *figure* to *filename*, now or in the background."
+        if self.jobs > 0 and not multiprocessing.current_process().daemon:
+            try:
+                data = pickle.dumps(figure, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # e.g. an artist holding an unpicklable object
+                data = None
+            if data is not None:
+                if self.pool is None:
+                    self.pool = multiprocessing.Pool(self.jobs)
+                filename = os.path.abspath(filename)
+                self.pending[filename] = self.pool.apply_async(render_figure,
+                                            (data, filename, savefig_kwargs,
+                                             self.manifest_entry(filename)))
+                return
+        
+        self.record(filename, write_figure(figure, filename, savefig_kwargs,
+                                           self.manifest_entry(filename)))
+    
+    def is_pending(self, filenames):
+        "Return True if any of *filenames* has not been written yet."
+        for filename in filenames:
+            if os.path.abspath(filename) in self.pending:
+                return True
+        return False
+    
+    def wait(self, filenames=None):
+        """Wait until *filenames* (default: all figures) have been written.
+        
+        An exception raised while rendering a figure is re-raised here.
+        
+        """
+        if filenames is None:
+            filenames = self.pending.keys()
+        for filename in filenames:
+            result = self.pending.pop(os.path.abspath(filename), None)
+            if result is None:
+                continue
+            try:
+                self.record(filename, result.get())
+            except:
+                print >>sys.stderr, "Error while saving figure %s:" % filename
+                raise
+    
+    def finish(self):
+        """Wait until all figures have been written, stop the pool, and write
+        the manifests."""
+        try:
+            self.wait()
+        finally:
+            self.cancel()
+            self.save_manifests()
+    
+    def cancel(self):
+        "Stop the pool, without waiting for figures still being rendered."
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+# renders the figures saved through CodeProcessor.save_figure()
+figure_renderer = FigureRenderer()
@@ -8,13 +8,147 @@ This module defines the AutoWrapProcessor class for use with pweave.
 import __main__ as pweave
 CodeProcessor = pweave.CodeProcessor
 
-from string import Template
+import os
 import re
-import sys
 
 #TODO: make more general (e.g. not specific to LaTeX) -- just a "put x before
 #      and y after" plugin.
 
+def trie_pattern(trie):
+    """Return a regular expression matching the strings stored in *trie*.
+    
+    *trie* is a nested dictionary mapping each character to the sub-trie of
+    the strings continuing with it; the key '' marks the end of a string.
+    Longer strings are preferred over their prefixes, so the pattern finds
+    the longest string starting at a position.
+    
+    """
+    alternatives = [re.escape(char) + trie_pattern(subtrie)
+                    for char, subtrie in sorted(trie.iteritems()) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1:
+        pattern = alternatives[0]
+    else:
+        pattern = '(?:' + '|'.join(alternatives) + ')'
+    if '' in trie:
+        # the string may also end here
+        pattern = '(?:' + pattern + ')?'
+    return pattern
+
+class FragmentMatcher(object):
+    """Wraps text-fragments with LaTeX commands, in a single scan of a text.
+    
+    *fragment_commands* maps each fragment to the name of its command.  The
+    fragments are compiled into one regular expression (shaped like a trie of
+    the fragments, so that matching doesn't slow down with their number).
+    Text is scanned from left to right; where several fragments start at a
+    position, the longest one is wrapped, and the scan continues after it.  A
+    fragment preceded by *escape_delimiter* isn't wrapped, and the delimiter
+    is removed.  Outside of fragments, '$$' is replaced by '$' in the same
+    scan (as string.Template did when it was used for the substitution).
+    
+    """
+    def __init__(self, fragment_commands, escape_delimiter):
+        self.commands = dict(fragment_commands)
+        
+        trie = {}
+        for fragment in self.commands:
+            node = trie
+            for char in fragment:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        
+        # without fragments, the fragment group never matches
+        self.regex = re.compile(r'(%s)?(%s)|(\$\$)' % (
+                                            re.escape(escape_delimiter),
+                                            trie_pattern(trie) or '(?!)'))
+    
+    def replace(self, match):
+        """Return the replacement of a matched (and possibly escaped) fragment,
+        or of an escaped '$'."""
+        escape, fragment, dollars = match.groups()
+        if dollars:
+            return '$'
+        if escape:
+            return fragment
+        return '\\' + self.commands[fragment] + '{' + fragment + '}'
+    
+    def wrap(self, text):
+        "Return *text* with its fragments wrapped, and its '$$' unescaped."
+        if not self.commands and '$$' not in text:
+            return text
+        return self.regex.sub(self.replace, text)
+
+# path -> (file_signature, {fragment: command}) of the glossary files read
+glossaries = {}
+
+def read_glossary(path):
+    """Return the {fragment: command} mappings of the glossary file *path*.
+    
+    Each line of the file has the form "<cmdname> <fragment>", where the
+    fragment is the rest of the line (so it may contain spaces).  Blank lines
+    and lines starting with '#' are ignored.  The file is only read again
+    when its size or modification time changes.
+    
+    """
+    signature = pweave.file_signature(path)
+    if path in glossaries and glossaries[path][0] == signature:
+        return glossaries[path][1]
+    
+    fragment_commands = {}
+    for number, line in enumerate(open(path)):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            raise ValueError('%s, line %d: expected "<cmdname> <fragment>"'
+                             % (path, number + 1))
+        fragment_commands[fields[1]] = fields[0]
+    
+    glossaries[path] = (signature, fragment_commands)
+    return fragment_commands
+
+def declaration_commands(declaration):
+    """Return the {fragment: command} mappings of a declaration.
+    
+    See AutoWrapProcessor.declaration().  The fragments of the *_wrapped
+    options take precedence over those of the glossary file; a fragment
+    listed for several commands is wrapped with the first of them in
+    alphabetical order.
+    
+    """
+    wrapped, list_delimiter, glossary = declaration
+    fragment_dict = {}
+    if glossary is not None:
+        fragment_dict.update(read_glossary(glossary[0]))
+    for cmd, fragments in reversed(wrapped):
+        for frag in fragments.split(list_delimiter):
+            if frag:
+                fragment_dict[frag] = cmd
+    return fragment_dict
+
+# (declarations, escape_delimiter) -> FragmentMatcher, so that the fragments
+# declared for a document are only compiled once
+matchers = {}
+
+def get_matcher(declarations, escape_delimiter):
+    """Return the (cached) FragmentMatcher for these declarations.
+    
+    Later declarations take precedence over earlier ones.
+    
+    """
+    key = (declarations, escape_delimiter)
+    if key not in matchers:
+        if len(matchers) >= 100:
+            matchers.clear()
+        fragment_commands = {}
+        for declaration in declarations:
+            fragment_commands.update(declaration_commands(declaration))
+        matchers[key] = FragmentMatcher(fragment_commands, escape_delimiter)
+    return matchers[key]
+
 class AutoWrapProcessor(CodeProcessor):
     """Processor to automatically wrap different items with a LaTeX command.
     
@@ -24,9 +158,19 @@ class AutoWrapProcessor(CodeProcessor):
     version of the fragment, where the command surrounds the fragment (e.g.
     "\mathbf{<string>}" could replace <string>). 
     
-    Beware of defining conflicting (overlapping) text-fragments, since if a
-    part of the code-block matches more than one text-fragment, the behavior
-    may not be as you expect it. 
+    Where several text-fragments start at the same position of the code-block,
+    the longest one is wrapped; the code-block is scanned from left to right,
+    and no text is wrapped twice.  A text-fragment listed for several commands
+    is wrapped with the first of them in alphabetical order.  Outside of the
+    text-fragments, '$$' stands for a single '$'; other text (including a
+    single '$') is passed through unchanged.
+    
+    Fragments may be declared once for the rest of the document, instead of
+    in the options of every block: the fragments of a block with the option
+    declare=True are wrapped in it and in all following autowrap blocks.  A
+    block's own fragments take precedence over declared ones, and later
+    declarations over earlier ones.  The declared fragments are compiled
+    only once.
     
     The following code-block options are accepted:
     
@@ -35,6 +179,16 @@ class AutoWrapProcessor(CodeProcessor):
                            should be wrapped with the specified command.
                            The list has the form "<fragment0>#<fragment1>...".
     
+    *glossary* -- (optional) the name of a file (relative to the current
+                  directory) of further fragments to wrap, with one
+                  "<cmdname> <fragment>" pair per line.  Lines starting with
+                  '#' are ignored.  Changes of the file are detected by
+                  its modification time.
+    
+    *declare* -- (optional) if 'True', the block's fragments (including
+                 those of its glossary) are declared for the following
+                 blocks.  The default value is 'False'.
+    
     *list_delimiter* -- (optional) specifies what character is used to delimit
                         the text-fragment lists.  The default value is '#'.
                         
@@ -43,12 +197,15 @@ class AutoWrapProcessor(CodeProcessor):
                           the codeblock is preceeded by these two characters,
                           the text will *NOT* be substituted, and the two
                           characters will be removed from the passed-through
-                          text.  The default value is '!!'.  Note, that the
-                          two-character requirement is due to a limitation
-                          imposed by using a negative lookbehind in a regular
-                          expression pattern.
+                          text.  The default value is '!!'.
     
     """
+    counter_names = ('declarations',)
+    
+    def __init__(self, processors):
+        super(AutoWrapProcessor, self).__init__(processors)
+        self.declarations = () # declarations of the preceding blocks
+    
     def name(self):
         return "autowrap"
     
@@ -57,67 +214,52 @@ class AutoWrapProcessor(CodeProcessor):
         option_defaults = {
                             'list_delimiter': '#',
                             'escape_delimiter': '!!',
+                            'glossary': '',
+                            'declare': 'False',
                           }
         
         return option_defaults
 
-    def process_code(self, codeblock, codeblock_options):
-        # build a dictionary of 'frag':'command' mappings
-        fragment_dict = {}
-        for k,v in codeblock_options.iteritems():
-            if k.endswith("_wrapped"):
-                cmd = k[0:-8] # chop off '_wrapped'
-                for frag in v.split(codeblock_options['list_delimiter']):
-                    fragment_dict[frag] = cmd
-        
-        substitution_vars = {}
-        # build substitution dictionary (allows for more general substitutions
-        # in the future), at the same time replacing fragments with a 
-        # substitution-variable.
+    def block_inputs(self, codeblock_options):
+        "Return the absolute paths of the files a block reads."
+        paths = super(AutoWrapProcessor, self).block_inputs(codeblock_options)
+        if codeblock_options.get('glossary'):
+            paths.append(os.path.abspath(codeblock_options['glossary']))
+        return paths
+
+    def declaration(self, codeblock_options):
+        """Return the (hashable) declaration of the fragments of the options.
         
-        esc = codeblock_options['escape_delimiter']
-
-        i=0
-        placeholder_root = "autowrap_"
-        placeholder_tmp_root = esc + esc.join(list(placeholder_root)) + esc 
-        for frag,cmd in fragment_dict.iteritems():
-            repl_str = '\\' + cmd + '{' + frag + '}'
-            placeholder = placeholder_root + str(i)
-            
-            # temp-placeholder needed to prevent substituting parts of the
-            # placeholders during the substitution loop.
-            placeholder_tmp = placeholder_tmp_root + str(i)
-            
-            substitution_vars[placeholder] = repl_str
-            
-            escapedfrag = re.escape(frag)
-            # only replace when frag is not immediately preceded by '!!' or '${'.
-            # uses a "negative lookbehind" assertion: (?<!....)
-            pattern = r'(?<!\$\{|'+re.escape(esc)+')' + escapedfrag
-            codeblock = re.sub(pattern, r'${' + placeholder_tmp + r'}', codeblock)
-            
-            i += 1
-            
-        # now all autowrap comamnd substitutions are finished -- replace
-        # escaped placeholders with 'legal' placeholders so Template()
-        # likes the placeholder names.
-        codeblock = codeblock.replace(placeholder_tmp_root, placeholder_root)
-            
-        # loop once more, this time removing '!!' preceeding fragments
-        for frag,cmd in fragment_dict.iteritems():
-            pattern = re.escape(esc) + re.escape(frag)
-            codeblock = re.sub(pattern, re.escape(frag), codeblock) 
+        This is a tuple of the sorted (cmdname, fragment list) pairs of the
+        *_wrapped options, the list delimiter, and the (absolute path,
+        file_signature) of the glossary file or None.
         
-        # add any additional items to substitution_vars dict here...
+        """
+        wrapped = tuple(sorted((k[0:-8], v) # chop off '_wrapped'
+                               for k, v in codeblock_options.iteritems()
+                               if k.endswith("_wrapped")))
+        glossary = None
+        if codeblock_options['glossary']:
+            path = os.path.abspath(codeblock_options['glossary'])
+            glossary = (path, pweave.file_signature(path))
+        return (wrapped, codeblock_options['list_delimiter'], glossary)
+
+    def advance_counters(self, codeblock_options):
+        "Update the counters as processing a block with these options would."
+        if codeblock_options['declare'].lower() == 'true':
+            self.declarations += (self.declaration(codeblock_options),)
+
+    def process_code(self, codeblock, codeblock_options):
+        if codeblock_options['declare'].lower() == 'true':
+            self.advance_counters(codeblock_options)
+            declarations = self.declarations
+        else:
+            declarations = self.declarations + (
+                                        self.declaration(codeblock_options),)
         
-        # perform substitutions
-        try:
-            document_text = \
-                Template(codeblock).substitute(substitution_vars)
-        except ValueError, e:
-            print e, ':'
-            print codeblock
-            sys.exit(1)
+        matcher = get_matcher(declarations,
+                              codeblock_options['escape_delimiter'])
+        document_text = matcher.wrap(codeblock)
         
         code_text = ''
         
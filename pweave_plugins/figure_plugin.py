@@ -8,9 +8,7 @@ This module defines a Matplotlib-figure processor class for use with pweave.
 import __main__ as pweave
 CodeProcessor = pweave.CodeProcessor
 
-from string import Template
 import os
-import matplotlib.pyplot as plt
 
 class MatplotlibFigureProcessor(CodeProcessor):
     """Processor for generating (LaTeX) figures from matplotlib plots.
@@ -49,6 +47,8 @@ class MatplotlibFigureProcessor(CodeProcessor):
     TODO: other formatting options
     
     """
+    counter_names = ('figure_number',)
+
     def __init__(self, processors):
         super(MatplotlibFigureProcessor, self).__init__(processors)
         self.figure_number = 1 # counter used for autogenerating figure-names
@@ -72,6 +72,9 @@ class MatplotlibFigureProcessor(CodeProcessor):
         
         return option_defaults
 
+    def advance_counters(self, codeblock_options):
+        "Update the counters as processing a block with these options would."
+        self.figure_number += 1
 
     def output_template_str(self):
         return r'''
@@ -83,6 +86,10 @@ class MatplotlibFigureProcessor(CodeProcessor):
 \end{figure}
 '''
 
+    def template_strs(self):
+        "Return a dictionary of the processor's output templates."
+        return {'output': self.output_template_str()}
+
     def get_image_abspath(self, outfolder):
         "Autogenerate and return an absolute image path."
         fname = "mpl_image_%03d.pdf" % self.figure_number
@@ -145,8 +152,8 @@ class MatplotlibFigureProcessor(CodeProcessor):
     
     def write_figure(self, filename):
         "Write (and clear) the matplotlib fig as a pdf to the specified file."
-        plt.savefig(filename, dpi = 200)
-        plt.clf()
+        self.save_figure(filename, dpi = 200)
+        self.clear_figure()
         
     
     def process_code(self, codeblock, codeblock_options):
@@ -157,8 +164,7 @@ class MatplotlibFigureProcessor(CodeProcessor):
         # a bit ugly... (passing info here via substitution_vars dict)
         self.write_figure(substitution_vars['imgfile_abspath'])
 
-        document_text = \
-            Template(self.output_template_str()).substitute(substitution_vars)
+        document_text = self.render_template('output', substitution_vars)
         
         # by default, don't echo the codeblock to the output document
         if codeblock_options['echo'].lower() == 'true':
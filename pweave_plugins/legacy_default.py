@@ -10,7 +10,6 @@ CodeProcessor = pweave.CodeProcessor
 
 import os
 import StringIO
-import matplotlib.pyplot as plt
 
 #TODO: make more general (e.g. not specific to LaTeX) -- just a "put x before
 #      and y after" plugin.
@@ -64,6 +63,8 @@ class LegacyDefaultProcessor(CodeProcessor):
                  float in Latex.
     
     """
+    counter_names = ('nfig',)
+
     def __init__(self, all_processors):
         super(LegacyDefaultProcessor, self).__init__(all_processors)
         self.nfig = 1
@@ -86,6 +87,11 @@ class LegacyDefaultProcessor(CodeProcessor):
         
         return option_defaults
 
+    def advance_counters(self, codeblock_options):
+        "Update the counters as processing a block with these options would."
+        if codeblock_options['fig'].lower() == 'true':
+            self.nfig += 1
+
     def process_code(self, codeblock, codeblock_options):
         outbuf = StringIO.StringIO() # temporary file obj for storing text
         blockoptions = codeblock_options
@@ -162,7 +168,7 @@ class LegacyDefaultProcessor(CodeProcessor):
         if blockoptions['fig'].lower() == 'true':
             figname = os.path.join(self.settings['imgfolder_path'],'Fig' +str(self.nfig) \
                     + self.settings['img_format'])
-            plt.savefig(figname, dpi = 200)
+            self.save_figure(figname, dpi = 200)
             
             #TODO: why can't we just set 'img_format' for sphinx like we do for
             #      tex and rst?
@@ -171,8 +177,8 @@ class LegacyDefaultProcessor(CodeProcessor):
                 figname2 = figname2_base + self.settings['sphinxteximg_format']
                 figname2_base_rel = \
                     os.path.relpath(figname2_base, self.settings['base_output_path'])
-                plt.savefig(figname2)
-            plt.clf()
+                self.save_figure(figname2)
+            self.clear_figure()
             if self.settings['format'] == 'rst':
                 if blockoptions['caption']:
                     #If the image has a caption, use Figure directive
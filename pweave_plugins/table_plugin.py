@@ -8,12 +8,14 @@ This module defines a TableProcessor class for use with pweave.
 import __main__ as pweave
 CodeProcessor = pweave.CodeProcessor
 
-from string import Template
+import os
+from itertools import chain, izip, islice
 
 class TableProcessor(CodeProcessor):
     """Processor for generating (LaTeX) tables.
     
-    This processor generates a table from a nested-list.
+    This processor generates a table from a nested-list, a 2-dimensional
+    NumPy array, a pandas DataFrame, or an iterator of rows.
     
     The following code-block options are accepted:
     
@@ -21,18 +23,66 @@ class TableProcessor(CodeProcessor):
                          the code-block will create that contains the contents
                          of the table.  Each sublist in the list represents one
                          row of the table, and can contain either string or
-                         numeric values.  By default, this option is set to
-                         "table_rows". 
+                         numeric values.  Instead of a list, the name may
+                         refer to a NumPy array or pandas DataFrame (whose
+                         cells are all formatted in one operation), or to an
+                         iterator (e.g. a generator) of rows, which is
+                         consumed one row at a time (not with --isolate,
+                         since iterators can't be sent between processes).
+                         The rows of a spilled table (see *spill*) are
+                         written to its file as they are formatted; other
+                         tables become part of the block's output text.
+                         By default, this option is set to "tablerows".
     
     *column_labels* -- (optional) specifies the name of a list which contains
-                       the column labels. 
+                       the column labels.  For a DataFrame, its column names
+                       are used by default.
     
     *row_labels* -- (optional) specifies the name of a list which contains the
                     row labels.
     
-    TODO: other formatting options
+    *column_formats* -- (optional) a list of %-format specifications for the
+                        cells of each column, e.g. "%.2f#%d#%s", separated by
+                        *list_delimiter*.  Columns without a (non-empty)
+                        specification are formatted with "%s", like str().
+    
+    *list_delimiter* -- (optional) the delimiter of the column_formats list.
+                        The default value is '#'.
+    
+    *paginate* -- (optional) 'longtable' to typeset the table with the
+                  longtable package (which needs \usepackage{longtable}), so
+                  that it may span pages; 'split' to split it into several
+                  tables of at most *max_rows* rows each; or 'false' (the
+                  default) for a single table.
+    
+    *max_rows* -- (optional) the number of rows of each table with
+                  paginate='split'.  Setting it implies paginate='split'.
+                  The default value is 40.
+    
+    *spill* -- (optional) if 'true', the table is written to a separate file
+               in *output_folder*, which the document includes with \input,
+               so that the document itself stays small.  The table is
+               written in pieces of at most *rows_per_piece* rows, so its
+               text is never held in memory as a whole.  The default value is
+               'false'.
+    
+    *output_folder* -- (optional) the folder of spilled tables, relative to
+                       the base output folder.  The default is the image
+                       folder.
     
     """
+    counter_names = ('table_number',)
+    
+    # stands for the rows when rendering the text around them
+    rows_marker = '\0rows\0'
+    
+    # the number of rows formatted at once (see iter_rows_str())
+    rows_per_piece = 10000
+    
+    def __init__(self, processors):
+        super(TableProcessor, self).__init__(processors)
+        self.table_number = 1 # counter used for naming spilled tables
+    
     def name(self):
         return "table"
     
@@ -44,11 +94,22 @@ class TableProcessor(CodeProcessor):
                             'table_list_name': 'tablerows',
                             'column_labels': None,
                             'row_labels': None,
+                            'column_formats': '',
+                            'list_delimiter': '#',
+                            'paginate': 'false',
+                            'max_rows': None,
+                            'spill': 'false',
+                            'output_folder': None,
                             'echo': 'false',
                           }
         
         return option_defaults
 
+    def advance_counters(self, codeblock_options):
+        "Update the counters as processing a block with these options would."
+        if codeblock_options['spill'].lower() == 'true':
+            self.table_number += 1
+
 
     def output_template_str(self):
         return r'''
@@ -66,6 +127,26 @@ $rows
 \end{table}
 '''
     
+    def longtable_template_str(self):
+        return r'''
+\begin{longtable}{$tabular_format}
+\caption{$caption}\\
+\hline
+$columnlabels\endfirsthead
+\caption[]{$caption (continued)}\\
+\hline
+$columnlabels\endhead
+\hline
+\endfoot
+$rows
+\end{longtable}
+'''
+    
+    def template_strs(self):
+        "Return a dictionary of the processor's output templates."
+        return {'output': self.output_template_str(),
+                'longtable': self.longtable_template_str()}
+    
     def col_label_str(self, col_labels):
         "Return LaTeX code for column labels"
         if len(col_labels) == 0:
@@ -77,28 +158,130 @@ $rows
         
         return s
     
-    def rows_str(self, table_rows, row_labels=None):
-        "Return LaTeX code for all rows"
+    def row_format(self, row_length, column_formats=(), row_labels=None):
+        """Return the %-format string of a row of *row_length* cells.
         
-        s = ''
-        for i,row in enumerate(table_rows):
-            latex_row_elems = [str(elem) for elem in row]
-            if row_labels is not None:
-                latex_row_elems.insert(0, r'\textbf{' + str(row_labels[i]) + r'}')
-            
-            s += r' & '.join(latex_row_elems) + r'\\' + "\n"
+        *column_formats* are the specifications of the first columns (see the
+        class documentation); the others are formatted with "%s".  If
+        *row_labels* are given, the row's first cell is its label.
         
-        s += r'\hline' + "\n"
+        """
+        formats = [f or '%s' for f in column_formats[:row_length]]
+        formats += ['%s'] * (row_length - len(formats))
         
+        s = r' & '.join(formats) + '\\\\\n'
+        if row_labels is not None:
+            s = r'\textbf{%s} & ' + s
         return s
     
-    def tabular_format_str(self, table_rows, row_labels=None):
-        "Return LaTeX 'tabular' environment format string"
- 
-        row_length = len(table_rows[0])
+    def rows_str(self, table_rows, row_labels=None, column_formats=(),
+                 closing_rule=True):
+        """Return LaTeX code for all rows
+        
+        *table_rows* may be a sequence or iterator of rows, a 2-dimensional
+        NumPy array or a pandas DataFrame.  If *closing_rule* is true, the
+        rows are followed by a horizontal rule.
+        
+        """
+        return ''.join(self.iter_rows_str(table_rows, row_labels,
+                                          column_formats, closing_rule))
+    
+    def iter_rows_str(self, table_rows, row_labels=None, column_formats=(),
+                      closing_rule=True):
+        """Yield the LaTeX code of all rows (see rows_str()) in pieces of at
+        most *rows_per_piece* rows."""
+        if hasattr(table_rows, 'shape') and row_labels is None:
+            # a NumPy array or DataFrame: format all cells of a piece at once
+            if hasattr(table_rows, 'values'):
+                table_rows = table_rows.values
+            n_rows, row_length = table_rows.shape
+            row_format = self.row_format(row_length, column_formats)
+            for start in range(0, n_rows, self.rows_per_piece):
+                rows = table_rows[start:start + self.rows_per_piece]
+                yield (row_format * len(rows)) % tuple(rows.ravel().tolist())
+        else:
+            if hasattr(table_rows, 'values'):
+                table_rows = table_rows.values
+            if hasattr(table_rows, 'tolist'):
+                table_rows = table_rows.tolist()
+            
+            if row_labels is None:
+                rows = (tuple(row) for row in table_rows)
+                n_labels = 0
+            else:
+                rows = ((label,) + tuple(row)
+                        for label, row in izip(row_labels, table_rows))
+                n_labels = 1
+            
+            # row length -> row format, for rows of different lengths
+            row_formats = {}
+            while True:
+                lines = []
+                for row in islice(rows, self.rows_per_piece):
+                    if len(row) not in row_formats:
+                        row_formats[len(row)] = self.row_format(
+                                                    len(row) - n_labels,
+                                                    column_formats, row_labels)
+                    lines.append(row_formats[len(row)] % row)
+                if not lines:
+                    break
+                yield ''.join(lines)
+        
+        if closing_rule:
+            yield r'\hline' + "\n"
+    
+    def iter_row_chunks(self, table_rows, row_labels=None, max_rows=40):
+        """Split a table into parts of at most *max_rows* rows.
+        
+        Yields a (rows, labels) tuple for each part, where *labels* is None
+        if *row_labels* is None.  At least one (possibly empty) part is
+        yielded.
+        
+        """
         if row_labels is not None:
-            row_length += 1
+            row_labels = iter(row_labels)
+        
+        if hasattr(table_rows, 'shape'):
+            # a NumPy array or DataFrame
+            n_rows = len(table_rows)
+            if hasattr(table_rows, 'iloc'):
+                table_rows = table_rows.iloc
+            parts = (table_rows[start:start + max_rows]
+                     for start in range(0, n_rows, max_rows))
+        else:
+            table_rows = iter(table_rows)
+            parts = iter(lambda: list(islice(table_rows, max_rows)), [])
         
+        empty = True
+        for rows in parts:
+            if row_labels is not None:
+                labels = list(islice(row_labels, len(rows)))
+            else:
+                labels = None
+            yield rows, labels
+            empty = False
+        
+        if empty:
+            yield [], ([] if row_labels is not None else None)
+    
+    def iter_tables(self, template, substitution_vars, table_rows, row_labels,
+                    column_formats, caption, max_rows):
+        """Yield the text of each table of a table split into parts of at most
+        *max_rows* rows (see iter_row_chunks())."""
+        first = True
+        for rows, labels in self.iter_row_chunks(table_rows, row_labels,
+                                                 max_rows):
+            substitution_vars['rows'] = self.rows_str(rows, labels,
+                                                      column_formats)
+            if first:
+                substitution_vars['caption'] = caption
+            else:
+                substitution_vars['caption'] = caption + ' (continued)'
+            yield template.render(substitution_vars)
+            first = False
+    
+    def tabular_format_str(self, row_length):
+        "Return LaTeX 'tabular' environment format string"
         #TODO: don't hardcode to all 'c' elems
         format_elems = ['c'] * row_length
         
@@ -108,17 +291,45 @@ $rows
         #return "|l | c |"
         
     
+    def spill(self, document_text, codeblock_options):
+        """Write *document_text* to a file of its own, and return the LaTeX
+        code which includes this file.
+        
+        *document_text* may be a string or an iterable of strings (see
+        CodeProcessor.write_file()).
+        
+        """
+        if codeblock_options['output_folder'] is not None:
+            outfolder = os.path.join(self.settings['base_output_path'],
+                                     codeblock_options['output_folder'])
+        else:
+            outfolder = self.settings['imgfolder_path']
+        if not os.path.isdir(outfolder):
+            os.makedirs(outfolder)
+        
+        filename = os.path.join(outfolder, 'Table%d.tex' % self.table_number)
+        self.table_number += 1
+        self.write_file(filename, document_text)
+        
+        relpath = os.path.relpath(filename, self.settings['base_output_path'])
+        return '\n\\input{%s}\n' % relpath.replace(os.sep, '/')
+    
     def process_code(self, codeblock, codeblock_options):
         substitution_vars = {}
 
         # execute the codeblock, storing results in self.execution_namespace
         self.exec_code(codeblock)
         # extract object from exec_code()'s namespace:
-        table_rows = self.execution_namespace['tablerows']
+        table_rows = self.execution_namespace[
+                                        codeblock_options['table_list_name']]
         
         if codeblock_options['column_labels'] is not None:
             col_labels = self.execution_namespace[codeblock_options['column_labels']]
             substitution_vars['columnlabels'] = self.col_label_str(col_labels)
+        elif hasattr(table_rows, 'columns'):
+            # a DataFrame's column names
+            substitution_vars['columnlabels'] = \
+                                    self.col_label_str(list(table_rows.columns))
         else:
             substitution_vars['columnlabels'] = ''
         
@@ -127,12 +338,60 @@ $rows
         else:
             row_labels = None
         
-        substitution_vars['rows'] = self.rows_str(table_rows, row_labels)
-        substitution_vars['tabular_format'] = self.tabular_format_str(table_rows, row_labels)
-        substitution_vars['caption'] = codeblock_options['caption']
-
-        document_text = \
-            Template(self.output_template_str()).substitute(substitution_vars)
+        # the number of columns is that of the first row
+        if hasattr(table_rows, 'shape'):
+            row_length = table_rows.shape[1]
+        elif hasattr(table_rows, '__getitem__'):
+            row_length = len(table_rows[0]) if len(table_rows) else 0
+        else:
+            # an iterator: look at its first row, and put it back
+            table_rows = iter(table_rows)
+            first_row = next(table_rows, None)
+            if first_row is None:
+                row_length = 0
+            else:
+                row_length = len(first_row)
+                table_rows = chain([first_row], table_rows)
+        if row_labels is not None:
+            row_length += 1
+        
+        column_formats = [f.strip() for f in
+                          codeblock_options['column_formats'].split(
+                                    codeblock_options['list_delimiter'])]
+        substitution_vars['tabular_format'] = self.tabular_format_str(row_length)
+        caption = codeblock_options['caption']
+        
+        paginate = codeblock_options['paginate'].lower()
+        if codeblock_options['max_rows'] is not None:
+            paginate = 'split'
+        
+        if paginate == 'split':
+            template = self.templates['output']
+            tables = self.iter_tables(template, substitution_vars, table_rows,
+                                      row_labels, column_formats, caption,
+                                      int(codeblock_options['max_rows'] or 40))
+        else:
+            if paginate == 'longtable':
+                # the foot of each page (see longtable_template_str()) closes
+                # the table with a rule already
+                template = self.templates['longtable']
+                closing_rule = False
+            else:
+                template = self.templates['output']
+                closing_rule = True
+            substitution_vars['caption'] = caption
+            # the table's text around its rows
+            substitution_vars['rows'] = self.rows_marker
+            head, tail = template.render(substitution_vars).split(
+                                                        self.rows_marker)
+            tables = chain([head], self.iter_rows_str(table_rows, row_labels,
+                                                      column_formats,
+                                                      closing_rule), [tail])
+        
+        if codeblock_options['spill'].lower() == 'true':
+            document_text = self.spill(tables, codeblock_options)
+        else:
+            document_text = ''.join(tables)
         
         # by default, don't echo the codeblock to the output document
         if codeblock_options['echo'].lower() == 'true':
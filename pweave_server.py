@@ -0,0 +1,259 @@
+"""
+The pweave server (see --serve), which processes pweave invocations in
+processes forked from it, so that they start with the plugins and other
+modules already imported, and the client side of it.
+
+This module is imported by pweave.py, and uses its globals.
+
+"""
+import os
+import sys
+import errno
+import socket
+import signal
+import hashlib
+import traceback
+import cPickle as pickle
+
+import pweave
+
+# default Unix socket of the pweave server (see serve())
+default_server_socket = os.path.join(os.path.expanduser('~'), '.pweave_server')
+
+# written by the server between the output of a request and its exit status
+server_status_marker = '\0pweave-exit-status:'
+
+# code_signature() of the running server, computed at startup (see serve())
+server_signature = None
+
+def code_signature(settings):
+    """Return a hash of pweave.py and its modules, and of the plugins found
+    with *settings*.
+    
+    A server only processes requests of pweave invocations with the same
+    signature, so that their documents are not woven with other code than
+    they would be without the server.
+    
+    """
+    digest = hashlib.sha1(repr([pweave.file_hash(path)
+                                for path in pweave.pweave_source_paths]))
+    for directory in pweave.plugin_directories(settings):
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        digest.update(repr(directory))
+        for name in names:
+            if name.endswith('.py'):
+                path = os.path.join(directory, name)
+                digest.update(repr((name, pweave.file_hash(path))))
+    return digest.hexdigest()
+
+def connect_to_server(socket_path):
+    "Return a socket connected to the pweave server, or None if none runs."
+    if not os.path.exists(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+def run_via_server(socket_path, argv):
+    """Let the pweave server at *socket_path* process the arguments *argv*.
+    
+    The arguments are interpreted relative to the current directory, and with
+    the current environment variables.  The output of the server is copied to
+    stdout.  Returns the exit status, or None if no server is running, or if
+    the server runs different code (see code_signature()).
+    
+    """
+    connection = connect_to_server(socket_path)
+    if connection is None:
+        return None
+    
+    try:
+        request = {'argv': argv, 'cwd': os.getcwd(),
+                   'environ': dict(os.environ),
+                   'signature': code_signature(pweave.settings)}
+        request_file = connection.makefile('wb')
+        pickle.dump(request, request_file, pickle.HIGHEST_PROTOCOL)
+        request_file.flush()
+        
+        # copy the output, holding back anything which might be the start of
+        # the status marker
+        hold = len(server_status_marker)
+        pending = ''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            pending += data
+            if server_status_marker not in pending and len(pending) > hold:
+                sys.stdout.write(pending[:-hold])
+                sys.stdout.flush()
+                pending = pending[-hold:]
+    finally:
+        connection.close()
+    
+    output, marker, status = pending.partition(server_status_marker)
+    sys.stdout.write(output)
+    if not marker:
+        print >>sys.stderr, "the pweave server closed the connection " \
+                            "without an exit status"
+        return 1
+    if status == 'mismatch':
+        print >>sys.stderr, "WARNING: the pweave server on %s runs another " \
+              "version of pweave.py or of the plugins; weaving without it." \
+              % socket_path
+        return None
+    return int(status)
+
+def handle_request(connection):
+    """Process the request read from *connection*, in a forked server process.
+    
+    Stdout and stderr (on the file-descriptor level, so that the output of
+    subprocesses is included) are redirected to the connection, and the
+    arguments are processed by main().  The output is followed by
+    server_status_marker and the exit status; the process then exits.  A
+    request with code-blocks of a SocketExecutor is instead answered with
+    the pickled ('ok', result) of process_partition_request(), or ('error',
+    traceback).  Requests of a pweave with another code_signature() are
+    answered with the status 'mismatch' (or a pickled ('mismatch', None)),
+    without processing them.
+    
+    """
+    try:
+        request = pickle.load(connection.makefile('rb'))
+    except EOFError:
+        # the connection only checked whether the server is running
+        os._exit(0)
+    
+    if request.get('signature') != server_signature:
+        try:
+            if 'partition' in request:
+                reply_file = connection.makefile('wb')
+                pickle.dump(('mismatch', None), reply_file,
+                            pickle.HIGHEST_PROTOCOL)
+                reply_file.flush()
+            else:
+                connection.sendall(server_status_marker + 'mismatch')
+        finally:
+            os._exit(0)
+    
+    if 'partition' in request:
+        # code-blocks sent by a SocketExecutor
+        try:
+            try:
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['environ'])
+                reply = ('ok', pweave.process_partition_request(request))
+            except:
+                reply = ('error', traceback.format_exc())
+            reply_file = connection.makefile('wb')
+            pickle.dump(reply, reply_file, pickle.HIGHEST_PROTOCOL)
+            reply_file.flush()
+        finally:
+            os._exit(0)
+    
+    status = 1
+    try:
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            sys.argv = [sys.argv[0]] + request['argv']
+            
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(connection.fileno(), 1)
+            os.dup2(connection.fileno(), 2)
+            
+            status = pweave.main(request['argv'], use_server=False)
+        except SystemExit, e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print >>sys.stderr, e.code
+                status = 1
+        except:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        connection.sendall(server_status_marker + str(status))
+    finally:
+        os._exit(0)
+
+def serve(settings):
+    """Process pweave requests on the Unix socket settings['server_socket'].
+    
+    The plugins (found as specified by *settings*) and the modules listed in
+    settings['preload'] are imported once, at startup.  Each request is then
+    processed in a process forked from the server, so that it starts without
+    the cost of these imports, but shares no other state (namespaces, figure
+    counters, settings) with earlier requests.  The server runs until it is
+    interrupted or terminated.  Returns the exit status.
+    
+    """
+    global server_signature
+    
+    socket_path = settings['server_socket']
+    connection = connect_to_server(socket_path)
+    if connection is not None:
+        connection.close()
+        print >>sys.stderr, "a pweave server is already running on %s" % \
+                            socket_path
+        return 1
+    
+    server_signature = code_signature(settings)
+    pweave.load_processor_plugins(settings).import_all()
+    pweave.get_pyplot()
+    if settings['preload'] is not None:
+        for module_name in settings['preload'].split(','):
+            if module_name.strip():
+                __import__(module_name.strip())
+    
+    if os.path.exists(socket_path):
+        # left behind by a server which did not shut down cleanly
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # requests execute arbitrary code, so only the current user may connect
+    old_umask = os.umask(0077)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(16)
+    
+    # finished request processes are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print "pweave server listening on %s" % socket_path
+    sys.stdout.flush()
+    
+    try:
+        while True:
+            try:
+                connection, address = listener.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if os.fork() == 0:
+                listener.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                handle_request(connection)
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
@@ -0,0 +1,154 @@
+"""
+Weaving a source file again whenever its inputs change (see --watch).
+
+This module is imported by pweave.py, and uses its globals.
+
+"""
+import os
+import sys
+import copy
+import time
+import select
+import traceback
+import ctypes
+import ctypes.util
+
+import pweave
+
+class FileWatcher(object):
+    """Waits for changes of a set of files.
+    
+    Changes are detected by comparing file signatures (see file_signature())
+    with those of an earlier snapshot.  Where inotify is available, the
+    signatures are only compared again after inotify reports activity in one
+    of the watched directories; otherwise they are polled.
+    
+    """
+    # seconds between two comparisons when polling
+    poll_interval = 0.5
+    
+    # seconds to wait for further events after an inotify event, since
+    # editors often save a file in several steps
+    settle_time = 0.1
+    
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    # IN_CREATE | IN_DELETE
+    inotify_mask = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+    
+    def __init__(self):
+        self.libc = None
+        library = ctypes.util.find_library('c')
+        if library is not None:
+            try:
+                libc = ctypes.CDLL(library, use_errno=True)
+                libc.inotify_init
+                libc.inotify_add_watch
+                self.libc = libc
+            except (OSError, AttributeError):
+                # not Linux
+                pass
+    
+    def snapshot(self, files, directories):
+        """Return the signatures of *files* and of the Python files in the
+        *directories*, as a dictionary keyed by path."""
+        paths = list(files)
+        for directory in directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            paths.extend([os.path.join(directory, name) for name in names
+                          if name.endswith('.py')])
+        return dict((path, pweave.file_signature(path)) for path in paths)
+    
+    def inotify_watch(self, paths):
+        """Return an inotify file descriptor watching the directories in
+        *paths*, or None if they cannot all be watched."""
+        if self.libc is None:
+            return None
+        fd = self.libc.inotify_init()
+        if fd < 0:
+            return None
+        for path in paths:
+            if self.libc.inotify_add_watch(fd, path, self.inotify_mask) < 0:
+                os.close(fd)
+                return None
+        return fd
+    
+    def wait(self, files, directories, snapshot):
+        """Wait until the snapshot of *files* and *directories* differs from
+        *snapshot*, and return the sorted list of the changed paths."""
+        watched_dirs = set([os.path.dirname(path) for path in files])
+        watched_dirs.update([d for d in directories if os.path.isdir(d)])
+        fd = self.inotify_watch(sorted(watched_dirs))
+        try:
+            while True:
+                current = self.snapshot(files, directories)
+                changed = [path for path in set(current) | set(snapshot)
+                           if current.get(path) != snapshot.get(path)]
+                if changed:
+                    return sorted(changed)
+                
+                if fd is None:
+                    time.sleep(self.poll_interval)
+                else:
+                    select.select([fd], [], [])
+                    time.sleep(self.settle_time)
+                    # discard the events; the snapshot tells what changed
+                    while select.select([fd], [], [], 0)[0]:
+                        os.read(fd, 65536)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+def watch(watch_settings):
+    """Weave watch_settings['sourcefile_path'] whenever its inputs change.
+    
+    The source file is woven, and then again whenever it, a file declared in
+    a code-block's 'inputs' option, or a plugin changes.  The process (with
+    its imported modules, compiled code and parsed options) is reused for
+    each weave, and together with the code-block cache only the affected
+    code-blocks are executed again.  Each weave starts with empty namespaces
+    and no open figures, so that its output is the same as that of a
+    separate pweave run.  When a plugin changes, pweave restarts itself, since
+    a plugin module cannot be reliably re-imported.
+    
+    """
+    watcher = FileWatcher()
+    directories = pweave.plugin_directories(watch_settings)
+    files = [watch_settings['sourcefile_path']]
+    while True:
+        snapshot = watcher.snapshot(files, directories)
+        
+        pweave.declared_inputs.clear()
+        for namespace in pweave.exec_namespaces.itervalues():
+            namespace.clear()
+        pweave.close_figures()
+        
+        start = time.time()
+        # run_pweave() modifies the settings (e.g. the image format)
+        pweave.settings = copy.copy(watch_settings)
+        try:
+            pweave.run_pweave(pweave.settings)
+        except KeyboardInterrupt:
+            raise
+        except:
+            traceback.print_exc()
+        
+        files = [watch_settings['sourcefile_path']] + \
+                sorted(pweave.declared_inputs)
+        for path in files:
+            if path not in snapshot:
+                snapshot[path] = pweave.file_signature(path)
+        
+        print 'Woven in %.2f s; watching %d files for changes (%s)...' % \
+                (time.time() - start, len(files),
+                 'polling' if watcher.libc is None else 'inotify')
+        sys.stdout.flush()
+        changed = watcher.wait(files, directories, snapshot)
+        print 'Changed:', ', '.join(changed)
+        
+        if [path for path in changed if os.path.dirname(path) in directories]:
+            print 'Plugins changed; restarting pweave.'
+            sys.stdout.flush()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -0,0 +1,62 @@
+"""
+Helpers shared by the tests of pweave.
+
+pweave.py is a script rather than a package, so the tests either load it as
+a module (see load_pweave()), or run it in a separate process on source files
+in a temporary directory (see PweaveTestCase).
+
+"""
+import os
+import sys
+import imp
+import shutil
+import tempfile
+import unittest
+import subprocess
+from collections import defaultdict
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+repository_dir = os.path.dirname(tests_dir)
+pweave_path = os.path.join(repository_dir, 'pweave.py')
+plugin_dir = os.path.join(repository_dir, 'pweave_plugins')
+
+def load_pweave():
+    "Import pweave.py as a module (its plugins cannot be used this way)."
+    pweave = imp.load_source('pweave', pweave_path)
+    pweave.settings = defaultdict(lambda: None)
+    return pweave
+
+class PweaveTestCase(unittest.TestCase):
+    "Base class of tests which run pweave in a temporary directory."
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pweave-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def write(self, filename, text):
+        f = open(self.path(filename), 'w')
+        f.write(text)
+        f.close()
+
+    def read(self, filename):
+        return open(self.path(filename)).read()
+
+    def run_pweave(self, *args):
+        """Run pweave with the command line arguments *args*.
+
+        Returns pweave's output; fails the test if pweave fails.
+
+        """
+        process = subprocess.Popen([sys.executable, pweave_path,
+                                    '-p', plugin_dir] + list(args),
+                                   cwd=self.directory, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            self.fail('pweave %s failed:\n%s' % (' '.join(args), output))
+        return output
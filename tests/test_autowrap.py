@@ -0,0 +1,94 @@
+"""
+Tests of the autowrap processor (see pweave_plugins/autowrap_plugin.py).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import unittest
+
+from support import PweaveTestCase
+
+class AutoWrapTestCase(PweaveTestCase):
+
+    def weave(self, *blocks):
+        """Weave a document of autowrap blocks, given as (options, text)
+        pairs, and return the wrapped text of each block."""
+        self.write('doc.tex_pweave', ''.join(
+                   '<<p=autowrap, %s>>=\n%s\n@\n[end]\n' % block
+                   for block in blocks))
+        self.run_pweave('doc.tex_pweave')
+        return self.wrapped_blocks()
+
+    def wrapped_blocks(self):
+        "Return the wrapped text of each block of the output document."
+        return self.read('doc.tex').split('\n[end]\n')[:-1]
+
+class WrapTest(AutoWrapTestCase):
+
+    def test_fragments(self):
+        self.assertEqual(self.weave(('textbf_wrapped=x#xy, emph_wrapped=z',
+                                     'x xy z !!z')),
+                         ['\\textbf{x} \\textbf{xy} \\emph{z} z'])
+
+    def test_escaped_dollars(self):
+        self.assertEqual(self.weave(('textbf_wrapped=x', '$$x$$ $y$'),
+                                    ('list_delimiter=#', 'costs $$5')),
+                         ['$\\textbf{x}$ $y$', 'costs $5'])
+
+class DeclarationTest(AutoWrapTestCase):
+
+    def test_declared_fragments(self):
+        self.assertEqual(self.weave(('textbf_wrapped=x, declare=True', 'x y'),
+                                    ('list_delimiter=#', 'x y'),
+                                    ('emph_wrapped=x', 'x y'),
+                                    ('textit_wrapped=y, declare=True', 'x y'),
+                                    ('list_delimiter=#', 'x y')),
+                         ['\\textbf{x} y', '\\textbf{x} y', '\\emph{x} y',
+                          '\\textbf{x} \\textit{y}',
+                          '\\textbf{x} \\textit{y}'])
+
+    def test_later_declarations_take_precedence(self):
+        self.assertEqual(self.weave(('textbf_wrapped=x, declare=True', ''),
+                                    ('emph_wrapped=x, declare=True', ''),
+                                    ('list_delimiter=#', 'x')),
+                         ['', '', '\\emph{x}'])
+
+    def test_parallel_processing(self):
+        blocks = [('textbf_wrapped=x, declare=True', 'x y'),
+                  ('list_delimiter=#, namespace=other', 'x y'),
+                  ('textit_wrapped=y, declare=True', 'x y'),
+                  ('list_delimiter=#, namespace=third', 'x y')]
+        inline = self.weave(*blocks)
+        self.run_pweave('--jobs', '2', 'doc.tex_pweave')
+        self.assertEqual(self.wrapped_blocks(), inline)
+
+class GlossaryTest(AutoWrapTestCase):
+
+    def test_glossary(self):
+        self.write('glossary.txt', '# a comment\n\n'
+                                   'textbf alpha beta\nemph x\n')
+        self.assertEqual(self.weave(('glossary=glossary.txt, textit_wrapped=x',
+                                     'alpha beta x alpha')),
+                         ['\\textbf{alpha beta} \\textit{x} alpha'])
+
+    def test_declared_glossary(self):
+        self.write('glossary.txt', 'textbf x\n')
+        self.assertEqual(self.weave(('glossary=glossary.txt, declare=True',
+                                     'x'),
+                                    ('list_delimiter=#', 'x')),
+                         ['\\textbf{x}', '\\textbf{x}'])
+
+    def test_edited_glossary(self):
+        self.write('glossary.txt', 'textbf x\n')
+        self.assertEqual(self.weave(('glossary=glossary.txt', 'x y')),
+                         ['\\textbf{x} y'])
+        self.run_pweave('--cache', 'doc.tex_pweave')
+        self.write('glossary.txt', 'textbf x\nemph y\n')
+        # the glossary is an input of the block's cache entry
+        self.run_pweave('--cache', 'doc.tex_pweave')
+        self.assertEqual(self.wrapped_blocks(), ['\\textbf{x} \\emph{y}'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests of weaving several source files in one invocation (see run_batch()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import sys
+import unittest
+import subprocess
+
+from support import pweave_path, plugin_dir, PweaveTestCase
+
+# Runs pweave as __main__ (so that its plugins can import it), with a
+# multiprocessing.Pool which prints the modules imported when the pool would
+# fork its workers, instead of weaving the files.
+batch_driver = '''
+import sys, runpy, multiprocessing
+class Pool(object):
+    def __init__(self, *args, **kwargs):
+        print ' '.join(sorted(name for name in sys.modules
+                              if sys.modules[name] is not None))
+        sys.exit(0)
+multiprocessing.Pool = Pool
+sys.argv = [%r, '-p', %r] + sys.argv[1:]
+runpy.run_path(%r, run_name='__main__')
+''' % (pweave_path, plugin_dir, pweave_path)
+
+class BatchTest(PweaveTestCase):
+
+    def modules_before_fork(self, *texts):
+        "Return the modules imported before the workers for *texts* fork."
+        filenames = []
+        for i, text in enumerate(texts):
+            filenames.append('doc%d.tex_pweave' % i)
+            self.write(filenames[-1], text)
+        process = subprocess.Popen([sys.executable, '-c', batch_driver] +
+                                   filenames, cwd=self.directory,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        return set(output.split())
+
+    def test_plugins_are_imported_before_fork(self):
+        modules = self.modules_before_fork(
+                        '<<p=helloworld, hello_text="Hi">>=\n@\n',
+                        '<<>>=\nprint 1\n@\n')
+        self.assertTrue('hello_world' in modules)
+        self.assertFalse('table_plugin' in modules)
+
+    def test_pyplot_is_imported_for_figures(self):
+        modules = self.modules_before_fork('<<fig=True>>=\nx = 1\n@\n',
+                                           '<<>>=\nprint 1\n@\n')
+        self.assertTrue('matplotlib.pyplot' in modules)
+        modules = self.modules_before_fork('<<p=mplfig>>=\nx = 1\n@\n',
+                                           '<<>>=\nprint 1\n@\n')
+        self.assertTrue('matplotlib.pyplot' in modules)
+
+    def test_pyplot_is_not_imported_without_figures(self):
+        modules = self.modules_before_fork('<<>>=\nprint 1\n@\n',
+                                           '<<>>=\nprint 2\n@\n')
+        self.assertFalse('matplotlib.pyplot' in modules)
+
+class BatchFigureTest(PweaveTestCase):
+
+    def test_files_sharing_a_figure_folder(self):
+        for i in range(2):
+            self.write('doc%d.tex_pweave' % i,
+                       '<<fig=True, echo=False>>=\n'
+                       'import matplotlib.pyplot as plt\n'
+                       'plt.plot(range(%d))\n@\n' % (i + 2))
+        self.run_pweave('--jobs', '2', '-d', 'figures',
+                        'doc0.tex_pweave', 'doc1.tex_pweave')
+        for i in range(2):
+            figure = self.path('figures/doc%d/Fig1.pdf' % i)
+            self.assertTrue(os.path.exists(figure))
+            self.assertTrue(figure in self.read('doc%d.tex' % i))
+
+    def test_file_with_own_figure_folder(self):
+        os.mkdir(self.path('sub'))
+        for filename in ['doc.tex_pweave', 'sub/doc.tex_pweave']:
+            self.write(filename, '<<fig=True, echo=False>>=\n'
+                                 'import matplotlib.pyplot as plt\n'
+                                 'plt.plot(range(2))\n@\n')
+        self.run_pweave('-d', 'figures', 'doc.tex_pweave',
+                        'sub/doc.tex_pweave')
+        self.assertTrue(os.path.exists(self.path('figures/Fig1.pdf')))
+        self.assertTrue(os.path.exists(self.path('sub/figures/Fig1.pdf')))
+
+if __name__ == "__main__":
+    unittest.main()
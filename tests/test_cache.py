@@ -0,0 +1,168 @@
+"""
+Tests of the chunk cache (see ChunkCache).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import re
+import imp
+import unittest
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+class CacheTestCase(PweaveTestCase):
+    "Base class of tests which weave a document twice with --cache."
+
+    def weave(self, text, *args):
+        "Weave *text*; return the woven document and the (hits, misses)."
+        self.write('doc.tex_pweave', text)
+        output = self.run_pweave('--cache', *args + ('doc.tex_pweave',))
+        counts = re.search(r'Chunk cache: (\d+) hits, (\d+) misses', output)
+        return self.read('doc.tex'), (int(counts.group(1)),
+                                      int(counts.group(2)))
+
+class CacheHitTest(CacheTestCase):
+
+    def test_unchanged_blocks_are_replayed(self):
+        text = ('<<>>=\nx = 6 * 7\n@\n'
+                '<<echo=False>>=\nprint "answer", x\n@\n')
+        first, counts = self.weave(text)
+        self.assertEqual(counts, (0, 2))
+        second, counts = self.weave(text)
+        self.assertEqual(counts, (2, 0))
+        self.assertEqual(first, second)
+        self.assertTrue('answer 42' in second)
+
+    def test_no_cache_by_default(self):
+        self.write('doc.tex_pweave', '<<>>=\nx = 1\n@\n')
+        self.assertFalse('Chunk cache' in self.run_pweave('doc.tex_pweave'))
+        self.assertFalse(os.path.exists(self.path('.pweave_cache')))
+
+class CacheKeyTest(CacheTestCase):
+    "Changes of a block's output must not replay cached results."
+
+    def test_changed_code(self):
+        template = ('<<>>=\nx = %d\n@\n'
+                    '<<echo=False>>=\nprint "value", x\n@\n'
+                    '<<>>=\ny = 1\n@\n')
+        self.weave(template % 1)
+        text, counts = self.weave(template % 2)
+        self.assertTrue('value 2' in text)
+        # the edited block and the blocks following it in its namespace
+        self.assertEqual(counts, (0, 3))
+
+    def test_changed_options(self):
+        template = '<<echo=%s>>=\nprint "value", 1 + 1\n@\n'
+        text, counts = self.weave(template % 'True')
+        self.assertTrue('1 + 1' in text)
+        text, counts = self.weave(template % 'False')
+        self.assertFalse('1 + 1' in text)
+        self.assertEqual(counts, (0, 1))
+
+    def test_changed_inputs(self):
+        text = ('<<inputs="data.txt", echo=False>>=\n'
+                'print "data", open("data.txt").read()\n@\n')
+        self.write('data.txt', 'one')
+        self.weave(text)
+        self.write('data.txt', 'three')
+        woven, counts = self.weave(text)
+        self.assertTrue('data three' in woven)
+        self.assertEqual(counts, (0, 1))
+
+    def test_capture_mode(self):
+        text = ('<<echo=False>>=\n'
+                'import sys\n'
+                'print "to stdout"\n'
+                'print >>sys.stderr, "to stderr"\n'
+                '@\n')
+        woven, counts = self.weave(text)
+        self.assertFalse('to stderr' in woven)
+        woven, counts = self.weave(text, '--capture', 'stderr')
+        self.assertTrue('to stderr' in woven)
+
+class CatchUpTest(CacheTestCase):
+    "Replayed blocks must be executed before a block depending on them."
+
+    def test_replayed_blocks_are_executed(self):
+        template = ('<<>>=\nx = 20\n@\n'
+                    '<<>>=\ny = x + 1\n@\n'
+                    '<<echo=False>>=\nprint "value", %s\n@\n')
+        self.weave(template % 'y')
+        text, counts = self.weave(template % '2 * y')
+        self.assertTrue('value 42' in text)
+        self.assertEqual(counts, (2, 1))
+
+    def test_checkpoint(self):
+        template = ('<<>>=\nx = 20\n@\n'
+                    '<<echo=False>>=\nprint "value", %s\n@\n')
+        self.weave(template % 'x', '--checkpoint')
+        text, counts = self.weave(template % '2 * x + 2', '--checkpoint')
+        self.assertTrue('value 42' in text)
+
+    def test_checkpoint_with_open_figures(self):
+        # the checkpoint after the first block would lack its figure
+        template = ('<<>>=\nimport matplotlib.pyplot as plt\n'
+                    'plt.plot([1, 5, 2, 8])\n@\n'
+                    '<<fig=True, echo=False>>=\nplt.title("%s")\n'
+                    'print "lines", len(plt.gca().lines)\n@\n')
+        self.weave(template % 'one', '--checkpoint')
+        text, counts = self.weave(template % 'two', '--checkpoint')
+        self.assertTrue('lines 1' in text)
+
+class CodeFingerprintTest(PweaveTestCase):
+    "Editing a processor's module must invalidate its cached results."
+
+    def fingerprint(self):
+        module = imp.load_source('cache_test_processor',
+                                 self.path('processor.py'))
+        cache = pweave.ChunkCache(self.path('cache'), 1024,
+                                  {'sourcefile_path': self.path('doc')})
+        return cache.code_fingerprint(module.Processor())
+
+    def test_edited_module(self):
+        self.write('processor.py', 'class Processor(object):\n    pass\n')
+        before = self.fingerprint()
+        self.assertEqual(self.fingerprint(), before)
+        self.write('processor.py', 'class Processor(object):\n'
+                                   '    "Edited."\n')
+        self.assertNotEqual(self.fingerprint(), before)
+
+class EvictionTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        self.cache = pweave.ChunkCache(self.path('cache'), 2500,
+                                       {'sourcefile_path': self.path('doc')})
+
+    def store(self, key, age):
+        "Store an entry of about 1000 bytes which was last used *age* ago."
+        self.cache.store(key, 'x' * 1000)
+        self.cache.index[key + '.pickle'][1] -= age
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.store('a', 20)
+        self.store('b', 10)
+        self.store('c', 0)
+        self.assertEqual(self.cache.load('a'), None)
+        self.assertFalse(os.path.exists(self.cache.entry_path('a')))
+        self.assertEqual(self.cache.load('b'), 'x' * 1000)
+        self.assertEqual(self.cache.index.total_size,
+                         sum(size for size, atime in
+                             self.cache.index.values()))
+        self.assertTrue(self.cache.index.total_size <= 2500)
+
+    def test_loading_marks_entries_as_used(self):
+        self.store('a', 20)
+        self.store('b', 10)
+        self.cache.load('a')
+        self.store('c', 0)
+        self.assertEqual(self.cache.load('a'), 'x' * 1000)
+        self.assertEqual(self.cache.load('b'), None)
+
+if __name__ == "__main__":
+    unittest.main()
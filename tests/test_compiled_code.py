@@ -0,0 +1,111 @@
+"""
+Tests of compiling executed code once (see CompiledCodeCache and
+execute_code()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import sys
+import hashlib
+import unittest
+import StringIO
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+class CompileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = pweave.CompiledCodeCache()
+
+    def test_modes(self):
+        self.assertEqual(self.cache.compile('  1 + 1\n')[0], 'eval')
+        self.assertEqual(self.cache.compile('x = 1\n')[0], 'exec')
+        self.assertEqual(self.cache.compile('print 1\n')[0], 'exec')
+
+    def test_compiled_once(self):
+        first = self.cache.compile('x = 1\n')
+        self.assertTrue(self.cache.compile('x = 1\n') is first)
+        self.assertEqual(len(self.cache.code), 1)
+
+    def test_export_used(self):
+        self.cache.compile('x = 1\n')
+        other = pweave.CompiledCodeCache()
+        other.import_marshalled(self.cache.export_used())
+        self.assertEqual(other.code.keys(), self.cache.code.keys())
+        # imported code is used by the importing process too
+        self.assertEqual(other.used, set(other.code))
+
+class SaveTest(PweaveTestCase):
+
+    def test_save_and_load(self):
+        cache = pweave.CompiledCodeCache()
+        cache.compile('x = 1\n')
+        cache.save(self.path('code'))
+        cache.compile('y = 2\n')
+
+        loaded = pweave.CompiledCodeCache()
+        loaded.load(self.path('code'))
+        self.assertEqual(len(loaded.code), 1)
+        mode, code = loaded.compile('x = 1\n')
+        namespace = {}
+        exec code in namespace
+        self.assertEqual(namespace['x'], 1)
+        self.assertEqual(os.listdir(self.directory), ['code'])
+
+    def test_only_used_code_is_saved(self):
+        cache = pweave.CompiledCodeCache()
+        cache.compile('x = 1\n')
+        cache.save(self.path('code'))
+        cache.load(self.path('code'))
+        cache.compile('y = 2\n')
+        cache.save(self.path('code'))
+        loaded = pweave.CompiledCodeCache()
+        loaded.load(self.path('code'))
+        self.assertEqual(loaded.code.keys(),
+                         [hashlib.sha1('y = 2\n').hexdigest()])
+
+    def test_unreadable_file(self):
+        self.write('code', 'not marshalled code')
+        cache = pweave.CompiledCodeCache()
+        cache.load(self.path('code'))
+        cache.load(self.path('missing'))
+        self.assertEqual(cache.code, {})
+
+class ExecuteTest(unittest.TestCase):
+
+    def test_expression_value_is_printed(self):
+        self.assertEqual(pweave.execute_code('  6 * 7\n', {}), '42\n')
+        self.assertEqual(pweave.execute_code('x = 6 * 7\n', {}), '')
+
+    def test_failing_expression_is_executed_once(self):
+        namespace = {'calls': []}
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertRaises(ZeroDivisionError, pweave.execute_code,
+                              'calls.append(1) or 1 / 0', namespace)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(namespace['calls'], [1])
+
+class CachedCodeTest(PweaveTestCase):
+
+    def test_code_file_in_cache(self):
+        self.write('doc.tex_pweave', '<<>>=\nx = 1\n@\n<<>>=\nx\n@\n')
+        self.run_pweave('--cache', 'doc.tex_pweave')
+        suffix = pweave.CompiledCodeCache.file_suffix
+        names = [name for name in os.listdir(self.path('.pweave_cache'))
+                 if name.endswith(suffix)]
+        self.assertEqual(len(names), 1)
+        cache = pweave.CompiledCodeCache()
+        cache.load(self.path('.pweave_cache/' + names[0]))
+        self.assertEqual(sorted(mode for mode, code in
+                                cache.code.itervalues()), ['eval', 'exec'])
+
+if __name__ == "__main__":
+    unittest.main()
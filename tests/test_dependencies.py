@@ -0,0 +1,167 @@
+"""
+Tests of the analysis of the names used by code-blocks (see NameCollector),
+and of the chunk cache's use of it with --analyze-dependencies.
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import random
+import unittest
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+def resolve(codeblocks):
+    "Return the resolved (reads, writes) of each of the *codeblocks*."
+    deferred = {}
+    return [pweave.resolve_names(pweave.analyze_code(code), deferred)
+            for code in codeblocks]
+
+class NameAnalysisTest(unittest.TestCase):
+
+    def test_mutated_global_is_not_local(self):
+        names = pweave.analyze_code('def f():\n'
+                                    '    L.append(1)\n'
+                                    '    L[0] = 2\n'
+                                    '    return len(L)\n')
+        self.assertEqual(names.reads, set())
+        self.assertEqual(names.writes, set(['f']))
+        self.assertTrue('L' in names.deferred_reads)
+        self.assertTrue('L' in names.deferred_writes)
+
+    def test_bound_names_are_local(self):
+        names = pweave.analyze_code('def f(a, b=c, *args, **kwargs):\n'
+                                    '    x = a\n'
+                                    '    for i in args: x += i\n'
+                                    '    import os\n'
+                                    '    return x, b, os, kwargs\n')
+        self.assertEqual(names.reads, set(['c']))
+        self.assertEqual(names.deferred_reads, set())
+        self.assertEqual(names.deferred_writes, set())
+
+    def test_declared_global_is_written(self):
+        names = pweave.analyze_code('def f():\n'
+                                    '    global N\n'
+                                    '    N = 1\n')
+        self.assertTrue('N' in names.deferred_writes)
+
+    def test_call_reads_free_names(self):
+        reads, writes = resolve(['def g():\n    return N\n',
+                                 'N = 1\n',
+                                 'print g()\n'])[2]
+        self.assertEqual(reads, set(['g', 'N']))
+
+    def test_call_writes_mutated_names(self):
+        reads, writes = resolve(['L = []\n',
+                                 'def f():\n    L.append(1)\n',
+                                 'f()\n'])[2]
+        self.assertTrue('L' in reads)
+        self.assertTrue('L' in writes)
+
+    def test_call_arguments_are_written(self):
+        names = pweave.analyze_code('f(L, M[0], key=D.get, *args, **kw)\n'
+                                    'g(1, x + y)\n')
+        self.assertEqual(names.writes, set(['L', 'M', 'D', 'args', 'kw']))
+
+    def test_nested_calls_and_derived_values(self):
+        reads, writes = resolve(['def g():\n    return N\n',
+                                 'def f():\n    return g()\n',
+                                 'h = f\n',
+                                 'print h()\n'])[3]
+        self.assertTrue('N' in reads)
+
+    def test_class_methods(self):
+        reads, writes = resolve(['class C(object):\n'
+                                 '    size = K\n'
+                                 '    def m(self):\n'
+                                 '        return N\n',
+                                 'c = C()\n',
+                                 'print c.m()\n'])[2]
+        self.assertTrue('N' in reads)
+
+class PartitionTest(unittest.TestCase):
+
+    def test_function_and_its_free_names_are_not_split(self):
+        blocks = [{'namespace': 'default', 'codeblock': code} for code in
+                  ['def g():\n    return N\n', 'N = 1\n', 'print g()\n',
+                   'x = 1\n']]
+        self.assertEqual(pweave.partition_blocks(blocks, True),
+                         [[0, 1, 2], [3]])
+
+    def test_mutation_through_function_call(self):
+        blocks = [{'namespace': 'default', 'codeblock': code} for code in
+                  ['L = []\n', 'def add(x):\n    x.append(1)\n',
+                   'add(L)\n', 'x = 1\n', 'print L\n']]
+        self.assertEqual(pweave.partition_blocks(blocks, True),
+                         [[0, 1, 2, 4], [3]])
+
+    def test_mutation_of_global_in_function(self):
+        blocks = [{'namespace': 'default', 'codeblock': code} for code in
+                  ['L = []\n', 'def f():\n    L.append(1)\n',
+                   'x = 1\n', 'f()\n', 'print L\n']]
+        self.assertEqual(pweave.partition_blocks(blocks, True),
+                         [[0, 1, 3, 4], [2]])
+
+class CacheDependencyTest(PweaveTestCase):
+    "Edited blocks must not leave stale results of the blocks using them."
+
+    def weave(self, text, *args):
+        self.write('doc.tex_pweave', text)
+        self.run_pweave('--cache', '--analyze-dependencies',
+                        *args + ('doc.tex_pweave',))
+        return self.read('doc.tex')
+
+    def test_function_mutating_global(self):
+        template = ('<<>>=\nL = %s\n@\n'
+                    '<<>>=\ndef f():\n    L.append(1)\n    return len(L)\n@\n'
+                    '<<echo=False>>=\nprint "length", f()\n@\n')
+        self.assertTrue('length 1' in self.weave(template % '[]'))
+        self.assertTrue('length 2' in self.weave(template % '[0]'))
+
+    def test_function_reading_later_global(self):
+        template = ('<<>>=\ndef g():\n    return N\n@\n'
+                    '<<>>=\nN = %d\n@\n'
+                    '<<echo=False>>=\nprint "value", g()\n@\n')
+        self.assertTrue('value 1' in self.weave(template % 1))
+        self.assertTrue('value 2' in self.weave(template % 2))
+
+    def test_function_mutating_argument(self):
+        template = ('<<>>=\nL = []\n@\n'
+                    '<<>>=\ndef add(x):\n    x.append(%d)\n@\n'
+                    '<<>>=\nadd(L)\n@\n'
+                    '<<echo=False>>=\nprint "L is", L\n@\n')
+        self.assertTrue('L is [1]' in self.weave(template % 1))
+        self.assertTrue('L is [2]' in self.weave(template % 2))
+
+    def test_module_state_changed_by_method_call(self):
+        template = ('<<>>=\nimport random\nL = range(10)\n@\n'
+                    '<<>>=\nrandom.seed(%d)\n@\n'
+                    '<<>>=\nrandom.shuffle(L)\n@\n'
+                    '<<echo=False>>=\nprint "L is", L\n@\n')
+        for seed in [1, 2]:
+            random.seed(seed)
+            expected = range(10)
+            random.shuffle(expected)
+            self.assertTrue('L is %r' % expected in
+                            self.weave(template % seed))
+
+    def test_parallel_partitions(self):
+        text = ('<<>>=\ndef g():\n    return N\n@\n'
+                '<<>>=\nN = 1\n@\n'
+                '<<echo=False>>=\nprint "value", g()\n@\n')
+        self.assertTrue('value 1' in self.weave(text, '--jobs', '2'))
+
+    def test_parallel_mutation_through_function_call(self):
+        text = ('<<>>=\nL = []\n@\n'
+                '<<>>=\ndef add(x):\n    x.append(1)\n@\n'
+                '<<>>=\ndef f():\n    L.append(2)\n@\n'
+                '<<>>=\nadd(L)\nf()\n@\n'
+                '<<>>=\nx = 1\n@\n'
+                '<<echo=False>>=\nprint "L is", L\n@\n')
+        self.assertTrue('L is [1, 2]' in self.weave(text, '--jobs', '2'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+Tests of processing code-blocks on executors (see --executor,
+ThreadExecutor, ProcessExecutor and run_in_threads()).  The 'socket'
+executor is tested with the server, in test_server.py.
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import unittest
+import threading
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+# blocks of two namespaces, each of which waits for the other one to start;
+# run at the same time, both print True.  The events are shared through the
+# sys module (dict.setdefault() is atomic).
+rendezvous_document = '''<<p=%(p)s, echo=False, namespace=first>>=
+import sys, threading
+first, second = sys.__dict__.setdefault('rendezvous',
+                                        (threading.Event(), threading.Event()))
+first.set()
+print "first", second.wait(%(wait)s)
+@
+<<p=%(p)s, echo=False, namespace=second>>=
+import sys, threading
+first, second = sys.__dict__.setdefault('rendezvous',
+                                        (threading.Event(), threading.Event()))
+second.set()
+print "second", first.wait(%(wait)s)
+@
+'''
+
+# a processor of which only one block is processed at a time
+serial_plugin = '''
+import __main__ as pweave
+
+class SerialProcessor(pweave.DefaultProcessor):
+    max_concurrency = 1
+
+    def name(self):
+        return 'serial'
+'''
+
+# blocks of several namespaces, which each print what they have seen
+namespaces_document = ''.join('''<<namespace=%s>>=
+seen = globals().get('seen', []) + [%d]
+print seen
+@
+text %d
+''' % ('abc'[i % 3], i, i) for i in range(9))
+
+class RunInThreadsTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        self.assertEqual(pweave.run_in_threads(3, lambda x: x * 2,
+                                               [(i,) for i in range(10)]),
+                         [i * 2 for i in range(10)])
+        self.assertEqual(pweave.run_in_threads(3, lambda: 1, []), [])
+
+    def test_concurrent_calls(self):
+        events = [threading.Event(), threading.Event()]
+        def meet(i):
+            events[i].set()
+            return events[1 - i].wait(5)
+        self.assertEqual(pweave.run_in_threads(2, meet, [(0,), (1,)]),
+                         [True, True])
+
+    def test_jobs_limit_threads(self):
+        threads = set()
+        def record():
+            threads.add(threading.current_thread())
+        pweave.run_in_threads(2, record, [()] * 10)
+        self.assertTrue(len(threads) <= 2)
+
+    def test_exception(self):
+        def fail(i):
+            if i == 3:
+                raise ValueError(i)
+        self.assertRaises(ValueError, pweave.run_in_threads, 2, fail,
+                          [(i,) for i in range(5)])
+
+class ExecutorTest(PweaveTestCase):
+
+    def weave(self, document, *args):
+        self.write('doc.tex_pweave', document)
+        self.run_pweave(*args + ('doc.tex_pweave',))
+        return self.read('doc.tex')
+
+    def weave_rendezvous(self, processor, wait, *args):
+        return self.weave(rendezvous_document % {'p': processor,
+                                                 'wait': wait}, *args)
+
+    def test_same_output(self):
+        inline = self.weave(namespaces_document)
+        for executor in ['thread', 'process']:
+            self.assertEqual(self.weave(namespaces_document, '--executor',
+                                        executor, '--jobs', '3'), inline)
+
+    def test_threads_share_the_process(self):
+        document = self.weave_rendezvous('default', 10, '--executor', 'thread',
+                                         '--jobs', '2')
+        self.assertTrue('first True' in document)
+        self.assertTrue('second True' in document)
+
+    def test_inline_processes_one_block_at_a_time(self):
+        document = self.weave_rendezvous('default', 0.1)
+        self.assertTrue('first False' in document)
+
+    def test_max_concurrency(self):
+        os.mkdir(self.path('plugins'))
+        self.write('plugins/serial.py', serial_plugin)
+        document = self.weave_rendezvous('serial', 0.5, '--executor', 'thread',
+                                         '--jobs', '2',
+                                         '-p', self.path('plugins'))
+        self.assertTrue('False' in document)
+        self.assertTrue('True' in document)
+
+class ConcurrencyLimitsTest(unittest.TestCase):
+
+    def test_limits(self):
+        class Processor(object):
+            max_concurrency = None
+        class SerialProcessor(object):
+            max_concurrency = 1
+        blocks = [{'codeprocessor': Processor(), 'processor_name': 'default'},
+                  {'codeprocessor': SerialProcessor(),
+                   'processor_name': 'serial'}]
+        self.assertEqual(pweave.concurrency_limits(blocks), {'serial': 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Tests of saving figures (see FigureRenderer and write_figure()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import pickle
+import unittest
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+# a document drawing a figure
+figure_document = """<<fig=True, echo=False>>=
+import matplotlib.pyplot as plt
+plt.plot([1, 2, 3], [%s])
+@
+"""
+
+def make_figure(ys):
+    "Return a new matplotlib figure of a line through *ys*."
+    figure = pweave.get_pyplot().figure()
+    figure.gca().plot(range(len(ys)), ys)
+    return figure
+
+class FigureTestCase(PweaveTestCase):
+
+    def tearDown(self):
+        pweave.close_figures()
+        PweaveTestCase.tearDown(self)
+
+    def figure_data(self, figure, filename):
+        "Return the contents of *figure* saved as *filename*."
+        figure.savefig(self.path(filename))
+        return open(self.path(filename), 'rb').read()
+
+class BackgroundTest(FigureTestCase):
+
+    def test_rendered_in_background(self):
+        figure = make_figure([1, 3, 2])
+        expected = self.figure_data(figure, 'expected.png')
+        renderer = pweave.FigureRenderer(jobs=2)
+        renderer.save(figure, self.path('Fig1.png'), {})
+        self.assertTrue(renderer.is_pending([self.path('Fig1.png')]))
+        # the figure was pickled when it was saved
+        figure.gca().plot([0, 1], [1, 0])
+        renderer.finish()
+        self.assertFalse(renderer.is_pending([self.path('Fig1.png')]))
+        self.assertEqual(self.read('Fig1.png'), expected)
+        self.assertTrue(os.path.exists(self.path(
+                                    pweave.FigureRenderer.manifest_name)))
+
+    def test_wait_for_one_figure(self):
+        renderer = pweave.FigureRenderer(jobs=1)
+        renderer.save(make_figure([1, 2]), self.path('Fig1.png'), {})
+        renderer.save(make_figure([2, 1]), self.path('Fig2.png'), {})
+        renderer.wait([self.path('Fig1.png')])
+        self.assertTrue(os.path.exists(self.path('Fig1.png')))
+        self.assertFalse(renderer.is_pending([self.path('Fig1.png')]))
+        renderer.finish()
+        self.assertTrue(os.path.exists(self.path('Fig2.png')))
+
+    def test_same_document(self):
+        self.write('doc.tex_pweave', figure_document % '3, 1, 2')
+        self.run_pweave('doc.tex_pweave')
+        document = self.read('doc.tex')
+        digest = pweave.figure_digest(self.read('pweave_images/Fig1.pdf'))
+        os.remove(self.path('pweave_images/Fig1.pdf'))
+        self.run_pweave('--render-jobs', '2', 'doc.tex_pweave')
+        self.assertEqual(self.read('doc.tex'), document)
+        self.assertEqual(pweave.figure_digest(self.read(
+                                    'pweave_images/Fig1.pdf')), digest)
+
+class DigestTest(FigureTestCase):
+
+    def test_dates_are_ignored(self):
+        figure = make_figure([1, 2])
+        first = self.figure_data(figure, 'first.pdf')
+        second = first.replace('/CreationDate (D:2', '/CreationDate (D:1')
+        self.assertNotEqual(first, second)
+        self.assertEqual(pweave.figure_digest(first),
+                         pweave.figure_digest(second))
+        data = self.figure_data(figure, 'first.ps')
+        self.assertEqual(pweave.figure_digest(data), pweave.figure_digest(
+                         data.replace('%%CreationDate: ', '%%CreationDate: x')))
+
+    def test_unchanged_figure_is_not_written(self):
+        filename = self.path('Fig1.pdf')
+        entry = pweave.write_figure(make_figure([1, 2]), filename, {})
+        os.utime(filename, (0, 0))
+        pweave.write_figure(make_figure([1, 2]), filename, {})
+        self.assertEqual(os.stat(filename).st_mtime, 0)
+        pweave.write_figure(make_figure([2, 1]), filename, {})
+        self.assertNotEqual(os.stat(filename).st_mtime, 0)
+        self.assertNotEqual(pweave.write_figure(make_figure([2, 1]),
+                                                filename, {}), entry)
+
+    def test_recorded_digest_is_trusted(self):
+        filename = self.path('Fig1.png')
+        entry = pweave.write_figure(make_figure([1, 2]), filename, {})
+        data = self.read('Fig1.png')
+        self.write('Fig1.png', 'garbage')
+        # a file with the recorded signature isn't read
+        previous = (entry[0], pweave.file_signature(filename))
+        pweave.write_figure(make_figure([1, 2]), filename, {}, previous)
+        self.assertEqual(self.read('Fig1.png'), 'garbage')
+        pweave.write_figure(make_figure([1, 2]), filename, {}, entry)
+        self.assertEqual(self.read('Fig1.png'), data)
+
+    def test_unchanged_figure_in_document(self):
+        self.write('doc.tex_pweave', figure_document % '3, 1, 2')
+        self.run_pweave('doc.tex_pweave')
+        os.utime(self.path('pweave_images/Fig1.pdf'), (0, 0))
+        self.run_pweave('doc.tex_pweave')
+        self.assertEqual(os.stat(self.path(
+                                'pweave_images/Fig1.pdf')).st_mtime, 0)
+        self.write('doc.tex_pweave', figure_document % '3, 2, 1')
+        self.run_pweave('doc.tex_pweave')
+        self.assertNotEqual(os.stat(self.path(
+                                'pweave_images/Fig1.pdf')).st_mtime, 0)
+
+class ManifestTest(PweaveTestCase):
+
+    def test_manifest_is_replaced(self):
+        renderer = pweave.FigureRenderer()
+        renderer.record(self.path('Fig1.png'), ('digest', (10, 1.0)))
+        renderer.save_manifests()
+        renderer.record(self.path('Fig2.png'), ('digest', (20, 2.0)))
+        renderer.save_manifests()
+        self.assertEqual(os.listdir(self.directory),
+                         [pweave.FigureRenderer.manifest_name])
+        manifest = pickle.load(open(self.path(
+                                    pweave.FigureRenderer.manifest_name)))
+        self.assertEqual(sorted(manifest), ['Fig1.png', 'Fig2.png'])
+
+if __name__ == "__main__":
+    unittest.main()
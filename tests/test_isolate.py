@@ -0,0 +1,134 @@
+"""
+Tests of executing code-blocks in worker processes with time and memory
+limits (see ExecutionEngine and --isolate).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import unittest
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+class ExecutionEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = pweave.ExecutionEngine()
+        self.namespace = pweave.RemoteNamespace(self.engine, 'default')
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def test_namespace_is_kept(self):
+        self.assertEqual(self.namespace.execute('x = 6\n'), '')
+        self.assertEqual(self.namespace.execute('print x * 7\n'), '42\n')
+        self.assertEqual(self.namespace['x'], 6)
+        self.assertTrue('x' in self.namespace)
+        other = pweave.RemoteNamespace(self.engine, 'other')
+        self.assertFalse('x' in other)
+
+    def test_worker_process(self):
+        pid = int(self.namespace.execute('import os\nprint os.getpid()\n'))
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(self.engine.workers['default'][0], pid)
+
+    def test_exception(self):
+        self.assertRaises(pweave.RemoteExecutionError,
+                          self.namespace.execute, '1 / 0\n')
+        self.assertEqual(self.namespace.execute('print 1\n'), '1\n')
+
+    def test_timeout(self):
+        self.namespace.execute('x = 1\n')
+        self.assertRaises(pweave.ChunkKilled, self.namespace.execute,
+                          'while True: pass\n', timeout=0.5)
+        self.assertFalse('default' in self.engine.workers)
+        # the namespace was lost with its worker
+        try:
+            self.namespace.execute('print x\n')
+        except pweave.ChunkKilled, e:
+            self.assertTrue('was lost' in str(e))
+        else:
+            self.fail('ChunkKilled not raised')
+        self.assertEqual(self.engine.kills, 2)
+
+    def test_memlimit(self):
+        self.namespace.execute('x = 1\n')
+        self.assertRaises(pweave.ChunkKilled, self.namespace.execute,
+                          'y = " " * (500 * 2**20)\n', memlimit=100)
+        # the namespace is kept
+        self.assertEqual(self.namespace.execute('print x\n', memlimit=100),
+                         '1\n')
+        self.assertFalse('y' in self.namespace)
+
+    def test_stopped_namespace_is_usable_again(self):
+        self.assertRaises(pweave.ChunkKilled, self.namespace.execute,
+                          'while True: pass\n', timeout=0.5)
+        self.engine.stop('default')
+        self.assertEqual(self.namespace.execute('print 1\n'), '1\n')
+
+class LimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        pweave.settings['timeout'] = 10
+        pweave.settings['memlimit'] = None
+
+    def tearDown(self):
+        pweave.settings.clear()
+
+    def test_limits(self):
+        self.assertEqual(pweave.execution_limits({}), (10.0, None))
+        self.assertEqual(pweave.execution_limits({'timeout': '2.5',
+                                                  'memlimit': '100'}),
+                         (2.5, 100.0))
+
+    def test_no_limit(self):
+        self.assertEqual(pweave.execution_limits({'timeout': '0'}),
+                         (None, None))
+        self.assertEqual(pweave.execution_limits({'timeout': 'none'}),
+                         (None, None))
+
+class IsolateTest(PweaveTestCase):
+
+    def test_stopped_blocks(self):
+        self.write('doc.tex_pweave',
+                   '<<echo=False>>=\nx = 1\n@\n'
+                   '<<echo=False, timeout=0.5>>=\nwhile True: pass\n@\n'
+                   '<<echo=False>>=\nprint "same namespace", x\n@\n'
+                   '<<echo=False, namespace=other>>=\n'
+                   'print "other namespace"\n@\n'
+                   '<<echo=False, namespace=big, memlimit=100>>=\n'
+                   'y = " " * (500 * 2**20)\n@\n'
+                   '<<echo=False, namespace=big>>=\n'
+                   'print "kept namespace"\n@\n')
+        output = self.run_pweave('--isolate', 'doc.tex_pweave')
+        self.assertTrue('WARNING: code-block stopped' in output)
+        document = self.read('doc.tex')
+        self.assertTrue('PWEAVE ERROR: code-block stopped: exceeded the '
+                        'time limit of 0.5 s' in document)
+        self.assertTrue("namespace 'default' was lost" in document)
+        self.assertFalse('same namespace' in document)
+        self.assertTrue('other namespace' in document)
+        self.assertTrue('exceeded the memory limit of 100 MB' in document)
+        self.assertTrue('kept namespace' in document)
+
+    def test_timeout_option_isolates(self):
+        self.write('doc.tex_pweave', '<<echo=False>>=\nimport os\n'
+                                     'print "parent", os.getppid()\n@\n')
+        self.run_pweave('doc.tex_pweave')
+        self.assertTrue('parent %d' % os.getpid() in self.read('doc.tex'))
+        # the block is executed by a worker of the pweave process
+        self.run_pweave('--timeout', '10', 'doc.tex_pweave')
+        self.assertFalse('parent %d' % os.getpid() in self.read('doc.tex'))
+
+    def test_limits_need_isolate(self):
+        self.write('doc.tex_pweave', '<<echo=False, timeout=10>>=\n'
+                                     'print 1\n@\n')
+        output = self.run_pweave('doc.tex_pweave')
+        self.assertTrue('only enforced with --isolate' in output)
+
+if __name__ == "__main__":
+    unittest.main()
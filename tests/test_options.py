@@ -0,0 +1,109 @@
+"""
+Tests of block-option parsing (see parse_options(), get_options() and
+BlockOptions).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import sys
+import pickle
+import unittest
+import StringIO
+
+from support import load_pweave
+
+pweave = load_pweave()
+
+class ParseTest(unittest.TestCase):
+
+    def test_pairs(self):
+        self.assertEqual(pweave.parse_options('echo=False, fig = True'),
+                         {'p': 'default', 'echo': 'False', 'fig': 'True'})
+
+    def test_block_name(self):
+        self.assertEqual(pweave.parse_options('results, echo=False'),
+                         {'p': 'default', '__pweave_block_name': 'results',
+                          'echo': 'False'})
+        self.assertEqual(pweave.parse_options('results'),
+                         {'p': 'default', '__pweave_block_name': 'results'})
+
+    def test_processor(self):
+        self.assertEqual(pweave.parse_options('p=table')['p'], 'table')
+
+    def test_quoted_values(self):
+        options = pweave.parse_options('caption="a, b = c", label=x')
+        self.assertEqual(options['caption'], 'a, b = c')
+        self.assertEqual(options['label'], 'x')
+
+    def test_commented_out_block(self):
+        options = pweave.parse_options('#echo=False')
+        self.assertTrue(options['__pweave_do_not_process'])
+        self.assertFalse('echo' in options)
+
+    def test_empty(self):
+        self.assertEqual(pweave.parse_options(''), {'p': 'default'})
+
+class BlockOptionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.options = pweave.parse_options('echo=False')
+
+    def test_immutable(self):
+        options = self.options
+        self.assertRaises(TypeError, options.__setitem__, 'echo', 'True')
+        self.assertRaises(TypeError, options.__delitem__, 'echo')
+        self.assertRaises(TypeError, options.update, {'fig': 'True'})
+        self.assertRaises(TypeError, options.setdefault, 'fig', 'True')
+        self.assertRaises(TypeError, options.pop, 'echo')
+        self.assertRaises(TypeError, options.popitem)
+        self.assertRaises(TypeError, options.clear)
+        self.assertEqual(options, {'p': 'default', 'echo': 'False'})
+
+    def test_copy_is_mutable(self):
+        options = dict(self.options)
+        options['echo'] = 'True'
+        self.assertEqual(self.options['echo'], 'False')
+
+    def test_pickle(self):
+        options = pickle.loads(pickle.dumps(self.options, 2))
+        self.assertTrue(isinstance(options, pweave.BlockOptions))
+        self.assertEqual(options, self.options)
+
+class GetOptionsTest(unittest.TestCase):
+
+    def setUp(self):
+        pweave.parsed_options.clear()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_memoized(self):
+        options = pweave.get_options('echo=False')
+        self.assertTrue(pweave.get_options('echo=False') is options)
+
+    def test_least_recently_used_are_forgotten(self):
+        size = pweave.parsed_options_size
+        first = pweave.get_options('n=0')
+        for i in range(1, size):
+            pweave.get_options('n=%d' % i)
+        # using the first string again keeps it
+        pweave.get_options('n=0')
+        pweave.get_options('n=%d' % size)
+        self.assertEqual(len(pweave.parsed_options), size)
+        self.assertTrue(pweave.get_options('n=0') is first)
+        self.assertFalse('n=1' in pweave.parsed_options)
+
+    def test_unparseable_options_warn_every_time(self):
+        for i in range(3):
+            options = pweave.get_options('echo=False, junk')
+            self.assertEqual(options['echo'], 'False')
+            self.assertEqual(options.unparsed, ' junk')
+        self.assertEqual(sys.stdout.getvalue().count('unparseable'), 3)
+        self.assertFalse('echo=False, junk' in pweave.parsed_options)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of finding plugin processors without importing them (see
+index_plugins() and ProcessorRegistry).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import unittest
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+plugin_text = '''
+class %sProcessor(object):
+    def name(self):
+        return %r
+'''
+
+class IndexTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        self.plugin_index_dir = pweave.plugin_index_dir
+        pweave.plugin_index_dir = self.path('index')
+        os.mkdir(self.path('plugins'))
+        os.mkdir(self.path('other'))
+
+    def tearDown(self):
+        pweave.plugin_index_dir = self.plugin_index_dir
+        PweaveTestCase.tearDown(self)
+
+    def write_plugin(self, filename, processor_name):
+        self.write(filename, plugin_text % (processor_name.capitalize(),
+                                            processor_name))
+
+    def test_index_per_list_of_directories(self):
+        self.write_plugin('plugins/first.py', 'first')
+        self.write_plugin('other/second.py', 'second')
+        directories = [self.path('plugins'), self.path('other')]
+        self.assertEqual(pweave.index_plugins(directories),
+                         [('first', ['first']), ('second', ['second'])])
+        self.assertEqual(pweave.index_plugins(directories[:1]),
+                         [('first', ['first'])])
+        self.assertEqual(sorted(os.listdir(self.path('index'))),
+                         sorted(os.path.basename(
+                                    pweave.plugin_index_path(d))
+                                for d in [directories, directories[:1]]))
+        # nothing is written next to the plugins
+        self.assertEqual(os.listdir(self.path('plugins')), ['first.py'])
+
+    def test_edited_plugin(self):
+        directories = [self.path('plugins')]
+        self.write_plugin('plugins/first.py', 'first')
+        pweave.index_plugins(directories)
+        self.write_plugin('plugins/first.py', 'renamed')
+        self.assertEqual(pweave.index_plugins(directories),
+                         [('first', ['renamed'])])
+
+    def test_first_module_of_a_name_is_used(self):
+        self.write_plugin('plugins/first.py', 'first')
+        self.write_plugin('other/first.py', 'shadowed')
+        self.assertEqual(pweave.index_plugins([self.path('plugins'),
+                                               self.path('other')]),
+                         [('first', ['first'])])
+
+if __name__ == "__main__":
+    unittest.main()
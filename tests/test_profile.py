@@ -0,0 +1,126 @@
+"""
+Tests of the per-block profile (see Profiler and --profile).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import json
+import time
+import unittest
+import threading
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+# a quick block, a block sleeping for a while and a figure block
+profiled_document = '''<<>>=
+x = 1
+@
+text
+<<>>=
+import time
+time.sleep(0.2)
+@
+<<fig=True, echo=False>>=
+import matplotlib.pyplot as plt
+plt.plot([1, 2])
+@
+'''
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = pweave.Profiler()
+
+    def test_block_records(self):
+        profiler = self.profiler
+        profiler.start_block('first', (1, 3), 'default')
+        profiler.add('exec', 0.5)
+        profiler.add('exec', 0.25)
+        profiler.end_block()
+        profiler.start_block('second', None, 'table')
+        profiler.end_block(cached=True)
+        profiler.add('assembly', 1.0)
+
+        first, second = profiler.blocks
+        self.assertEqual((first['label'], first['first_line'],
+                          first['last_line'], first['processor']),
+                         ('first', 1, 3, 'default'))
+        self.assertEqual(first['exec'], 0.75)
+        self.assertFalse(first['cached'])
+        self.assertEqual(second['first_line'], None)
+        self.assertTrue(second['cached'])
+        self.assertEqual(profiler.totals['exec'], 0.75)
+        self.assertEqual(profiler.totals['assembly'], 1.0)
+        self.assertEqual(profiler.totals['blocks'],
+                         first['wall'] + second['wall'])
+
+    def test_report_lists_most_expensive_first(self):
+        for label, seconds in [('quick', 0), ('slow', 0.05)]:
+            self.profiler.start_block(label, None, 'default')
+            time.sleep(seconds)
+            self.profiler.end_block()
+        lines = self.profiler.report(1.0).splitlines()
+        self.assertTrue(lines[1].endswith('slow'))
+        self.assertTrue(lines[2].endswith('quick'))
+
+    def test_threads_record_their_own_blocks(self):
+        def record():
+            self.profiler.start_block('thread', None, 'default')
+            self.profiler.add('exec', 1.0)
+            self.profiler.end_block()
+        self.profiler.start_block('main', None, 'default')
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        self.profiler.add('exec', 2.0)
+        self.profiler.end_block()
+        self.assertEqual([(b['label'], b['exec'])
+                          for b in self.profiler.blocks],
+                         [('thread', 1.0), ('main', 2.0)])
+        self.assertEqual(self.profiler.totals['exec'], 3.0)
+
+class ProfileTest(PweaveTestCase):
+
+    def profile(self, *args):
+        "Weave profiled_document with --profile; return the output."
+        self.write('doc.tex_pweave', profiled_document)
+        return self.run_pweave('--profile', *args + ('doc.tex_pweave',))
+
+    def read_profile(self, filename='doc.profile.json'):
+        return json.load(open(self.path(filename)))
+
+    def test_report(self):
+        output = self.profile()
+        self.assertTrue('Wall [s]' in output)
+        self.assertTrue('Profile written to' in output)
+        profile = self.read_profile()
+        self.assertEqual(profile['sourcefile'], self.path('doc.tex_pweave'))
+        blocks = profile['blocks']
+        self.assertEqual([(b['first_line'], b['last_line']) for b in blocks],
+                         [(1, 3), (5, 8), (9, 12)])
+        self.assertTrue(blocks[1]['wall'] >= 0.2)
+        self.assertTrue(blocks[1]['exec'] >= 0.2)
+        self.assertTrue(blocks[2]['savefig'] > 0)
+        self.assertTrue(profile['total_wall'] >= profile['totals']['blocks'])
+
+    def test_cached_blocks(self):
+        self.profile('--cache')
+        self.profile('--cache')
+        profile = self.read_profile()
+        self.assertEqual([b['cached'] for b in profile['blocks']],
+                         [True, True, True])
+        self.assertTrue(profile['blocks'][1]['wall'] < 0.2)
+
+    def test_parallel_blocks(self):
+        output = self.profile('--jobs', '2', '--profile-file', 'profile.json')
+        self.assertTrue('Profile written to profile.json' in output)
+        profile = self.read_profile('profile.json')
+        self.assertEqual(sorted(b['first_line'] for b in profile['blocks']),
+                         [1, 5, 9])
+
+if __name__ == "__main__":
+    unittest.main()
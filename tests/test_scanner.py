@@ -0,0 +1,130 @@
+"""
+Tests of reading and tokenizing source files (see iter_source_lines(),
+iter_chunks() and iter_preprocess()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import re
+import sys
+import unittest
+import StringIO
+
+from support import load_pweave, PweaveTestCase
+
+pweave = load_pweave()
+
+# size of the blocks in which python 2 file objects read ahead when iterated
+readahead_size = 8192
+
+def legacy_preprocess(input_text):
+    """The scanning loop of preprocess() before iter_chunks() existed.
+
+    Code-blocks are replaced by block_text() instead of being processed.
+
+    """
+    doc_pieces = []
+    code_pieces = []
+    state = 'text'
+    block = ''
+    for line in input_text.splitlines(True):
+        code = re.search('^<<(.*)>>=.*$', line.strip())
+        if code is not None:
+            state = 'code'
+            optionstring = code.group(1)
+            line = ''
+        if line.startswith('@'):
+            blockoptions = pweave.get_options(optionstring)
+            doc_pieces.append(block_text(blockoptions, block))
+            code_pieces.append(block)
+            block = ''
+            state = 'text'
+            line = ''
+        if state == 'code':
+            block = block + line
+        if state == 'text':
+            doc_pieces.append(line)
+    return ''.join(doc_pieces), ''.join(code_pieces)
+
+def block_text(blockoptions, codeblock):
+    return '[%r %r]' % (sorted(blockoptions.items()), codeblock)
+
+class Processor(object):
+    "Stands in for a code processor; blocks are deferred, not processed."
+    namespace_name = 'default'
+
+    def block_inputs(self, blockoptions):
+        return []
+
+class StreamingTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        pweave.settings['imgfolder_path'] = self.directory
+
+    def preprocess_file(self, filename):
+        "Preprocess the file *filename* as it is read, like weave_and_tangle()."
+        blocks = []
+        doc_pieces = []
+        code_pieces = []
+        input_file = open(self.path(filename))
+        for document_text, code_text in pweave.iter_preprocess(
+                pweave.iter_source_lines(input_file),
+                {'default': Processor()}, deferred_blocks=blocks):
+            if isinstance(document_text, int):
+                block = blocks[document_text]
+                document_text = block_text(block['blockoptions'],
+                                           block['codeblock'])
+                code_text = block['codeblock']
+            doc_pieces.append(document_text)
+            code_pieces.append(code_text)
+        input_file.close()
+        return ''.join(doc_pieces), ''.join(code_pieces)
+
+    def test_read_boundaries_inside_markers(self):
+        pattern = ('Some text\r\n'
+                   '<<echo=False, caption="a, b">>=\n'
+                   'x = [1,\n     2]\n'
+                   '@\n'
+                   'A line\rwith a lone carriage return\n'
+                   '  <<name>>=  \n'
+                   'print x\n'
+                   '@ trailing text\n')
+        repeats = readahead_size // len(pattern) + 2
+        # shifting the pattern makes the first read end at each of its
+        # offsets, including those inside the '<<...>>=' and '@' lines
+        for shift in range(len(pattern)):
+            text = 'x' * shift + '\n' + pattern * repeats
+            self.write('doc.tex_pweave', text)
+            self.assertEqual(self.preprocess_file('doc.tex_pweave'),
+                             legacy_preprocess(text))
+
+    def test_long_runs_of_text(self):
+        text = ''.join('line %d\n' % i for i in range(2500)) + \
+               '<<>>=\nx = 1\n@\n' + 'last line'
+        self.write('doc.tex_pweave', text)
+        self.assertEqual(self.preprocess_file('doc.tex_pweave'),
+                         legacy_preprocess(text))
+
+class ChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        # iter_chunks() warns about the unterminated block
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_tokens(self):
+        lines = ['text\n', '<<a=1>>=\n', 'x = 1\n', '<<b=2>>=\n', 'y = 2\n',
+                 '@\n', 'more\n', '<<>>=\n', 'unterminated\n']
+        self.assertEqual(list(pweave.iter_chunks(lines)),
+                         [('text', None, 'text\n', (1, 1)),
+                          ('block', 'b=2', 'x = 1\ny = 2\n', (2, 6)),
+                          ('text', None, 'more\n', (7, 7))])
+
+if __name__ == "__main__":
+    unittest.main()
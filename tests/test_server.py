@@ -0,0 +1,81 @@
+"""
+Tests of the pweave server (see serve(), run_via_server() and
+SocketExecutor).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import sys
+import shutil
+import unittest
+import subprocess
+
+from support import pweave_path, plugin_dir, PweaveTestCase
+
+# prints the id of the process which executes the block's parent, i.e. of
+# the server if the block is processed in a process forked from it
+parent_document = '<<echo=False>>=\nimport os\nprint "parent", os.getppid()\n@\n'
+
+class ServerTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        self.socket_path = self.path('server')
+        self.server = subprocess.Popen([sys.executable, pweave_path,
+                                        '-p', plugin_dir, '--serve',
+                                        '--server-socket', self.socket_path],
+                                       cwd=self.directory,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        line = self.server.stdout.readline()
+        if not line.startswith('pweave server listening'):
+            self.server.kill()
+            self.fail('the server failed to start:\n' + line +
+                      self.server.stdout.read())
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        PweaveTestCase.tearDown(self)
+
+    def weave_parent(self, *args):
+        "Weave parent_document; return the output and the block's parent."
+        self.write('doc.tex_pweave', parent_document)
+        output = self.run_pweave('--server-socket', self.socket_path,
+                                 *args + ('doc.tex_pweave',))
+        parent = self.read('doc.tex').split('parent ')[1].split()[0]
+        return output, int(parent)
+
+    def test_request(self):
+        output, parent = self.weave_parent('--server')
+        self.assertEqual(parent, self.server.pid)
+        self.assertTrue('Output written to' in output)
+
+    def test_server_is_opt_in(self):
+        output, parent = self.weave_parent()
+        self.assertNotEqual(parent, self.server.pid)
+
+    def test_other_plugins_are_refused(self):
+        os.mkdir(self.path('plugins'))
+        for name in os.listdir(plugin_dir):
+            if name.endswith('.py'):
+                shutil.copy(os.path.join(plugin_dir, name),
+                            self.path('plugins'))
+        f = open(self.path('plugins/hello_world.py'), 'a')
+        f.write('\n# edited\n')
+        f.close()
+        output, parent = self.weave_parent('--server',
+                                           '-p', self.path('plugins'))
+        self.assertNotEqual(parent, self.server.pid)
+        self.assertTrue('runs another version' in output)
+
+    def test_socket_executor(self):
+        output, parent = self.weave_parent('--executor', 'socket',
+                                           '--jobs', '2')
+        self.assertEqual(parent, self.server.pid)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Tests of the table processor (see pweave_plugins/table_plugin.py).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import unittest
+
+from support import PweaveTestCase
+
+# a table of *n* rows, given by the block's code as *rows*
+table_document = '''<<p=table, caption=Numbers, %s>>=
+n = %d
+tablerows = %s
+@
+'''
+
+rows_as_list = '[[i / 4.0, i / 2.0] for i in range(n)]'
+rows_as_generator = '([i / 4.0, i / 2.0] for i in range(n))'
+rows_as_array = 'numpy.array([[i / 4.0, i / 2.0] for i in range(n)])'
+
+class TableTest(PweaveTestCase):
+
+    def weave_table(self, options, n, rows):
+        "Weave a document with a table, and return the output document."
+        self.write('doc.tex_pweave', '<<echo=False>>=\nimport numpy\n@\n' +
+                   table_document % (options, n, rows))
+        self.run_pweave('doc.tex_pweave')
+        return self.read('doc.tex')
+
+    def spilled_table(self, output):
+        "Return the table which *output* includes with \\input."
+        filename = output.split('\\input{')[1].split('}')[0]
+        return open(self.path(filename)).read()
+
+    def test_rows(self):
+        output = self.weave_table('column_formats=%.2f#%.1f', 3, rows_as_list)
+        self.assertTrue('\\caption{Numbers}' in output)
+        self.assertTrue('0.00 & 0.0\\\\\n0.25 & 0.5\\\\\n0.50 & 1.0\\\\\n'
+                        '\\hline\n' in output)
+
+    def test_kinds_of_rows(self):
+        outputs = [self.weave_table('', 25, rows)
+                   for rows in [rows_as_list, rows_as_generator,
+                                rows_as_array]]
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+    def test_spilled_table(self):
+        # longer than the pieces in which spilled tables are written
+        n = 25000
+        for rows in [rows_as_list, rows_as_generator, rows_as_array]:
+            output = self.weave_table('', n, rows)
+            spilled = self.spilled_table(self.weave_table('spill=true', n,
+                                                          rows))
+            self.assertEqual(spilled, output[output.index('\n\\begin{table}'):])
+            self.assertEqual(spilled.count('\\\\\n'), n)
+
+    def test_spilled_file_is_kept_if_unchanged(self):
+        self.spilled_table(self.weave_table('spill=true', 3, rows_as_list))
+        filename = self.path('pweave_images/Table1.tex')
+        os.utime(filename, (0, 0))
+        self.weave_table('spill=true', 3, rows_as_list)
+        self.assertEqual(os.stat(filename).st_mtime, 0)
+        self.weave_table('spill=true', 4, rows_as_list)
+        self.assertNotEqual(os.stat(filename).st_mtime, 0)
+        self.assertEqual(os.listdir(self.path('pweave_images')),
+                         ['Table1.tex'])
+
+    def test_split_table(self):
+        output = self.weave_table('max_rows=10', 25, rows_as_generator)
+        self.assertEqual(output.count('\\begin{table}'), 3)
+        self.assertEqual(output.count('Numbers (continued)'), 2)
+        spilled = self.spilled_table(self.weave_table('max_rows=10, spill=true',
+                                                      25, rows_as_generator))
+        self.assertEqual(spilled, output[output.index('\n\\begin{table}'):])
+
+    def test_longtable_pages_end_with_one_rule(self):
+        output = self.weave_table('paginate=longtable', 3, rows_as_list)
+        self.assertTrue('\\begin{longtable}' in output)
+        self.assertTrue('\\hline\n\\endfoot\n' in output)
+        self.assertFalse('\\hline\n\\end{longtable}' in output)
+        self.assertEqual(output.count('\\hline'), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests of compiled output templates (see CompiledTemplate and
+CodeProcessor.render_template()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import unittest
+from string import Template
+
+from support import load_pweave
+
+pweave = load_pweave()
+
+class CompiledTemplateTest(unittest.TestCase):
+
+    def assertRendersLikeTemplate(self, template_str, mapping):
+        self.assertEqual(pweave.CompiledTemplate(template_str).render(mapping),
+                         Template(template_str).substitute(mapping))
+
+    def test_same_as_template(self):
+        mapping = {'name': 'x', 'caption': '50% of $y', 'width': '15 cm'}
+        for template_str in ['\\includegraphics{$name}\n',
+                             '${name}s and $caption at ${width}',
+                             '100% $name %s %(name)s',
+                             'costs $$5, $name',
+                             'no placeholders',
+                             '']:
+            self.assertRendersLikeTemplate(template_str, mapping)
+
+    def test_missing_value(self):
+        template = pweave.CompiledTemplate('$name and $other')
+        self.assertRaises(KeyError, template.render, {'name': 'x'})
+
+    def test_invalid_placeholder(self):
+        self.assertRaises(ValueError, pweave.CompiledTemplate, 'costs $5')
+
+    def test_compiled_once(self):
+        template = pweave.compile_template('$x')
+        self.assertTrue(pweave.compile_template('$x') is template)
+
+    def test_compile_templates(self):
+        templates = pweave.compile_templates({
+                            'output': '$x',
+                            'figure': {'tex': 'tex $x', 'rst': 'rst $x'}})
+        self.assertEqual(templates['output'].render({'x': 1}), '1')
+        self.assertEqual(templates['figure']['rst'].render({'x': 1}), 'rst 1')
+
+class RenderTemplateTest(unittest.TestCase):
+
+    class Processor(pweave.CodeProcessor):
+        def name(self):
+            return 'test'
+
+        def template_strs(self):
+            return {'output': '[$x]',
+                    'figure': {'tex': 'tex $x', 'rst': 'rst $x'}}
+
+    def setUp(self):
+        self.processor = self.Processor({})
+
+    def tearDown(self):
+        pweave.settings.clear()
+
+    def test_render(self):
+        self.assertEqual(self.processor.render_template('output', {'x': 1}),
+                         '[1]')
+
+    def test_template_per_format(self):
+        for output_format in ['tex', 'rst']:
+            pweave.settings['format'] = output_format
+            self.assertEqual(self.processor.render_template('figure',
+                                                            {'x': 1}),
+                             output_format + ' 1')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of weaving again when the inputs change (see FileWatcher and watch()).
+
+Run from the repository's top directory:
+
+    python -m unittest discover tests
+
+"""
+import os
+import sys
+import time
+import Queue
+import unittest
+import threading
+import subprocess
+
+from support import load_pweave, pweave_path, plugin_dir, PweaveTestCase
+
+pweave = load_pweave()
+
+# seconds to wait for pweave to notice a change
+timeout = 20
+
+class FileWatcherTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        self.watcher = pweave.FileWatcher()
+        os.mkdir(self.path('plugins'))
+        self.write('doc.tex_pweave', 'text\n')
+        self.write('plugins/plugin.py', '')
+        self.files = [self.path('doc.tex_pweave')]
+        self.directories = [self.path('plugins')]
+        self.snapshot = self.watcher.snapshot(self.files, self.directories)
+
+    def change_later(self, filename, text):
+        "Write *text* to *filename* after a while, in another thread."
+        timer = threading.Timer(0.2, self.write, (filename, text))
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def wait(self):
+        return self.watcher.wait(self.files, self.directories, self.snapshot)
+
+    def test_snapshot(self):
+        self.assertEqual(sorted(self.snapshot),
+                         [self.path('doc.tex_pweave'),
+                          self.path('plugins/plugin.py')])
+
+    def test_changed_file(self):
+        self.change_later('doc.tex_pweave', 'more text\n')
+        self.assertEqual(self.wait(), [self.path('doc.tex_pweave')])
+
+    def test_new_plugin(self):
+        self.change_later('plugins/new.py', '')
+        self.assertEqual(self.wait(), [self.path('plugins/new.py')])
+
+    def test_changed_before_waiting(self):
+        self.write('doc.tex_pweave', 'more text\n')
+        self.assertEqual(self.wait(), [self.path('doc.tex_pweave')])
+
+    def test_polling(self):
+        self.watcher.libc = None
+        self.watcher.poll_interval = 0.05
+        self.change_later('doc.tex_pweave', 'more text\n')
+        self.assertEqual(self.wait(), [self.path('doc.tex_pweave')])
+
+class WatchTest(PweaveTestCase):
+
+    def setUp(self):
+        PweaveTestCase.setUp(self)
+        self.write('data.txt', 'first')
+        self.write('doc.tex_pweave', '<<echo=False, inputs=data.txt>>=\n'
+                                     'print open("data.txt").read()\n@\n')
+        self.process = subprocess.Popen([sys.executable, pweave_path,
+                                         '-p', plugin_dir, '--watch',
+                                         'doc.tex_pweave'],
+                                        cwd=self.directory,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        # the lines printed by pweave, read by another thread
+        self.lines = Queue.Queue()
+        self.reader = threading.Thread(target=self.read_lines)
+        self.reader.start()
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.wait()
+        self.reader.join()
+        PweaveTestCase.tearDown(self)
+
+    def read_lines(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self.lines.put(line)
+
+    def wait_for_weave(self):
+        "Wait until pweave has woven the document, and return its output."
+        output = []
+        deadline = time.time() + timeout
+        while not output or 'watching' not in output[-1]:
+            try:
+                output.append(self.lines.get(timeout=deadline - time.time()))
+            except (Queue.Empty, ValueError):
+                self.fail('pweave did not weave:\n' + ''.join(output))
+        return ''.join(output)
+
+    def test_changed_input(self):
+        output = self.wait_for_weave()
+        self.assertTrue('watching 2 files' in output)
+        self.assertTrue('first' in self.read('doc.tex'))
+        self.write('data.txt', 'second')
+        output = self.wait_for_weave()
+        self.assertTrue('Changed: ' + self.path('data.txt') in output)
+        self.assertTrue('second' in self.read('doc.tex'))
+
+    def test_changed_source(self):
+        self.wait_for_weave()
+        self.write('doc.tex_pweave', 'no code\n')
+        self.wait_for_weave()
+        self.assertEqual(self.read('doc.tex'), 'no code\n')
+
+if __name__ == "__main__":
+    unittest.main()